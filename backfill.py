@@ -0,0 +1,274 @@
+# backfill.py
+
+"""
+Бэкфилл: анализ комментариев по всей базе активных заказов (или по диапазону дат создания).
+
+Обычный запуск смотрит только 50 последних заказов, поэтому строки «ДД.ММ - действие»
+в более старых активных заказах не превращаются в задачи. Бэкфилл постранично обходит базу,
+запрашивая страницы параллельно в пределах бюджета запросов, прогоняет заказы через дешёвые
+локальные фильтры (в том числе по статусу) и отправляет на анализ только кандидатов. После каждой
+пачки страниц курсор сохраняется, поэтому прерванный бэкфилл продолжается с того же места: верхняя
+граница даты создания закрепляется при старте обхода, и страницы между запусками не сдвигаются.
+
+    python backfill.py                               # вся база активных заказов
+    python backfill.py --from 2025-01-01 --to 2025-06-30
+    python backfill.py --tenant shop2                # аккаунт из TENANTS_FILE
+    python backfill.py --reset                       # начать заново, не глядя на курсор
+"""
+
+import os
+import sys
+import time
+import argparse
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from main import (CRM_DATETIME_FORMAT, build_comment_pipeline, extract_last_entries, filter_order, moscow_tz,
+                  run_lock)
+import clock
+import json_codec
+import log
+from models import Order
+from openai_processor import STRICT_TASK_RE
+from settings import SETTINGS
+from retailcrm_api import RATE_LIMIT, PAGE_LIMIT, RetailCRMClient, fetch_orders_page, use_client
+from locking import LeaseLock
+from sharding import owns_order, shard_path, shard_suffix
+from tenants import TENANTS_FILE, load_tenants, tenant_path, tenant_suffix, use_tenant
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Курсор бэкфилла (у каждого шарда и тенанта свой)
+BACKFILL_CURSOR_FILE = shard_path(SETTINGS.backfill_cursor_file)
+# Сколько страниц запрашивается параллельно
+BACKFILL_PAGE_WORKERS = SETTINGS.backfill_page_workers
+# Доля бюджета запросов аккаунта для бэкфилла: cron-запуски на том же ключе не должны упираться в лимит
+BACKFILL_RATE_SHARE = SETTINGS.backfill_rate_share
+# Как часто проверять, освободил ли периодический запуск блокировку обработки заказов, секунды
+BACKFILL_LOCK_RETRY_SECONDS = 5
+
+
+def scan_params(date_from: Optional[str] = None, date_to: Optional[str] = None,
+                created_to: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Фильтры обхода: даты создания и верхняя граница created_to, закреплённая при старте обхода.
+    Курсор — номер страницы, поэтому выборка между запусками не должна меняться: новые заказы
+    отсекает created_to, а статус в выборку не входит (заказ, сменивший статус, сдвигал бы страницы)
+    и проверяется локально в filter_order.
+    """
+    params: Dict[str, Any] = {}
+    if date_from:
+        params['filter[createdAtFrom]'] = f"{date_from} 00:00:00"
+    upper = [bound for bound in (f"{date_to} 23:59:59" if date_to else None, created_to) if bound]
+    if upper:
+        params['filter[createdAtTo]'] = min(upper)
+    return params
+
+
+def load_cursor(path: str, scan_key: str) -> Dict[str, Any]:
+    """Курсор того же обхода (те же фильтры) или пустой курсор."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        cursor = json_codec.load_file(path)
+    except (IOError, json_codec.JSONDecodeError) as e:
+        logger.error("Ошибка при чтении курсора %s: %s. Начинаю обход сначала.", path, e)
+        return {}
+    if cursor.get('scan') != scan_key:
+        logger.warning("Курсор %s относится к другому обходу. Начинаю обход сначала.", path)
+        return {}
+    return cursor
+
+
+def save_cursor(path: str, cursor: Dict[str, Any]):
+    try:
+        json_codec.dump_file(path, cursor, atomic=True)
+    except IOError as e:
+        logger.error("Ошибка при записи курсора %s: %s", path, e)
+
+
+def candidate_outcome(order: Order, only_dated: bool) -> Optional[str]:
+    """Итог дешёвой проверки заказа или None, если заказ нужно анализировать."""
+    outcome = filter_order(order)
+    if outcome:
+        return outcome
+    # Без строки строгого формата «ДАТА - ДЕЙСТВИЕ» (тот же разбор, что у уровня local) анализировать нечего
+    if only_dated and not STRICT_TASK_RE.search(extract_last_entries(order.manager_comment)):
+        return 'undated'
+    return None
+
+
+@contextmanager
+def hold_run_lock() -> Iterator[None]:
+    """
+    Блокировка обработки заказов, та же, что у main() и приёмника триггеров: пачка бэкфилла
+    не анализируется параллельно с cron-запуском. Если идёт запуск, ждёт его завершения.
+    """
+    lock = run_lock()
+    if not lock.acquire():
+        logger.info("Идёт периодический запуск (блокировка занята). Жду его завершения...")
+        while not lock.acquire():
+            time.sleep(BACKFILL_LOCK_RETRY_SECONDS)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def fetch_pages(params: Dict[str, Any], pages: List[int], workers: int) -> Dict[int, Any]:
+    """Параллельно запрашивает страницы; результат fetch_orders_page по номеру страницы."""
+    with ThreadPoolExecutor(max_workers=min(workers, len(pages))) as executor:
+        futures = {
+            page: executor.submit(contextvars.copy_context().run, fetch_orders_page, params, page, PAGE_LIMIT)
+            for page in pages
+        }
+        return {page: future.result() for page, future in futures.items()}
+
+
+def run_backfill(date_from: Optional[str] = None, date_to: Optional[str] = None, only_dated: bool = True,
+                 reset: bool = False, page_workers: int = BACKFILL_PAGE_WORKERS) -> Dict[str, Any]:
+    """Обходит базу, анализирует кандидатов и возвращает итоги обхода."""
+    path = tenant_path(BACKFILL_CURSOR_FILE)
+    scan_key = json_codec.dumps(scan_params(date_from, date_to), sort_keys=True)
+    cursor = {} if reset else load_cursor(path, scan_key)
+    # Граница обхода закрепляется при первом запуске и переживает продолжения с курсора
+    created_to = cursor.get('created_to') or clock.now(moscow_tz()).strftime(CRM_DATETIME_FORMAT)
+    params = scan_params(date_from, date_to, created_to)
+
+    next_page = cursor.get('next_page', 1)
+    total_pages = cursor.get('total_pages')
+    totals = cursor.get('totals') or {'scanned': 0, 'candidates': 0}
+    if next_page > 1:
+        logger.info("Продолжаю бэкфилл со страницы %s из %s (уже просмотрено %s заказов).",
+                    next_page, total_pages, totals['scanned'])
+
+    started = time.perf_counter()
+    scanned = candidates = 0
+    completed = False
+
+    while True:
+        # Пока число страниц неизвестно, запрашиваем одну; дальше — пачками по page_workers
+        last_page = next_page if total_pages is None else min(total_pages, next_page + page_workers - 1)
+        pages = list(range(next_page, last_page + 1))
+        if not pages:
+            completed = True
+            break
+
+        results = fetch_pages(params, pages, page_workers)
+        # Курсор двигается только по непрерывному префиксу успешно полученных страниц
+        batch: List[Order] = []
+        done_pages = 0
+        for page in pages:
+            result = results[page]
+            if result is None:
+                break
+            orders, pagination = result
+            total_pages = int(pagination.get('totalPageCount') or 0)
+            batch.extend(order for order in orders if owns_order(order.id))
+            done_pages += 1
+
+        batch_candidates = []
+        for order in batch:
+            outcome = candidate_outcome(order, only_dated)
+            if outcome:
+                metrics.inc('orders_processed', outcome=outcome)
+            else:
+                batch_candidates.append(order)
+
+        if batch_candidates:
+            # Старые заказы без найденных задач не получают заглушку «запланировать дату касания»:
+            # по всей базе это были бы тысячи задач
+            comment_pipeline = build_comment_pipeline(include_filter=False, fallback_task=False)
+            # Блокировка берётся на пачку, а не на весь обход: cron-запуски идут между пачками
+            with hold_run_lock():
+                comment_pipeline.run(batch_candidates)
+
+        scanned += len(batch)
+        candidates += len(batch_candidates)
+        metrics.inc('orders_scanned', len(batch), block='backfill')
+        next_page += done_pages
+        save_cursor(path, {
+            'scan': scan_key,
+            'created_to': created_to,
+            'next_page': next_page,
+            'total_pages': total_pages,
+            'totals': {'scanned': totals['scanned'] + scanned, 'candidates': totals['candidates'] + candidates},
+        })
+
+        elapsed = time.perf_counter() - started
+        logger.info("📦 Страницы %s–%s из %s: просмотрено %s заказов (%.1f/с), кандидатов %s.",
+                    pages[0], pages[0] + done_pages - 1, total_pages, scanned, scanned / elapsed if elapsed else 0,
+                    candidates)
+
+        if done_pages < len(pages):
+            logger.warning("Страница %s не получена. Бэкфилл остановлен; повторный запуск продолжит с неё.",
+                           pages[done_pages])
+            break
+        if next_page > total_pages:
+            completed = True
+            break
+
+    elapsed = time.perf_counter() - started
+    if completed and os.path.exists(path):
+        os.remove(path)
+    return {
+        'completed': completed,
+        'scanned': scanned,
+        'candidates': candidates,
+        'elapsed_seconds': round(elapsed, 3),
+        'orders_per_second': round(scanned / elapsed, 2) if elapsed else None,
+    }
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бэкфилл анализа комментариев по всей базе заказов.")
+    parser.add_argument('--from', dest='date_from', metavar='YYYY-MM-DD', help="дата создания заказов с")
+    parser.add_argument('--to', dest='date_to', metavar='YYYY-MM-DD', help="дата создания заказов по")
+    parser.add_argument('--tenant', help="имя тенанта из файла конфигурации тенантов")
+    parser.add_argument('--tenants', metavar='FILE', default=TENANTS_FILE or 'tenants.json',
+                        help="файл конфигурации тенантов для --tenant")
+    parser.add_argument('--workers', type=int, default=BACKFILL_PAGE_WORKERS,
+                        help=f"страниц параллельно (по умолчанию {BACKFILL_PAGE_WORKERS})")
+    parser.add_argument('--all-candidates', action='store_true',
+                        help="анализировать и заказы без строк с датой (в том числе с пустым комментарием)")
+    parser.add_argument('--reset', action='store_true', help="начать обход заново, игнорируя курсор")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    log.configure()
+    with ExitStack() as stack:
+        if args.tenant:
+            tenant = next((t for t in load_tenants(args.tenants) if t.name == args.tenant), None)
+            if tenant is None:
+                logger.error("Тенант '%s' не найден в %s.", args.tenant, args.tenants)
+                return 1
+            rate_limit = (tenant.rate_limit if tenant.rate_limit is not None else RATE_LIMIT) * BACKFILL_RATE_SHARE
+            client = RetailCRMClient.for_tenant(tenant, rate_limit=rate_limit)
+            stack.enter_context(use_tenant(tenant.name))
+        else:
+            client = RetailCRMClient.from_env(rate_limit=RATE_LIMIT * BACKFILL_RATE_SHARE)
+        stack.enter_context(use_client(client))
+        stack.callback(client.close)
+
+        if not stack.enter_context(LeaseLock(f"backfill{tenant_suffix()}{shard_suffix()}")):
+            logger.info("Бэкфилл этого аккаунта уже выполняется (блокировка занята). Завершаю работу.")
+            return 1
+
+        result = run_backfill(args.date_from, args.date_to, only_dated=not args.all_candidates,
+                              reset=args.reset, page_workers=args.workers)
+
+    status = "завершён" if result['completed'] else "прерван (продолжится с курсора)"
+    logger.info("Бэкфилл %s: просмотрено %s заказов за %.1f с (%.1f заказов/с), на анализ отправлено %s.",
+                status, result['scanned'], result['elapsed_seconds'], result['orders_per_second'] or 0,
+                result['candidates'])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
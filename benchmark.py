@@ -0,0 +1,160 @@
+# benchmark.py
+
+"""
+Бенчмарк main() на фейковых RetailCRM и OpenAI (см. fake_servers.py).
+
+Для каждого размера базы поднимаются локальные серверы с синтетическими заказами,
+после чего main() прогоняется по слотам 12:00, 16:00 и 21:00 нескольких дней подряд.
+Отчёт: запусков в секунду, число вызовов API и p50/p99 задержек.
+
+    python benchmark.py                         # 50, 1000 и 50000 заказов
+    python benchmark.py --sizes 1000 --days 5 --crm-latency 0.02 --llm-latency 0.3
+    python benchmark.py --error-rate 0.05 --rate-limit 10 --output bench.json
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime, timedelta
+from typing import Dict, Any, List
+
+import openai
+
+import main as task_manager
+import json_codec
+import metrics
+import retailcrm_api
+from fake_servers import API_KEY, FakeRetailCRM, FakeOpenAI, FakeServer, FaultInjector, generate_orders
+
+DEFAULT_SIZES = [50, 1000, 50000]
+SLOT_HOURS = [12, 16, 21]
+
+
+def _collect_samples(store: Dict[str, List[float]]):
+    """Переносит наблюдения гистограмм текущего запуска в общий накопитель (main() сбрасывает метрики)."""
+    for name, series in metrics.METRICS.histograms.items():
+        for key, hist in series.items():
+            labels = ','.join(v for _, v in key)
+            store.setdefault(f"{name}{{{labels}}}" if labels else name, []).extend(hist.samples)
+
+
+def run_scenario(size: int, days: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Прогоняет main() по всем слотам на базе из size заказов и возвращает сводку."""
+    start_day = task_manager.MOSCOW_TZ.localize(datetime(2025, 10, 13))
+    orders = generate_orders(size, now=start_day, seed=args.seed)
+
+    crm = FakeRetailCRM(orders, faults=FaultInjector(latency=args.crm_latency, jitter=args.crm_latency / 2,
+                                                     rate_limit=args.rate_limit, error_rate=args.error_rate,
+                                                     seed=args.seed))
+    llm = FakeOpenAI(faults=FaultInjector(latency=args.llm_latency, jitter=args.llm_latency / 2,
+                                          error_rate=args.error_rate, seed=args.seed),
+                     rpm=args.llm_rpm, tpm=args.llm_tpm)
+
+    samples: Dict[str, List[float]] = {}
+    run_times: List[float] = []
+    tiers: Dict[str, Dict[str, float]] = {}
+    previous_cwd = os.getcwd()
+
+    with FakeServer(crm=crm, llm=llm) as server, tempfile.TemporaryDirectory() as workdir:
+        # Лимит частоты эмулирует сам фейковый сервер (--rate-limit), поэтому бюджет клиента отключён
+        retailcrm_api.set_default_client(
+            retailcrm_api.RetailCRMClient(server.url, API_KEY, 'fake-site', rate_limit=0))
+        openai.api_key = 'fake-openai-key'
+        openai.base_url = f"{server.url}/v1/"
+
+        # Трекеры и отчёты пишутся во временный каталог, а не в рабочие файлы
+        os.chdir(workdir)
+        try:
+            for day in range(days):
+                for hour in SLOT_HOURS:
+                    slot = start_day + timedelta(days=day, hours=hour)
+                    started = time.perf_counter()
+                    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                        task_manager.main(now_moscow=slot)
+                    run_times.append(time.perf_counter() - started)
+                    _collect_samples(samples)
+                    _collect_tiers(tiers)
+        finally:
+            os.chdir(previous_cwd)
+
+    total_time = sum(run_times)
+    return {
+        'orders': size,
+        'runs': len(run_times),
+        'total_seconds': round(total_time, 3),
+        'runs_per_second': round(len(run_times) / total_time, 3) if total_time else None,
+        'run_seconds': {'p50': metrics.percentile(run_times, 50), 'p99': metrics.percentile(run_times, 99)},
+        'crm_calls': dict(sorted(crm.request_counts.items())),
+        'crm_calls_total': sum(crm.request_counts.values()),
+        'openai_calls': llm.request_count,
+        'openai_tokens': llm.tokens_total,
+        'openai_throttled': llm.throttled_count,
+        'tasks_created': len(crm.tasks),
+        'llm_tiers': {
+            tier: {**totals, 'p50': metrics.percentile(samples.get(f'llm_tier_seconds{{{tier}}}', []), 50)}
+            for tier, totals in sorted(tiers.items())
+        },
+        'latency_seconds': {
+            name: {'count': len(values), 'p50': metrics.percentile(values, 50), 'p99': metrics.percentile(values, 99)}
+            for name, values in sorted(samples.items())
+        },
+    }
+
+
+def _ms(value) -> str:
+    return f"{value * 1000:.1f}" if value is not None else '-'
+
+
+def print_report(results: List[Dict[str, Any]]):
+    print(f"{'orders':>8} {'runs':>5} {'runs/s':>8} {'run p50 ms':>11} {'run p99 ms':>11} "
+          f"{'CRM calls':>10} {'LLM calls':>10} {'tasks':>6}")
+    for r in results:
+        print(f"{r['orders']:>8} {r['runs']:>5} {r['runs_per_second'] or 0:>8.2f} {_ms(r['run_seconds']['p50']):>11} "
+              f"{_ms(r['run_seconds']['p99']):>11} {r['crm_calls_total']:>10} {r['openai_calls']:>10} "
+              f"{r['tasks_created']:>6}")
+
+    for r in results:
+        print(f"\nУровни анализа, {r['orders']} заказов:")
+        for tier, stats in r['llm_tiers'].items():
+            print(f"  {tier:<8} {int(stats['requests']):>6} запросов, p50 {_ms(stats['p50']):>8} мс, "
+                  f"${stats['cost_usd']:.4f}")
+
+    for r in results:
+        print(f"\nЗадержки, {r['orders']} заказов (p50 / p99, мс):")
+        for name, stats in r['latency_seconds'].items():
+            print(f"  {name:<60} {_ms(stats['p50']):>8} / {_ms(stats['p99']):<8} (n={stats['count']})")
+
+
+def _collect_tiers(store: Dict[str, Dict[str, float]]):
+    """Накопитель разбивки по уровням анализа: запросов и стоимость (USD) на уровень."""
+    for name, field in (('llm_tier_requests', 'requests'), ('llm_cost_usd', 'cost_usd')):
+        for key, value in metrics.METRICS.counters.get(name, {}).items():
+            tier = dict(key).get('tier', '')
+            store.setdefault(tier, {'requests': 0, 'cost_usd': 0.0})[field] += value
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бенчмарк main() на фейковых RetailCRM и OpenAI.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="размеры базы заказов")
+    parser.add_argument('--days', type=int, default=2, help="сколько дней слотов 12/16/21 прогнать")
+    parser.add_argument('--crm-latency', type=float, default=0.005, help="задержка ответа RetailCRM, сек")
+    parser.add_argument('--llm-latency', type=float, default=0.05, help="задержка ответа OpenAI, сек")
+    parser.add_argument('--rate-limit', type=float, default=None, help="лимит запросов к RetailCRM в секунду")
+    parser.add_argument('--llm-rpm', type=int, default=None, help="лимит запросов к OpenAI в минуту")
+    parser.add_argument('--llm-tpm', type=int, default=None, help="лимит токенов OpenAI в минуту")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 500 от обоих серверов")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="сохранить результаты в JSON-файл")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    results = [run_scenario(size, args.days, args) for size in args.sizes]
+    print_report(results)
+    if args.output:
+        json_codec.dump_file(args.output, results, indent=True)
+        print(f"\nРезультаты сохранены в {args.output}.")
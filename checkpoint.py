@@ -0,0 +1,186 @@
+# checkpoint.py
+
+import os
+import threading
+import logging
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+import json_codec
+import log
+from settings import SETTINGS
+from sharding import shard_path
+from tenants import current_tenant, tenant_path
+
+logger = logging.getLogger(__name__)
+
+# Журнал прогресса запуска: одна JSON-запись на строку (у каждого шарда свой)
+RUN_JOURNAL_FILE = shard_path(SETTINGS.run_journal_file)
+
+# Шаг, которым отмечается полностью обработанный заказ
+DONE_STEP = 'done'
+# Сколько запусков подряд переносятся незавершённые шаги заказа; дальше они отбрасываются
+RUN_JOURNAL_MAX_CARRIES = SETTINGS.run_journal_max_carries
+
+
+def new_run_id() -> str:
+    return f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+
+
+class RunJournal:
+    """
+    Журнал прогресса запуска по заказам (анализ выполнен, задача создана, комментарий обновлён).
+
+    Каждый шаг дописывается в файл сразу после выполнения. Если предыдущий запуск не дошёл
+    до finish() (процесс убит, OOM), следующий запуск продолжает его с тем же run_id и
+    пропускает уже выполненные шаги. Если предыдущий запуск завершился, но по каким-то заказам
+    комментарий так и не был обновлён маркером, их шаги переносятся в новый запуск, чтобы
+    задачи по ним не создавались повторно, — но не больше RUN_JOURNAL_MAX_CARRIES запусков подряд,
+    иначе шаги заказа, комментарий которого так и не обновится, копились бы в журнале бесконечно.
+    """
+
+    def __init__(self, path: str = RUN_JOURNAL_FILE):
+        self.path = path
+        self.run_id: Optional[str] = None
+        self.resumed = False
+        self._steps: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._flows: Dict[str, str] = {}
+        # Сколько раз шаги заказа уже переносились из предыдущих запусков
+        self._carries: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _read_records(self):
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json_codec.loads(line))
+                    except json_codec.JSONDecodeError:
+                        # Последняя строка могла оборваться при аварийном завершении
+                        continue
+        except IOError as e:
+            logger.error("Ошибка при чтении журнала запуска %s: %s. Начинаю новый запуск.", self.path, e)
+            return []
+        return records
+
+    def _load_steps(self, records, run_id: str):
+        for record in records:
+            if record.get('run') == run_id and record.get('event') == 'step':
+                order_id = str(record['order'])
+                self._steps.setdefault(order_id, {})[record['step']] = record.get('data') or {}
+                if record.get('flow'):
+                    self._flows[order_id] = record['flow']
+                if record.get('carries'):
+                    self._carries[order_id] = max(self._carries.get(order_id, 0), record['carries'])
+
+    def start(self) -> 'RunJournal':
+        """Начинает новый запуск или продолжает незавершённый."""
+        records = self._read_records()
+        runs = [r for r in records if r.get('event') == 'run_started']
+        last_run_id = runs[-1]['run'] if runs else None
+        last_finished = any(r.get('event') == 'run_finished' and r.get('run') == last_run_id for r in records)
+
+        with self._lock:
+            self._steps, self._flows, self._carries = {}, {}, {}
+            if last_run_id and not last_finished:
+                self.run_id = last_run_id
+                log.set_run_id(self.run_id)
+                self.resumed = True
+                self._load_steps(records, last_run_id)
+                logger.info("Продолжаю незавершённый запуск %s (в журнале %s заказов с выполненными шагами).",
+                            self.run_id, len(self._steps))
+                return self
+
+            self.run_id = new_run_id()
+            log.set_run_id(self.run_id)
+            self.resumed = False
+            carried = []
+            if last_run_id:
+                self._load_steps(records, last_run_id)
+                unfinished = {
+                    order_id for order_id, steps in self._steps.items()
+                    if self._flows.get(order_id) == 'comment' and DONE_STEP not in steps
+                }
+                expired = {order_id for order_id in unfinished
+                           if self._carries.get(order_id, 0) >= RUN_JOURNAL_MAX_CARRIES}
+                if expired:
+                    logger.warning("Шаги %s заказов не завершены за %s запусков и больше не переносятся: %s",
+                                   len(expired), RUN_JOURNAL_MAX_CARRIES, ', '.join(sorted(expired)))
+                unfinished -= expired
+                self._steps = {order_id: self._steps[order_id] for order_id in unfinished}
+                self._flows = {order_id: 'comment' for order_id in unfinished}
+                self._carries = {order_id: self._carries.get(order_id, 0) + 1 for order_id in unfinished}
+                carried = [
+                    {'run': self.run_id, 'event': 'step', 'order': order_id, 'step': step,
+                     'flow': 'comment', 'data': data, 'carries': self._carries[order_id]}
+                    for order_id, steps in self._steps.items() for step, data in steps.items()
+                ]
+
+            # Журнал хранит только текущий запуск, чтобы не расти бесконечно
+            try:
+                with open(self.path, 'w', encoding='utf-8') as f:
+                    f.write(json_codec.dumps({'run': self.run_id, 'event': 'run_started',
+                                              'ts': datetime.now().isoformat()}) + '\n')
+                    for record in carried:
+                        f.write(json_codec.dumps(record) + '\n')
+            except IOError as e:
+                logger.error("Ошибка при записи журнала запуска %s: %s", self.path, e)
+            if carried:
+                logger.info("Перенесены незавершённые шаги по %s заказам из предыдущего запуска.", len(self._steps))
+        return self
+
+    def _append(self, record: Dict[str, Any]):
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json_codec.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except IOError as e:
+            logger.error("Ошибка при записи журнала запуска %s: %s", self.path, e)
+
+    def get(self, order_id, step: str) -> Optional[Dict[str, Any]]:
+        """Данные выполненного шага или None, если шаг ещё не выполнялся."""
+        with self._lock:
+            return self._steps.get(str(order_id), {}).get(step)
+
+    def record(self, order_id, step: str, flow: Optional[str] = None, **data):
+        """Отмечает шаг выполненным. flow='comment' — шаг анализа комментария (переносится между запусками)."""
+        if self.run_id is None:
+            return
+        order_id = str(order_id)
+        with self._lock:
+            self._steps.setdefault(order_id, {})[step] = data
+            if flow:
+                self._flows[order_id] = flow
+            record = {'run': self.run_id, 'event': 'step', 'order': order_id, 'step': step, 'data': data}
+            if flow:
+                record['flow'] = flow
+            self._append(record)
+
+    def finish(self):
+        """Отмечает запуск завершённым: следующий запуск начнётся с нуля."""
+        if self.run_id is None:
+            return
+        with self._lock:
+            self._append({'run': self.run_id, 'event': 'run_finished', 'ts': datetime.now().isoformat()})
+
+
+JOURNAL = RunJournal()
+
+# Журналы тенантов многотенантного запуска (у каждого свой файл)
+_TENANT_JOURNALS: Dict[str, RunJournal] = {}
+_TENANT_JOURNALS_LOCK = threading.Lock()
+
+
+def journal() -> RunJournal:
+    """Журнал текущего тенанта; вне тенанта — общий JOURNAL."""
+    tenant = current_tenant()
+    if tenant is None:
+        return JOURNAL
+    with _TENANT_JOURNALS_LOCK:
+        if tenant not in _TENANT_JOURNALS:
+            _TENANT_JOURNALS[tenant] = RunJournal(tenant_path(RUN_JOURNAL_FILE))
+        return _TENANT_JOURNALS[tenant]
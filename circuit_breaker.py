@@ -0,0 +1,115 @@
+# circuit_breaker.py
+
+import time
+import threading
+import logging
+
+import metrics
+from settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# Сколько отказов подряд размыкает цепь и сколько секунд она остаётся разомкнутой
+CIRCUIT_FAILURE_THRESHOLD = SETTINGS.circuit_failure_threshold
+CIRCUIT_COOLDOWN_SECONDS = SETTINGS.circuit_cooldown_seconds
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class DependencyUnavailableError(Exception):
+    """Внешний сервис недоступен: работа не выполнена и должна быть повторена в следующий раз."""
+
+
+class CircuitOpenError(DependencyUnavailableError):
+    """Вызов отклонён без обращения к сервису: цепь разомкнута."""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} недоступен (цепь разомкнута, повтор через {retry_in:.0f} с)")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешней зависимости.
+
+    closed — вызовы идут как обычно; failure_threshold отказов подряд размыкают цепь.
+    open — вызовы сразу отклоняются (CircuitOpenError), не дожидаясь таймаута;
+    через cooldown_seconds цепь переходит в half_open.
+    half_open — пропускается один пробный вызов: успех замыкает цепь, отказ снова размыкает её.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 cooldown_seconds: float = CIRCUIT_COOLDOWN_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and self._cooldown_left() <= 0:
+                return HALF_OPEN
+            return self._state
+
+    def _cooldown_left(self) -> float:
+        return self._opened_at + self.cooldown_seconds - time.monotonic()
+
+    def _transition(self, state: str):
+        # Вызывается под self._lock
+        if state != self._state:
+            self._state = state
+            metrics.inc('circuit_transitions', dependency=self.name, state=state)
+            logger.info("⚡ Предохранитель %s: %s", self.name, state)
+
+    def before_call(self):
+        """Пропускает вызов или сразу отклоняет его (CircuitOpenError), если цепь разомкнута."""
+        with self._lock:
+            if self._state == OPEN:
+                retry_in = self._cooldown_left()
+                if retry_in > 0:
+                    metrics.inc('circuit_rejected_calls', dependency=self.name)
+                    raise CircuitOpenError(self.name, retry_in)
+                self._transition(HALF_OPEN)
+            if self._state == HALF_OPEN:
+                if self._probe_in_flight:
+                    metrics.inc('circuit_rejected_calls', dependency=self.name)
+                    raise CircuitOpenError(self.name, 0)
+                self._probe_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            self._transition(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._transition(OPEN)
+
+    def release(self):
+        """Вызов завершился ошибкой, которая ничего не говорит о состоянии сервиса."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def available(self) -> bool:
+        """True, если вызов сейчас не будет отклонён сразу."""
+        return self.state != OPEN
+
+    def reset(self):
+        """Замыкает цепь и сбрасывает счётчик отказов (бенчмарки, ручная отладка)."""
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            self._state = CLOSED
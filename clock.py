@@ -0,0 +1,56 @@
+# clock.py
+
+"""
+Часы процесса. Регламенты main.py (лимиты дней в статусах, трёхдневный цикл НДЗ, слоты 12/16/21)
+берут «сейчас» через clock.now(), а не datetime.now(): симулятор (simulator.py) подменяет часы
+виртуальными и прогоняет недели запусков за секунды.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta, tzinfo
+from typing import Iterator, Optional
+
+
+class VirtualClock:
+    """Часы, которые идут только по команде: set() и advance(). Время задаётся с часовым поясом."""
+
+    def __init__(self, start: datetime):
+        if start.tzinfo is None:
+            raise ValueError("Виртуальным часам нужно время с часовым поясом")
+        self._now = start
+
+    def now(self, tz: Optional[tzinfo] = None) -> datetime:
+        """Как datetime.now(tz); без tz — наивное время в поясе, с которым заданы часы."""
+        if tz is None:
+            return self._now.replace(tzinfo=None)
+        return self._now.astimezone(tz)
+
+    def set(self, moment: datetime):
+        if moment.tzinfo is None:
+            raise ValueError("Виртуальным часам нужно время с часовым поясом")
+        self._now = moment
+
+    def advance(self, delta: timedelta):
+        self._now = self._now + delta
+
+
+# Часы процесса: None — системные. Общие для всех потоков (конвейер, планировщик, фейковые серверы)
+_clock: Optional[VirtualClock] = None
+
+
+def now(tz: Optional[tzinfo] = None) -> datetime:
+    """Текущее время по часам процесса."""
+    if _clock is not None:
+        return _clock.now(tz)
+    return datetime.now(tz)
+
+
+@contextmanager
+def use_clock(virtual: VirtualClock) -> Iterator[VirtualClock]:
+    """Подменяет часы процесса на время блока."""
+    global _clock
+    previous, _clock = _clock, virtual
+    try:
+        yield virtual
+    finally:
+        _clock = previous
@@ -0,0 +1,225 @@
+# extractor_eval.py
+
+"""
+Офлайн-оценка экстрактора задач: точность и полнота на размеченном корпусе, задержки и токены.
+
+Корпус — JSONL (по умолчанию eval/corpus.jsonl): записи комментария и ожидаемый список задач
+в формате ответа модели. Начальный корпус — примеры из промпта analyze_comment_with_openai;
+--export N добавляет N новых неразмеченных записей из CRM (expected = null), их нужно разметить вручную.
+
+Бэкенды экстрактора:
+    router               — рабочий путь: выбор уровня и модели (route_comment)
+    model:<имя>          — все записи в одну модель, например model:gpt-4.1-mini
+    rules                — разбор строк «ДД.ММ - действие» без модели
+    replay:<файл>        — ответы, записанные ранее через --record (офлайн, без запросов)
+
+Задачи сопоставляются по строке-источнику (marked_line), даты — по дню и месяцу в этой строке.
+Отчёт: precision/recall по задачам и датам, доля полностью верных записей, p50/p95 задержки,
+токенов на запись и записей в секунду. С --baseline скрипт завершается с кодом 1, если
+precision или recall упали относительно сохранённого отчёта: изменения промпта и модели
+принимаются только по измеренному результату.
+
+    python extractor_eval.py --backend model:gpt-4o-mini --record eval/recordings/gpt-4o-mini.jsonl
+    python extractor_eval.py --backend replay:eval/recordings/gpt-4o-mini.jsonl --output eval/baseline.json
+    python extractor_eval.py --backend router --baseline eval/baseline.json
+    python extractor_eval.py --export 200
+"""
+
+import os
+import sys
+import argparse
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import json_codec
+import metrics
+from extractors import Backend, Extraction, comment_key, make_backend, task_keys
+
+DEFAULT_CORPUS = os.path.join('eval', 'corpus.jsonl')
+# Допустимое падение precision/recall относительно --baseline
+DEFAULT_TOLERANCE = 0.0
+
+
+def load_corpus(path: str) -> List[Dict[str, Any]]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json_codec.loads(line) for line in f if line.strip()]
+
+
+def _ratio(numerator: float, denominator: float) -> float:
+    # Пустой знаменатель: ни одной предсказанной (ожидаемой) задачи — ошибаться было не в чем
+    return numerator / denominator if denominator else 1.0
+
+
+def score(corpus: List[Dict[str, Any]], results: List[Extraction]) -> Dict[str, Any]:
+    """Сводка качества, задержек и токенов по размеченным записям."""
+    totals = Counter()
+    latencies, tokens = [], 0
+    mismatches = []
+    for item, result in zip(corpus, results):
+        if result.tasks is None:
+            totals['errors'] += 1
+            continue
+        latencies.append(result.latency)
+        tokens += result.tokens
+        expected_lines, expected_dates = task_keys(item['expected'])
+        predicted_lines, predicted_dates = task_keys(result.tasks)
+        totals['tasks_tp'] += sum((expected_lines & predicted_lines).values())
+        totals['tasks_expected'] += sum(expected_lines.values())
+        totals['tasks_predicted'] += sum(predicted_lines.values())
+        totals['dates_tp'] += sum((expected_dates & predicted_dates).values())
+        totals['dates_expected'] += sum(expected_dates.values())
+        totals['dates_predicted'] += sum(predicted_dates.values())
+        if expected_dates == predicted_dates:
+            totals['exact'] += 1
+        else:
+            mismatches.append({'id': item.get('id'), 'comment': item['comment'],
+                               'expected': item['expected'], 'predicted': result.tasks})
+    scored = len(latencies)
+    wall = sum(latencies)
+    return {
+        'comments': len(corpus),
+        'scored': scored,
+        'errors': totals['errors'],
+        'tasks': {'precision': _ratio(totals['tasks_tp'], totals['tasks_predicted']),
+                  'recall': _ratio(totals['tasks_tp'], totals['tasks_expected'])},
+        'dates': {'precision': _ratio(totals['dates_tp'], totals['dates_predicted']),
+                  'recall': _ratio(totals['dates_tp'], totals['dates_expected'])},
+        'exact_match': totals['exact'] / scored if scored else None,
+        'latency_seconds': {'p50': metrics.percentile(latencies, 50), 'p95': metrics.percentile(latencies, 95)},
+        'tokens_per_comment': tokens / scored if scored else None,
+        'comments_per_second': scored / wall if wall else None,
+        'mismatches': mismatches,
+    }
+
+
+def evaluate(backend: Backend, corpus: List[Dict[str, Any]],
+             record_path: Optional[str] = None) -> Dict[str, Any]:
+    """Прогоняет бэкенд по размеченным записям корпуса; с record_path сохраняет ответы для replay."""
+    labelled = [item for item in corpus if item.get('expected') is not None]
+    results = []
+    record_file = open(record_path, 'w', encoding='utf-8') if record_path else None
+    try:
+        for item in labelled:
+            result = backend.extract(item['comment'])
+            results.append(result)
+            if record_file:
+                record_file.write(json_codec.dumps({
+                    'key': comment_key(item['comment']), 'id': item.get('id'), 'backend': backend.name,
+                    'tasks': result.tasks, 'latency': result.latency, 'tokens': result.tokens,
+                    'error': result.error,
+                }) + '\n')
+    finally:
+        if record_file:
+            record_file.close()
+    report = score(labelled, results)
+    report['backend'] = backend.name
+    report['unlabelled'] = len(corpus) - len(labelled)
+    return report
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Регрессии качества относительно baseline (пустой список — изменение можно принимать)."""
+    problems = []
+    for group in ('tasks', 'dates'):
+        for measure in ('precision', 'recall'):
+            current, previous = report[group][measure], baseline[group][measure]
+            if current is not None and previous is not None and current < previous - tolerance:
+                problems.append(f"{group} {measure}: {current:.3f} < {previous:.3f} "
+                                f"(baseline {baseline.get('backend')})")
+    return problems
+
+
+def export_comments(corpus_path: str, limit: int) -> int:
+    """
+    Добавляет в корпус до limit новых неразмеченных записей из последних заказов CRM; возвращает число
+    добавленных. Заказы запрашиваются страницами допустимого размера (PAGE_LIMIT), пока не набрано limit
+    записей или не кончились заказы.
+    """
+    from main import extract_last_entries
+    from retailcrm_api import PAGE_LIMIT, iter_orders
+
+    known = set()
+    if os.path.exists(corpus_path):
+        known = {comment_key(item['comment']) for item in load_corpus(corpus_path)}
+    added = 0
+    with open(corpus_path, 'a', encoding='utf-8') as f:
+        for order in iter_orders(limit=PAGE_LIMIT):
+            entries = extract_last_entries(order.manager_comment or '')
+            if not entries or comment_key(entries) in known:
+                continue
+            known.add(comment_key(entries))
+            f.write(json_codec.dumps({'id': f"order-{order.id}", 'source': 'crm',
+                                      'comment': entries, 'expected': None}) + '\n')
+            added += 1
+            if added >= limit:
+                break
+    return added
+
+
+def _fmt(value: Optional[float], digits: int = 3) -> str:
+    return f"{value:.{digits}f}" if value is not None else '-'
+
+
+def print_report(report: Dict[str, Any], show: int):
+    print(f"Бэкенд {report['backend']}: {report['scored']} записей оценено, ошибок {report['errors']}, "
+          f"неразмеченных {report['unlabelled']}")
+    for group, title in (('tasks', 'задачи'), ('dates', 'даты')):
+        print(f"  {title:<8} precision {_fmt(report[group]['precision'])}  recall {_fmt(report[group]['recall'])}")
+    latency = report['latency_seconds']
+    print(f"  полностью верно {_fmt(report['exact_match'])}; задержка p50 {_fmt(latency['p50'])} с, "
+          f"p95 {_fmt(latency['p95'])} с; токенов на запись {_fmt(report['tokens_per_comment'], 1)}; "
+          f"записей в секунду {_fmt(report['comments_per_second'], 2)}")
+    for mismatch in report['mismatches'][:show]:
+        print(f"\n  ✗ {mismatch['id']}: {mismatch['comment']!r}")
+        print(f"    ожидалось: {[(t.get('marked_line'), t.get('date_time')) for t in mismatch['expected']]}")
+        print(f"    получено:  {[(t.get('marked_line'), t.get('date_time')) for t in mismatch['predicted']]}")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Оценка экстрактора задач на размеченном корпусе.")
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help=f"корпус JSONL (по умолчанию {DEFAULT_CORPUS})")
+    parser.add_argument('--backend', default='router', help="router | model:<имя> | rules | replay:<файл>")
+    parser.add_argument('--record', help="сохранить ответы бэкенда в JSONL для replay")
+    parser.add_argument('--output', help="сохранить отчёт в JSON (его можно использовать как --baseline)")
+    parser.add_argument('--baseline', help="отчёт, с которым сравнить precision/recall")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="допустимое падение precision/recall относительно baseline")
+    parser.add_argument('--show', type=int, default=10, help="сколько расхождений вывести")
+    parser.add_argument('--export', type=int, metavar='N',
+                        help="добавить в корпус N новых неразмеченных записей последних заказов из CRM и выйти")
+    args = parser.parse_args(argv)
+    if args.export is not None and args.export <= 0:
+        parser.error("--export: N должно быть положительным числом")
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.export:
+        added = export_comments(args.corpus, args.export)
+        print(f"В {args.corpus} добавлено {added} неразмеченных записей (expected = null).")
+        if added < args.export:
+            print(f"⚠️ Запрошено {args.export}: новых записей в CRM меньше или заказы получены не полностью "
+                  f"(см. журнал).")
+        return 0
+
+    report = evaluate(make_backend(args.backend), load_corpus(args.corpus), args.record)
+    print_report(report, args.show)
+    if args.record:
+        print(f"\nОтветы сохранены в {args.record}.")
+    if args.output:
+        json_codec.dump_file(args.output, report, indent=True)
+        print(f"Отчёт сохранён в {args.output}.")
+    if args.baseline:
+        problems = compare(report, json_codec.load_file(args.baseline), args.tolerance)
+        if problems:
+            print("\n❌ Качество хуже baseline:")
+            for problem in problems:
+                print(f"  - {problem}")
+            return 1
+        print("\n✅ Качество не хуже baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
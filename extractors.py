@@ -0,0 +1,134 @@
+# extractors.py
+
+"""
+Бэкенды экстрактора задач: одна запись комментария -> задачи, задержка и токены.
+Общие для рабочего процесса (теневой режим, shadow.py) и офлайн-оценки (extractor_eval.py).
+
+    router               — рабочий путь: выбор уровня и модели (route_comment)
+    model:<имя>          — все записи в одну модель, например model:gpt-4.1-mini
+    rules                — разбор строк «ДД.ММ - действие» без модели
+    replay:<файл>        — ответы, записанные ранее через extractor_eval.py --record (офлайн, без запросов)
+"""
+
+import re
+import time
+import hashlib
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import clock
+import json_codec
+import openai_processor
+from circuit_breaker import DependencyUnavailableError
+
+# Строка задачи для бэкенда rules: дата в начале строки, дефис, действие
+RULE_LINE_RE = re.compile(r'^\s*(\d{1,2})[./](\d{1,2})(?:[./]\d{2,4})?\s*[-–—]\s*(.+?)\s*$')
+# Маркеры, которые скрипт дописывает к обработанным строкам
+LINE_MARKERS_RE = re.compile(r'[📅📝📲]')
+
+
+@dataclass
+class Extraction:
+    """Результат одного вызова бэкенда: задачи (None — вызов не удался), задержка и токены."""
+    tasks: Optional[List[Dict[str, Any]]]
+    latency: float
+    tokens: int = 0
+    error: Optional[str] = None
+
+
+@dataclass
+class Backend:
+    """Экстрактор под именем из --backend; для replay задержка и токены берутся из записи."""
+    name: str
+    extract: Callable[[str], Extraction]
+    # Обращается ли бэкенд к OpenAI (расходует лимиты аккаунта)
+    llm: bool = False
+
+
+def comment_key(comment: str) -> str:
+    """Ключ записи в корпусе и в файле ответов."""
+    return hashlib.sha1(comment.encode('utf-8')).hexdigest()[:12]
+
+
+def extract_by_rules(comment: str, now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Строки «ДД.ММ - действие» как задачи на 10:00 указанного дня текущего года."""
+    now = now or clock.now()
+    tasks = []
+    for line in comment.split('\n'):
+        match = RULE_LINE_RE.match(LINE_MARKERS_RE.sub('', line))
+        if not match:
+            continue
+        day, month, action = int(match.group(1)), int(match.group(2)), match.group(3)
+        try:
+            task_date = now.replace(month=month, day=day, hour=10, minute=0, second=0, microsecond=0)
+        except ValueError:
+            continue
+        tasks.append({
+            'task': action[:1].upper() + action[1:],
+            'date_time': task_date.strftime('%Y-%m-%d %H:%M'),
+            'marked_line': line.strip(),
+        })
+    return tasks
+
+
+def _live(call: Callable[[str], List[Dict[str, Any]]]) -> Callable[[str], Extraction]:
+    def extract(comment: str) -> Extraction:
+        started = time.perf_counter()
+        with openai_processor.track_usage() as usage:
+            try:
+                tasks = call(comment)
+                error = None
+            except DependencyUnavailableError as e:
+                tasks, error = None, str(e)
+        return Extraction(tasks, time.perf_counter() - started,
+                          usage['prompt_tokens'] + usage['completion_tokens'], error)
+    return extract
+
+
+def load_recordings(path: str) -> Dict[str, Dict[str, Any]]:
+    recordings = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json_codec.loads(line)
+                recordings[record['key']] = record
+    return recordings
+
+
+def make_backend(spec: str) -> Backend:
+    """Бэкенд по строке вида router | model:<имя> | rules | replay:<файл>."""
+    kind, _, arg = spec.partition(':')
+    if kind == 'router':
+        return Backend(spec, _live(openai_processor.analyze_comment_with_openai), llm=True)
+    if kind == 'model' and arg:
+        return Backend(spec, _live(lambda comment: openai_processor.analyze_comment_with_openai(comment, model=arg)),
+                       llm=True)
+    if kind == 'rules':
+        return Backend(spec, _live(extract_by_rules))
+    if kind == 'replay' and arg:
+        recordings = load_recordings(arg)
+
+        def replay(comment: str) -> Extraction:
+            record = recordings.get(comment_key(comment))
+            if record is None:
+                return Extraction(None, 0.0, error='нет записанного ответа')
+            return Extraction(record.get('tasks'), record.get('latency', 0.0), record.get('tokens', 0),
+                              record.get('error'))
+        return Backend(spec, replay)
+    raise ValueError(f"Неизвестный бэкенд экстрактора: {spec}")
+
+
+def _line_key(line: str) -> str:
+    return ' '.join(LINE_MARKERS_RE.sub('', line).split()).casefold()
+
+
+def task_keys(tasks: List[Dict[str, Any]]) -> Tuple[Counter, Counter]:
+    """(строки задач, пары строка + день-месяц) — мультимножества для сопоставления."""
+    lines, dates = Counter(), Counter()
+    for task in tasks:
+        key = _line_key(str(task.get('marked_line') or task.get('task') or ''))
+        lines[key] += 1
+        dates[(key, str(task.get('date_time') or '')[5:10])] += 1
+    return lines, dates
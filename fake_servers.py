@@ -0,0 +1,529 @@
+# fake_servers.py
+
+"""
+Локальные заменители RetailCRM и OpenAI для бенчмарков и отладки без боевого аккаунта.
+
+FakeRetailCRM реализует endpoint'ы, которыми пользуется проект:
+GET orders, GET orders/history, POST tasks/create, POST orders/{id}/edit.
+FakeOpenAI реализует POST /v1/chat/completions и извлекает задачи из строк
+вида "DD.MM - действие" простым разбором вместо модели.
+Оба сервера поддерживают искусственную задержку, лимит запросов (ответ 429)
+и случайные ошибки (ответ 500); FakeOpenAI, кроме того, — лимиты RPM/TPM аккаунта
+с заголовками x-ratelimit-* в каждом ответе.
+FakeServer отдаёт их по HTTP на локальном порту; InProcessAdapter (requests) и in_process_transport
+(httpx, клиент OpenAI) вызывают обработчики в том же процессе, без сокетов (симулятор).
+"""
+
+import io
+import re
+import time
+import random
+import threading
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from typing import Dict, Any, List, Optional, Tuple
+
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+
+import clock
+import json_codec
+
+API_KEY = 'fake-api-key'
+
+Query = Dict[str, List[str]]
+Reply = Tuple[int, Dict[str, Any], Dict[str, str]]
+
+TASK_LINE_RE = re.compile(r'^\s*(\d{1,2})[./](\d{1,2})\s*-\s*(.+?)\s*$')
+
+
+class FaultInjector:
+    """Общая для фейковых серверов логика задержек, лимита запросов и случайных ошибок."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit: Optional[float] = None,
+                 error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = rate_limit or 0.0
+        self._refilled_at = time.monotonic()
+
+    def _take_token(self) -> bool:
+        if not self.rate_limit:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled_at) * self.rate_limit)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def before_request(self) -> Optional[Reply]:
+        """Имитирует задержку; возвращает ответ с ошибкой, если запрос нужно отклонить."""
+        with self._lock:
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+            fail = self.error_rate and self._random.random() < self.error_rate
+        if not self._take_token():
+            return 429, {'success': False, 'errorMsg': 'Rate limit exceeded'}, {'Retry-After': '1'}
+        if delay:
+            time.sleep(delay)
+        if fail:
+            return 500, {'success': False, 'errorMsg': 'Injected server error'}, {}
+        return None
+
+
+class FakeRetailCRM:
+    """In-memory хранилище заказов и задач с обработчиками API v5."""
+
+    def __init__(self, orders: Optional[List[Dict[str, Any]]] = None, faults: Optional[FaultInjector] = None):
+        self.orders: Dict[int, Dict[str, Any]] = {order['id']: order for order in (orders or [])}
+        self.tasks: List[Dict[str, Any]] = []
+        self.history: List[Dict[str, Any]] = []
+        self.faults = faults or FaultInjector()
+        self.request_counts: Dict[str, int] = {}
+        # Сколько заказов отдано в ответах GET orders (объём выборок)
+        self.orders_served = 0
+        self._lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._lock:
+            self.request_counts[name] = self.request_counts.get(name, 0) + 1
+
+    def handle(self, method: str, path: str, query: Query, form: Query) -> Reply:
+        """Обрабатывает запрос к /api/v5/...; возвращает (HTTP-статус, JSON-ответ, заголовки)."""
+        endpoint = path.split('/api/v5/', 1)[-1].strip('/')
+        self._count(f"{method} {re.sub(r'/[0-9]+/', '/{id}/', endpoint)}")
+
+        if (query.get('apiKey') or [''])[0] != API_KEY:
+            return 403, {'success': False, 'errorMsg': 'Wrong "apiKey" value.'}, {}
+
+        fault = self.faults.before_request()
+        if fault:
+            return fault
+
+        if method == 'GET' and endpoint == 'orders':
+            return self._list_orders(query)
+        if method == 'GET' and endpoint == 'orders/history':
+            return self._paginate(query, self.history, 'history')
+        if method == 'POST' and endpoint == 'tasks/create':
+            return self._create_task(form)
+        match = re.fullmatch(r'orders/(\d+)/edit', endpoint)
+        if method == 'POST' and match:
+            return self._edit_order(int(match.group(1)), form)
+        return 404, {'success': False, 'errorMsg': 'API method not found'}, {}
+
+    @staticmethod
+    def _paginate(query: Query, items: List[Dict[str, Any]], key: str) -> Reply:
+        limit = int((query.get('limit') or ['20'])[0])
+        if limit not in (20, 50, 100):
+            return 400, {'success': False, 'errorMsg': 'Parameter limit must be 20, 50 or 100'}, {}
+        page = max(1, int((query.get('page') or ['1'])[0]))
+        total = len(items)
+        return 200, {
+            'success': True,
+            'pagination': {
+                'limit': limit,
+                'totalCount': total,
+                'currentPage': page,
+                'totalPageCount': max(1, (total + limit - 1) // limit),
+            },
+            key: items[(page - 1) * limit:page * limit],
+        }, {}
+
+    def _list_orders(self, query: Query) -> Reply:
+        def values(name: str) -> List[str]:
+            return query.get(f'filter[{name}][]') or []
+
+        def value(name: str) -> Optional[str]:
+            return (query.get(f'filter[{name}]') or [None])[0]
+
+        ids = {int(i) for i in values('ids')}
+        statuses = set(values('extendedStatus'))
+        methods = set(values('orderMethods'))
+        delivery_types = set(values('deliveryTypes'))
+        delivery_from, delivery_to = value('deliveryDateFrom'), value('deliveryDateTo')
+        created_from, created_to = value('createdAtFrom'), value('createdAtTo')
+        status_from, status_to = value('statusUpdatedAtFrom'), value('statusUpdatedAtTo')
+
+        with self._lock:
+            candidates = [self.orders[i] for i in ids if i in self.orders] if ids else list(self.orders.values())
+
+        result = []
+        for order in candidates:
+            delivery = order.get('delivery') or {}
+            delivery_date = delivery.get('date') or ''
+            if statuses and order.get('status') not in statuses:
+                continue
+            if methods and order.get('orderMethod') not in methods:
+                continue
+            if delivery_types and delivery.get('code') not in delivery_types:
+                continue
+            if delivery_from and not (delivery_date and delivery_date >= delivery_from[:10]):
+                continue
+            if delivery_to and not (delivery_date and delivery_date <= delivery_to[:10]):
+                continue
+            if created_from and order.get('createdAt', '') < created_from:
+                continue
+            if created_to and order.get('createdAt', '') > created_to:
+                continue
+            if status_from and order.get('statusUpdatedAt', '') < status_from:
+                continue
+            if status_to and order.get('statusUpdatedAt', '') > status_to:
+                continue
+            result.append(order)
+
+        # Как и RetailCRM, отдаём сначала самые новые заказы
+        result.sort(key=lambda o: o['id'], reverse=True)
+        reply = self._paginate(query, result, 'orders')
+        with self._lock:
+            self.orders_served += len(reply[1].get('orders') or [])
+        return reply
+
+    def _create_task(self, form: Query) -> Reply:
+        try:
+            task = json_codec.loads((form.get('task') or [''])[0])
+        except json_codec.JSONDecodeError:
+            return 400, {'success': False, 'errorMsg': 'Parameter task is invalid'}, {}
+        if not task.get('text') or not task.get('performerId'):
+            return 400, {'success': False, 'errorMsg': 'Task is not valid', 'errors': {'text': 'required'}}, {}
+        with self._lock:
+            task_id = len(self.tasks) + 1
+            self.tasks.append({'id': task_id, **task})
+        return 201, {'success': True, 'id': task_id}, {}
+
+    def _edit_order(self, order_id: int, form: Query) -> Reply:
+        try:
+            changes = json_codec.loads((form.get('order') or [''])[0])
+        except json_codec.JSONDecodeError:
+            return 400, {'success': False, 'errorMsg': 'Parameter order is invalid'}, {}
+        with self._lock:
+            order = self.orders.get(order_id)
+            if order is None:
+                return 404, {'success': False, 'errorMsg': 'Not found'}, {}
+            for field, new_value in changes.items():
+                if field == 'id':
+                    continue
+                self.history.append({
+                    'id': len(self.history) + 1,
+                    'field': field,
+                    'oldValue': order.get(field),
+                    'newValue': new_value,
+                    'order': {'id': order_id},
+                })
+                if field == 'status' and new_value != order.get('status'):
+                    order['statusUpdatedAt'] = clock.now().strftime('%Y-%m-%d %H:%M:%S')
+                order[field] = new_value
+        return 200, {'success': True, 'id': order_id, 'order': order}, {}
+
+
+def extract_tasks_locally(comment: str, now: datetime) -> List[Dict[str, str]]:
+    """Находит строки "DD.MM - действие" и превращает их в задачи в формате ответа модели."""
+    tasks = []
+    for line in comment.split('\n'):
+        match = TASK_LINE_RE.match(line)
+        if not match:
+            continue
+        day, month, action = int(match.group(1)), int(match.group(2)), match.group(3)
+        try:
+            task_date = now.replace(month=month, day=day, hour=10, minute=0, second=0, microsecond=0)
+        except ValueError:
+            continue
+        tasks.append({
+            'task': action[:1].upper() + action[1:],
+            'date_time': task_date.strftime('%Y-%m-%d %H:%M'),
+            'marked_line': line.strip(),
+        })
+    return tasks
+
+
+class FakeOpenAI:
+    """Заменитель Chat Completions API: отвечает задачами, найденными локальным разбором."""
+
+    def __init__(self, faults: Optional[FaultInjector] = None, rpm: Optional[int] = None,
+                 tpm: Optional[int] = None):
+        self.faults = faults or FaultInjector()
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_count = 0
+        self.tokens_total = 0
+        self.throttled_count = 0
+        self._lock = threading.Lock()
+        # (время, токены) принятых запросов за последние 60 секунд — окно лимитов RPM/TPM
+        self._window: List[Tuple[float, int]] = []
+
+    def _rate_limit_headers(self, now: float) -> Dict[str, str]:
+        # Вызывается под self._lock; формат — как у x-ratelimit-* в ответах OpenAI
+        headers = {}
+        oldest = self._window[0][0] if self._window else now
+        reset = f"{max(0.0, oldest + 60 - now):.3f}s"
+        if self.rpm:
+            headers['x-ratelimit-limit-requests'] = str(self.rpm)
+            headers['x-ratelimit-remaining-requests'] = str(max(0, self.rpm - len(self._window)))
+            headers['x-ratelimit-reset-requests'] = reset
+        if self.tpm:
+            used = sum(tokens for _, tokens in self._window)
+            headers['x-ratelimit-limit-tokens'] = str(self.tpm)
+            headers['x-ratelimit-remaining-tokens'] = str(max(0, self.tpm - used))
+            headers['x-ratelimit-reset-tokens'] = reset
+        return headers
+
+    def _admit(self, tokens: int) -> Tuple[Optional[str], Dict[str, str]]:
+        """Учитывает запрос в окне лимитов; (исчерпанный лимит или None, заголовки x-ratelimit-*)."""
+        with self._lock:
+            now = time.monotonic()
+            self._window = [(at, used) for at, used in self._window if now - at < 60]
+            over_rpm = self.rpm and len(self._window) + 1 > self.rpm
+            over_tpm = self.tpm and sum(used for _, used in self._window) + tokens > self.tpm
+            if over_rpm or over_tpm:
+                self.throttled_count += 1
+                headers = self._rate_limit_headers(now)
+                oldest = self._window[0][0] if self._window else now
+                headers['retry-after'] = str(max(1, int(oldest + 60 - now) + 1))
+                return ('requests' if over_rpm else 'tokens'), headers
+            self._window.append((now, tokens))
+            return None, self._rate_limit_headers(now)
+
+    def handle(self, method: str, path: str, body: Dict[str, Any]) -> Reply:
+        with self._lock:
+            self.request_count += 1
+        if method != 'POST' or not path.rstrip('/').endswith('/chat/completions'):
+            return 404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}}, {}
+
+        messages = body.get('messages') or []
+        comment = next((m.get('content', '') for m in reversed(messages) if m.get('role') == 'user'), '')
+        prompt_tokens = sum(len(m.get('content', '')) for m in messages) // 4
+        exhausted, limit_headers = self._admit(prompt_tokens + (body.get('max_tokens') or 0))
+        if exhausted:
+            return 429, {'error': {'message': f'Rate limit reached for {exhausted}', 'type': exhausted,
+                                   'code': 'rate_limit_exceeded'}}, limit_headers
+
+        fault = self.faults.before_request()
+        if fault:
+            status, _, headers = fault
+            error_type = 'rate_limit_exceeded' if status == 429 else 'server_error'
+            return status, {'error': {'message': 'Injected error', 'type': error_type, 'code': error_type}}, headers
+
+        content = json_codec.dumps({'response': extract_tasks_locally(comment, clock.now())})
+        completion_tokens = len(content) // 4
+        with self._lock:
+            self.tokens_total += prompt_tokens + completion_tokens
+
+        return 200, {
+            'id': f'chatcmpl-fake-{self.request_count}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'fake-model'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }, limit_headers
+
+
+def _make_handler(crm: Optional[FakeRetailCRM], llm: Optional[FakeOpenAI]):
+
+    class FakeHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Заголовки и тело уходят отдельными записями: без этого Nagle добавляет ~40 мс к каждому ответу
+        disable_nagle_algorithm = True
+
+        def _read_body(self) -> bytes:
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length) if length else b''
+
+        def _reply(self, reply: Reply):
+            status, payload, headers = reply
+            body = json_codec.dumps_bytes(payload)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self, method: str):
+            parsed = urlparse(self.path)
+            body = self._read_body()
+            if crm is not None and parsed.path.startswith('/api/v5/'):
+                form = parse_qs(body.decode('utf-8')) if body else {}
+                self._reply(crm.handle(method, parsed.path, parse_qs(parsed.query), form))
+            elif llm is not None and parsed.path.startswith('/v1/'):
+                try:
+                    payload = json_codec.loads(body) if body else {}
+                except json_codec.JSONDecodeError:
+                    payload = {}
+                self._reply(llm.handle(method, parsed.path, payload))
+            else:
+                self._reply((404, {'success': False, 'errorMsg': 'Not found'}, {}))
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeHandler
+
+
+class InProcessAdapter(HTTPAdapter):
+    """
+    Транспорт requests без сети: запросы обрабатывает FakeRetailCRM в этом же процессе.
+    Подключение: client.session.mount(base_url, InProcessAdapter(crm)).
+    """
+
+    def __init__(self, crm: FakeRetailCRM):
+        super().__init__()
+        self.crm = crm
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        parsed = urlparse(request.url)
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        form = parse_qs(body.decode('utf-8')) if body else {}
+        status, payload, headers = self.crm.handle(request.method, parsed.path, parse_qs(parsed.query), form)
+        # Тело отдаётся как из сокета: его можно читать и целиком (content), и потоково (raw)
+        raw = HTTPResponse(body=io.BytesIO(json_codec.dumps_bytes(payload)),
+                           headers={'Content-Type': 'application/json; charset=utf-8', **headers},
+                           status=status, reason=HTTPStatus(status).phrase, preload_content=False)
+        return self.build_response(request, raw)
+
+
+def in_process_transport(llm: FakeOpenAI):
+    """Транспорт httpx для клиента OpenAI (openai.http_client): запросы обрабатывает FakeOpenAI в этом же процессе."""
+    import httpx
+
+    def handle(request: 'httpx.Request') -> 'httpx.Response':
+        try:
+            payload = json_codec.loads(request.content) if request.content else {}
+        except json_codec.JSONDecodeError:
+            payload = {}
+        status, body, headers = llm.handle(request.method, request.url.path, payload)
+        return httpx.Response(status, content=json_codec.dumps_bytes(body),
+                              headers={'Content-Type': 'application/json', **headers})
+
+    return httpx.MockTransport(handle)
+
+
+class FakeServer:
+    """
+    Запускает фейковые RetailCRM и/или OpenAI на локальном порту в фоновом потоке.
+    Использование: with FakeServer(crm=FakeRetailCRM(orders)) as server: ... server.url ...
+    """
+
+    def __init__(self, crm: Optional[FakeRetailCRM] = None, llm: Optional[FakeOpenAI] = None,
+                 host: str = '127.0.0.1', port: int = 0):
+        self.crm = crm
+        self.llm = llm
+        self._server = ThreadingHTTPServer((host, port), _make_handler(crm, llm))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'FakeServer':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self) -> 'FakeServer':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+# --- ГЕНЕРАТОР СИНТЕТИЧЕСКИХ ЗАКАЗОВ ---
+
+COMMENT_NOISE = [
+    "нет связи",
+    "клиент думает",
+    "направлено кп",
+    "согласовывает с мужем",
+    "спам",
+    "дубль",
+    "нет цикаса и оваты сансет",
+    "За 10 мин до прибытия на место позвонить",
+]
+COMMENT_ACTIONS = ["перезвонить", "кас", "отправить КП", "отправить ссылку", "предложить варианты растений"]
+OTHER_STATUSES = ["send-to-delivery", "dostavlen", "complete", "cancel-other", "zakazat-nalichie",
+                  "ozhidaet-nalichie", "soglasovanie-dostavki", "send-to-assembling", "assembling"]
+ORDER_METHODS = ["phone", "shopping-cart", "vkhodiashchii-zvonok", "servisnoe-obsluzhivanie", "komus"]
+DELIVERY_CODES = ["self-delivery", "storonniaia-dostavka", "courier",
+                  "ekspress-dostavka-rasschityvaetsia-individualno"]
+
+
+def generate_comment(rng: random.Random, now: datetime) -> str:
+    """Синтетический комментарий менеджера: пустой, с маркерами или с шумом и строками задач."""
+    kind = rng.random()
+    if kind < 0.15:
+        return ''
+    if kind < 0.25:
+        return f"[{now.strftime('%Y-%m-%d %H:%M')}] " + rng.choice(['📝', '📲'])
+
+    lines = [rng.choice(COMMENT_NOISE) for _ in range(rng.randint(0, 4))]
+    for _ in range(rng.randint(0, 2)):
+        task_date = now + timedelta(days=rng.randint(-3, 10))
+        separator = rng.choice(['.', '/'])
+        line = f"{task_date.day:02d}{separator}{task_date.month:02d} - {rng.choice(COMMENT_ACTIONS)}"
+        if rng.random() < 0.2:
+            line += ' 📅'
+        lines.append(line)
+    rng.shuffle(lines)
+    return '\n'.join(lines)
+
+
+def generate_orders(count: int, now: datetime, seed: int = 42,
+                    statuses: Optional[List[str]] = None, first_id: int = 10000) -> List[Dict[str, Any]]:
+    """Генерирует count синтетических заказов с распределением статусов, методов и комментариев."""
+    if statuses is None:
+        # Импорт здесь, чтобы модуль можно было использовать без конфигурации main.py
+        from main import ALLOWED_STATUSES
+        statuses = ALLOWED_STATUSES + OTHER_STATUSES
+
+    rng = random.Random(seed)
+    orders = []
+    for i in range(count):
+        order_id = first_id + i
+        created_at = now - timedelta(minutes=rng.randint(0, 60 * 24 * 60))
+        created_at_str = created_at.strftime('%Y-%m-%d %H:%M:%S')
+        delivery_date = (now + timedelta(days=rng.randint(-2, 5))).strftime('%Y-%m-%d')
+        orders.append({
+            'id': order_id,
+            'number': f"{order_id}A",
+            'status': rng.choice(statuses),
+            'orderMethod': rng.choice(ORDER_METHODS),
+            'managerId': rng.choice([None] + list(range(1, 21))),
+            'managerComment': generate_comment(rng, now),
+            'createdAt': created_at_str,
+            'statusUpdatedAt': created_at_str,
+            'delivery': {'code': rng.choice(DELIVERY_CODES), 'date': delivery_date},
+            'customer': {'id': rng.randint(1, 10 ** 6), 'firstName': 'Тест', 'phones': [{'number': '+70000000000'}]},
+            'items': [{'id': j, 'quantity': rng.randint(1, 5), 'initialPrice': rng.randint(100, 50000)}
+                      for j in range(rng.randint(1, 6))],
+        })
+    return orders
@@ -0,0 +1,103 @@
+# json_benchmark.py
+
+"""
+Микробенчмарк JSON: стандартный json (как было до json_codec.py) против json_codec.
+
+Данные — реалистичные: страница заказов из генератора fake_servers.py, payload задачи,
+трекер статусов и ответ модели в обёртке ```json ... ```. Для каждой операции выводится
+время одного вызова и ускорение. Без orjson json_codec работает на стандартном json,
+и ускорение будет около 1x (кроме разбора ответа модели и компактной записи трекера).
+
+    python json_benchmark.py
+    python json_benchmark.py --page-size 100 --repeat 200
+"""
+
+import re
+import sys
+import json
+import timeit
+import argparse
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Tuple
+
+import json_codec
+from fake_servers import generate_orders
+
+
+def build_samples(page_size: int) -> Dict[str, Any]:
+    now = datetime(2025, 10, 12, 12, 0)
+    orders = generate_orders(page_size, now)
+    page = json.dumps({
+        'success': True,
+        'pagination': {'limit': page_size, 'totalCount': page_size, 'currentPage': 1, 'totalPageCount': 1},
+        'orders': orders,
+    }, ensure_ascii=False).encode('utf-8')
+
+    task = {
+        'text': 'НДЗ: звонок клиенту, день 2',
+        'commentary': 'Созвониться с клиентом по заказу 12345A и уточнить дату доставки',
+        'datetime': '2025-10-13 11:00',
+        'performerId': 7,
+        'order': {'id': 12345},
+    }
+    trackers = {
+        str(order['id']): {'status': order['status'], 'date_added': (now - timedelta(days=i % 9)).strftime('%Y-%m-%d')}
+        for i, order in enumerate(generate_orders(page_size * 20, now, first_id=50000))
+    }
+    trackers_file = {'stdlib': json.dumps(trackers, indent=4), 'codec': json_codec.dumps_bytes(trackers)}
+    llm = '```json\n' + json.dumps({'tasks': [
+        {'task': 'Позвонить клиенту и уточнить доставку', 'date': '13.10'},
+        {'task': 'Проверить оплату заказа', 'date': '14.10'},
+    ]}, ensure_ascii=False, indent=2) + '\n```'
+    return {'page': page, 'task': task, 'trackers': trackers, 'trackers_file': trackers_file, 'llm': llm}
+
+
+def _stdlib_llm_parse(text: str) -> Any:
+    return json.loads(re.sub(r'```json\n|```', '', text).strip())
+
+
+def _normalize(value: Any) -> Any:
+    """Сериализованный результат сравнивается по содержимому: форматирование у вариантов разное."""
+    return json.loads(value) if isinstance(value, (str, bytes)) else value
+
+
+def cases(samples: Dict[str, Any]) -> List[Tuple[str, Callable[[], Any], Callable[[], Any]]]:
+    """(операция, вариант stdlib, вариант json_codec) — те же вызовы, что были в коде до json_codec."""
+    return [
+        ("разбор страницы заказов", lambda: json.loads(samples['page']), lambda: json_codec.loads(samples['page'])),
+        ("payload задачи", lambda: json.dumps(samples['task']), lambda: json_codec.dumps(samples['task'])),
+        ("запись трекера", lambda: json.dumps(samples['trackers'], indent=4),
+         lambda: json_codec.dumps_bytes(samples['trackers'])),
+        ("чтение трекера", lambda: json.loads(samples['trackers_file']['stdlib']),
+         lambda: json_codec.loads(samples['trackers_file']['codec'])),
+        ("разбор ответа модели", lambda: _stdlib_llm_parse(samples['llm']),
+         lambda: json_codec.parse_llm_json(samples['llm'])),
+    ]
+
+
+def run(page_size: int, repeat: int) -> List[Dict[str, Any]]:
+    samples = build_samples(page_size)
+    results = []
+    for name, baseline, candidate in cases(samples):
+        assert _normalize(baseline()) == _normalize(candidate()), f"Результаты расходятся: {name}"
+        baseline_seconds = min(timeit.repeat(baseline, number=repeat, repeat=3)) / repeat
+        candidate_seconds = min(timeit.repeat(candidate, number=repeat, repeat=3)) / repeat
+        results.append({'operation': name, 'stdlib_us': baseline_seconds * 1e6, 'codec_us': candidate_seconds * 1e6,
+                        'speedup': baseline_seconds / candidate_seconds if candidate_seconds else None})
+    return results
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Микробенчмарк json против json_codec.")
+    parser.add_argument('--page-size', type=int, default=100, help="заказов на странице (лимит API — 100)")
+    parser.add_argument('--repeat', type=int, default=100, help="вызовов на замер")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    backend = 'orjson' if json_codec.orjson else 'json (orjson не установлен)'
+    print(f"json_codec: {backend}; страница из {args.page_size} заказов, {args.repeat} вызовов на замер\n")
+    print(f"{'операция':<26} {'json, мкс':>12} {'codec, мкс':>12} {'ускорение':>10}")
+    for r in run(args.page_size, args.repeat):
+        print(f"{r['operation']:<26} {r['stdlib_us']:>12.1f} {r['codec_us']:>12.1f} {r['speedup'] or 0:>9.1f}x")
@@ -0,0 +1,74 @@
+# json_codec.py
+
+import os
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него используется стандартный json
+    orjson = None
+
+# orjson.JSONDecodeError — подкласс json.JSONDecodeError, поэтому одно исключение покрывает обе реализации
+JSONDecodeError = json.JSONDecodeError
+
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+
+def dumps_bytes(obj: Any, indent: bool = False, sort_keys: bool = False) -> bytes:
+    """Сериализует obj в компактный UTF-8 JSON (indent=True — с отступом в 2 пробела)."""
+    if orjson:
+        options = _ORJSON_OPTIONS
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        if sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, option=options)
+    return dumps(obj, indent=indent, sort_keys=sort_keys).encode('utf-8')
+
+
+def dumps(obj: Any, indent: bool = False, sort_keys: bool = False) -> str:
+    """Сериализует obj в JSON-строку; кириллица не экранируется."""
+    if orjson:
+        return dumps_bytes(obj, indent=indent, sort_keys=sort_keys).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, sort_keys=sort_keys,
+                      indent=2 if indent else None, separators=None if indent else (',', ':'))
+
+
+def loads(data: Union[str, bytes, bytearray]) -> Any:
+    """Разбирает JSON из строки или байтов."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def load_file(path: str) -> Any:
+    """Читает JSON-файл целиком одним вызовом разбора."""
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+def dump_file(path: str, obj: Any, indent: bool = False, atomic: bool = False):
+    """
+    Пишет obj в JSON-файл (по умолчанию компактно — файлы состояния читает только программа).
+    atomic=True пишет во временный файл и переименовывает его: читатель не увидит файл наполовину.
+    """
+    target = f"{path}.tmp" if atomic else path
+    with open(target, 'wb') as f:
+        f.write(dumps_bytes(obj, indent=indent))
+    if atomic:
+        os.replace(target, path)
+
+
+def parse_llm_json(text: str) -> Any:
+    """
+    Разбирает JSON из ответа модели за один вызов разбора: берётся фрагмент от первой открывающей
+    до последней закрывающей скобки. Чистый JSON (response_format json_object) остаётся как есть,
+    а обёртка ```json ... ``` и текст вокруг отбрасываются без регулярных выражений.
+    Ошибка разбора — JSONDecodeError.
+    """
+    starts = [i for i in (text.find('{'), text.find('[')) if i != -1]
+    end = max(text.rfind('}'), text.rfind(']'))
+    if not starts or end < min(starts):
+        raise JSONDecodeError("В ответе модели не найден JSON", text, 0)
+    return loads(text[min(starts):end + 1])
@@ -0,0 +1,191 @@
+# llm_scheduler.py
+
+import re
+import time
+import threading
+from typing import Any, Dict, List, Mapping, Optional
+
+import metrics
+from settings import SETTINGS
+
+try:
+    import tiktoken
+except ImportError:  # точный подсчёт токенов необязателен: без tiktoken — оценка по длине текста
+    tiktoken = None
+
+# Лимиты аккаунта OpenAI по умолчанию (уточняются по заголовкам x-ratelimit-* первого же ответа)
+OPENAI_RPM_LIMIT = SETTINGS.openai_rpm_limit
+OPENAI_TPM_LIMIT = SETTINGS.openai_tpm_limit
+# Сколько секунд запрос может ждать бюджета; дольше — анализ откладывается до следующего запуска
+OPENAI_MAX_WAIT_SECONDS = SETTINGS.openai_max_wait_seconds
+
+# Оценка без tiktoken: символов на токен (для смеси кириллицы и разметки промпта — с запасом)
+CHARS_PER_TOKEN = 3.0
+# Служебные токены на каждое сообщение чата
+MESSAGE_OVERHEAD_TOKENS = 4
+# Начальная оценка длины ответа; дальше — скользящее среднее по фактическому usage
+INITIAL_COMPLETION_ESTIMATE = 150
+
+_RESET_PART_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_RESET_UNITS = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+_encoding = None
+
+
+def _count_text_tokens(text: str) -> int:
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding('o200k_base')
+        return len(_encoding.encode(text))
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def estimate_tokens(messages: List[Dict[str, Any]], completion_tokens: int) -> int:
+    """Оценка токенов запроса до отправки: промпт плюс ожидаемая длина ответа (так их считает TPM-лимит)."""
+    prompt = sum(_count_text_tokens(str(m.get('content') or '')) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+    return prompt + completion_tokens
+
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """Длительность из заголовков OpenAI ('1s', '6m0s', '120ms', '0.5') в секундах."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _RESET_PART_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _RESET_UNITS[unit] for number, unit in parts)
+
+
+class _MinuteBudget:
+    """Бюджет «limit в минуту» как token bucket; уровень может уйти в минус, если запрос оказался дороже оценки."""
+
+    def __init__(self, limit: float):
+        self.limit = float(limit)
+        self.level = float(limit)
+        self._updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.limit, self.level + (now - self._updated) * self.limit / 60.0)
+        self._updated = now
+
+    def wait_for(self, amount: float) -> float:
+        """Сколько секунд ждать, пока в бюджете появится amount (не больше размера бюджета)."""
+        missing = min(amount, self.limit) - self.level
+        return max(0.0, missing * 60.0 / self.limit) if self.limit > 0 else 0.0
+
+
+class LLMRateScheduler:
+    """
+    Очередь запросов к OpenAI в пределах лимитов аккаунта: запросов в минуту (RPM) и токенов в минуту (TPM).
+
+    Перед отправкой запрос резервирует 1 запрос и оценку своих токенов и при нехватке бюджета ждёт,
+    а не получает 429. Заголовки x-ratelimit-* каждого ответа подстраивают лимиты и остаток бюджета
+    под фактические (их же учитывают другие процессы на том же ключе), а 429 с retry-after
+    приостанавливает отправку для всех потоков. Если бюджета не дождаться за max_wait_seconds,
+    reserve() возвращает False — вызывающий откладывает работу, а не теряет её.
+
+    share < 1 — очередь получает только эту долю лимитов аккаунта (и по заголовкам ответов тоже):
+    так теневой кандидат не может израсходовать бюджет рабочего пути.
+    """
+
+    def __init__(self, rpm: float = OPENAI_RPM_LIMIT, tpm: float = OPENAI_TPM_LIMIT,
+                 max_wait_seconds: float = OPENAI_MAX_WAIT_SECONDS, share: float = 1.0):
+        self.share = share
+        self.requests = _MinuteBudget(rpm * share)
+        self.tokens = _MinuteBudget(tpm * share)
+        self.max_wait_seconds = max_wait_seconds
+        self._paused_until = 0.0
+        self._completion_estimate = float(INITIAL_COMPLETION_ESTIMATE)
+        self._lock = threading.Lock()
+
+    def completion_estimate(self) -> int:
+        with self._lock:
+            return int(self._completion_estimate)
+
+    def throttled(self) -> bool:
+        """Отправка на паузе после 429 или бюджет запросов/токенов исчерпан: следующий запрос будет ждать."""
+        with self._lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            return self._paused_until > now or self.requests.level < 1 or self.tokens.level <= 0
+
+    def reserve(self, tokens: int) -> bool:
+        """Ждёт бюджета на запрос из tokens токенов и резервирует его. False — ждать дольше max_wait_seconds."""
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+                wait = max(self._paused_until - now, self.requests.wait_for(1), self.tokens.wait_for(tokens))
+                if wait <= 0:
+                    self.requests.level -= 1
+                    self.tokens.level -= tokens
+                    break
+            if now - started + wait > self.max_wait_seconds:
+                metrics.inc('openai_throttled', reason='budget')
+                return False
+            time.sleep(min(wait, 1.0))
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            metrics.observe('openai_rate_wait_seconds', waited)
+        return True
+
+    def settle(self, reserved_tokens: int, prompt_tokens: int, completion_tokens: int):
+        """Сверяет резерв с фактическим usage ответа и уточняет оценку длины ответа."""
+        actual = prompt_tokens + completion_tokens
+        with self._lock:
+            self.tokens.level += reserved_tokens - actual
+            self._completion_estimate = 0.8 * self._completion_estimate + 0.2 * completion_tokens
+        metrics.inc('openai_tokens_estimated', reserved_tokens)
+
+    def sync(self, headers: Mapping[str, str]):
+        """Подстраивает лимиты и остаток бюджета по заголовкам x-ratelimit-* ответа OpenAI."""
+        values = {}
+        for kind in ('requests', 'tokens'):
+            try:
+                limit = headers.get(f'x-ratelimit-limit-{kind}')
+                remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+                values[kind] = (float(limit) if limit else None, float(remaining) if remaining else None,
+                                parse_reset(headers.get(f'x-ratelimit-reset-{kind}')))
+            except ValueError:
+                continue
+        if not values:
+            return
+        with self._lock:
+            now = time.monotonic()
+            for kind, (limit, remaining, reset) in values.items():
+                budget = self.requests if kind == 'requests' else self.tokens
+                budget.refill(now)
+                if limit:
+                    budget.limit = limit * self.share
+                if remaining is not None:
+                    remaining *= self.share
+                    # Сервер восстанавливает бюджет полностью через reset секунд: уровень не ниже того,
+                    # с которого равномерное пополнение успевает к этому моменту
+                    if reset is not None:
+                        remaining = max(remaining, budget.limit - reset * budget.limit / 60.0)
+                    budget.level = min(budget.level, remaining)
+        for kind, (limit, remaining, reset) in values.items():
+            if remaining is not None:
+                metrics.set_gauge(f'openai_ratelimit_remaining_{kind}', remaining)
+
+    def pause(self, seconds: float):
+        """Приостанавливает отправку для всех потоков (после 429)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def retry_delay(self, headers: Mapping[str, str]) -> float:
+        """Сколько ждать после 429: retry-after или время сброса исчерпанного лимита."""
+        for name in ('retry-after-ms', 'retry-after'):
+            delay = parse_reset(headers.get(name))
+            if delay is not None:
+                return delay / 1000 if name == 'retry-after-ms' else delay
+        resets = [parse_reset(headers.get(f'x-ratelimit-reset-{kind}')) for kind in ('requests', 'tokens')]
+        return max([r for r in resets if r is not None] or [1.0])
@@ -0,0 +1,167 @@
+# locking.py
+
+import os
+import time
+import fcntl
+import socket
+import sqlite3
+import importlib
+import threading
+import logging
+from typing import Optional
+
+import json_codec
+from settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# Бэкенд блокировок: 'file', 'sqlite' или путь к своему классу вида 'module:ClassName'
+LOCK_BACKEND = SETTINGS.lock_backend
+LOCK_DIR = SETTINGS.lock_dir
+LOCK_DB_FILE = SETTINGS.lock_db_file
+# Срок аренды блокировки; пока запуск жив, аренда продлевается каждые LOCK_TTL_SECONDS / 3
+LOCK_TTL_SECONDS = SETTINGS.lock_ttl_seconds
+
+
+class FileLeaseBackend:
+    """
+    Аренда в JSON-файле '<name>.lease' в каталоге LOCK_DIR.
+    Чтение и запись аренды выполняются под flock, поэтому подходит для процессов на одном хосте
+    (или на общем томе с поддержкой flock).
+    """
+
+    def __init__(self, directory: str = LOCK_DIR):
+        self.directory = directory
+
+    def _update(self, name: str, owner: str, ttl: Optional[float], only_if_owner: bool) -> bool:
+        path = os.path.join(self.directory, f"{name}.lease")
+        with open(path, 'a+', encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    lease = json_codec.loads(f.read() or '{}')
+                except json_codec.JSONDecodeError:
+                    lease = {}
+
+                now = time.time()
+                held_by_other = lease.get('owner') not in (None, owner) and lease.get('expires_at', 0) > now
+                if held_by_other or (only_if_owner and lease.get('owner') != owner):
+                    return False
+
+                f.seek(0)
+                f.truncate()
+                if ttl is not None:
+                    f.write(json_codec.dumps({'owner': owner, 'expires_at': now + ttl}))
+                f.flush()
+                return True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        return self._update(name, owner, ttl, only_if_owner=False)
+
+    def renew(self, name: str, owner: str, ttl: float) -> bool:
+        return self._update(name, owner, ttl, only_if_owner=True)
+
+    def release(self, name: str, owner: str) -> None:
+        self._update(name, owner, None, only_if_owner=True)
+
+
+class SQLiteLeaseBackend:
+    """Аренда в таблице SQLite; захват выполняется в транзакции BEGIN IMMEDIATE."""
+
+    def __init__(self, db_file: str = LOCK_DB_FILE):
+        self.db_file = db_file
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+
+    def _update(self, name: str, owner: str, ttl: Optional[float], only_if_owner: bool) -> bool:
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            now = time.time()
+            held_by_other = row is not None and row[0] != owner and row[1] > now
+            if held_by_other or (only_if_owner and (row is None or row[0] != owner)):
+                conn.execute("ROLLBACK")
+                return False
+            if ttl is None:
+                conn.execute("DELETE FROM leases WHERE name = ?", (name,))
+            else:
+                conn.execute("INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)",
+                             (name, owner, now + ttl))
+            conn.execute("COMMIT")
+            return True
+        finally:
+            conn.close()
+
+    def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        return self._update(name, owner, ttl, only_if_owner=False)
+
+    def renew(self, name: str, owner: str, ttl: float) -> bool:
+        return self._update(name, owner, ttl, only_if_owner=True)
+
+    def release(self, name: str, owner: str) -> None:
+        self._update(name, owner, None, only_if_owner=True)
+
+
+def get_backend(spec: str = LOCK_BACKEND):
+    """Создаёт бэкенд блокировок по имени или по пути 'module:ClassName'."""
+    if spec == 'file':
+        return FileLeaseBackend()
+    if spec == 'sqlite':
+        return SQLiteLeaseBackend()
+    module_name, _, class_name = spec.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class LeaseLock:
+    """
+    Блокировка с арендой: держится, пока владелец её продлевает, и освобождается сама,
+    если процесс умер (по истечении ttl). Используется как контекстный менеджер:
+
+        with LeaseLock('main') as acquired:
+            if not acquired: ...
+    """
+
+    def __init__(self, name: str, backend=None, ttl: float = LOCK_TTL_SECONDS):
+        self.name = name
+        self.backend = backend or get_backend()
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{id(self)}"
+        self.acquired = False
+        self._stop = threading.Event()
+        self._renewer: Optional[threading.Thread] = None
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.ttl / 3):
+            if not self.backend.renew(self.name, self.owner, self.ttl):
+                logger.warning("⚠️ Не удалось продлить блокировку '%s': её перехватил другой запуск.", self.name)
+                return
+
+    def acquire(self) -> bool:
+        self.acquired = self.backend.acquire(self.name, self.owner, self.ttl)
+        if self.acquired:
+            self._stop.clear()
+            self._renewer = threading.Thread(target=self._renew_loop, name=f"lease-{self.name}", daemon=True)
+            self._renewer.start()
+        return self.acquired
+
+    def release(self):
+        if not self.acquired:
+            return
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+        self.backend.release(self.name, self.owner)
+        self.acquired = False
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
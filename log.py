@@ -0,0 +1,164 @@
+# log.py
+
+"""
+Журнал процесса на стандартном logging: уровни, JSON-строки и неблокирующая запись.
+
+Модули пишут через logging.getLogger(__name__) с отложенным форматированием
+(logger.info("Заказ %s", order_id)): сообщение ниже LOG_LEVEL не форматируется вовсе,
+а тяжёлые дампы (payload запросов, сырой ответ модели) идут на уровне DEBUG через lazy_json.
+Каждая запись несёт run_id запуска, order_id и tenant из contextvars того потока, где она
+создана. Запись в поток вывода выполняет отдельный поток QueueListener, поэтому рабочие
+потоки не ждут ввода-вывода.
+"""
+
+import sys
+import copy
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Iterator, Optional
+
+import json_codec
+from settings import SETTINGS
+from tenants import current_tenant
+
+LOG_LEVEL = SETTINGS.log_level
+# json — одна JSON-строка на запись (контейнеры, сборщики логов); text — для чтения глазами
+LOG_FORMAT = SETTINGS.log_format
+
+_RUN_ID: ContextVar[Optional[str]] = ContextVar('log_run_id', default=None)
+_ORDER_ID: ContextVar[Optional[str]] = ContextVar('log_order_id', default=None)
+
+# Стандартные атрибуты LogRecord: всё остальное в record.__dict__ пришло через extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+_CONTEXT_ATTRS = ('run_id', 'order_id', 'tenant')
+
+
+def set_run_id(run_id: Optional[str]):
+    """run_id запуска для записей этого контекста (и потоков, запущенных из него через copy_context)."""
+    _RUN_ID.set(run_id)
+
+
+@contextmanager
+def order_context(order_id) -> Iterator[None]:
+    """Записи внутри блока помечаются order_id."""
+    token = _ORDER_ID.set(str(order_id) if order_id is not None else None)
+    try:
+        yield
+    finally:
+        _ORDER_ID.reset(token)
+
+
+class lazy_json:
+    """Аргумент записи, который сериализуется в JSON только если запись действительно выводится."""
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return json_codec.dumps(self.obj, indent=True)
+
+
+class ContextFilter(logging.Filter):
+    """Переносит run_id, order_id и tenant из contextvars в запись — до передачи в другой поток."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.run_id = _RUN_ID.get()
+        record.order_id = _ORDER_ID.get()
+        record.tenant = current_tenant()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение, контекст и поля из extra=."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for name in _CONTEXT_ATTRS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        for name, value in record.__dict__.items():
+            if name not in _RECORD_ATTRS and name not in _CONTEXT_ATTRS:
+                entry[name] = value if isinstance(value, (str, int, float, bool, list, dict)) else str(value)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json_codec.dumps(entry)
+
+
+class TextFormatter(logging.Formatter):
+    """Строка для чтения глазами: время, уровень, [tenant] [заказ], сообщение."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)-7s %(context)s%(message)s', datefmt='%H:%M:%S')
+
+    def format(self, record: logging.LogRecord) -> str:
+        parts = [getattr(record, 'tenant', None), getattr(record, 'order_id', None)]
+        record.context = ''.join(f"[{part}] " for part in parts if part)
+        return super().format(record)
+
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Сообщение и трассировка форматируются в рабочем потоке: аргументы записи
+        # и объект исключения не должны уходить в другой поток
+        prepared = copy.copy(record)
+        prepared.msg = record.getMessage()
+        prepared.args = None
+        if record.exc_info:
+            prepared.exc_text = logging.Formatter().formatException(record.exc_info)
+        prepared.exc_info = None
+        return prepared
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_configure_lock = threading.Lock()
+
+
+def configure(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, stream=None):
+    """
+    Настраивает корневой логгер: QueueHandler в рабочих потоках, вывод в stream (stdout) из потока
+    QueueListener. Повторный вызов ничего не делает. Вызывается точками входа (main, webhook_server, backfill).
+    """
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            return
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        handler = _ContextQueueHandler(log_queue)
+        handler.addFilter(ContextFilter())
+
+        root = logging.getLogger()
+        root.handlers[:] = [handler]
+        root.setLevel(level.upper())
+        # Библиотеки HTTP-клиентов шумят на DEBUG: их записи нужны только при WARNING и выше
+        for name in ('urllib3', 'httpx', 'httpcore', 'openai'):
+            logging.getLogger(name).setLevel(max(root.level, logging.WARNING))
+
+        _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def shutdown():
+    """Дописывает записи из очереди и останавливает поток вывода."""
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
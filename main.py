@@ -1,25 +1,59 @@
 import os
-import json
-import pytz
-from datetime import datetime, timedelta
-from typing import Dict, Any
-from dotenv import load_dotenv
+import sys
+import time
+import hashlib
+import argparse
+import functools
+import threading
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict, Any, Optional, List, Set, Tuple
 
 from retailcrm_api import (
-    get_recent_orders,
     create_task,
     update_order_comment,
     get_orders_by_delivery_date,
-    get_orders_by_statuses,
+    get_orders_by_ids,
     get_orders_by_method_and_date_range,
-    get_orders_for_evening_check
+    get_orders_by_status_update,
+    get_orders_for_evening_check,
+    iter_orders,
+    RetailCRMClient,
+    current_client,
+    use_client
 )
-from openai_processor import analyze_comment_with_openai
-
-load_dotenv()
-
-# Устанавливаем часовой пояс Москвы
-MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+from openai_processor import analyze_comment_with_openai, track_usage, LLMUnavailableError
+from extractors import Extraction
+from models import Order, decode_orders
+from pipeline import Pipeline, Stage
+from circuit_breaker import DependencyUnavailableError
+from locking import LeaseLock
+from sharding import owns_order, shard_path, shard_suffix
+from tenants import Tenant, load_tenants, tenant_path, tenant_suffix, use_tenant, TENANTS_FILE
+from scheduler import (
+    Scheduler,
+    WorkItem,
+    carry_over,
+    current_scheduler,
+    use_scheduler,
+    delivery_urgency,
+    ndz_urgency,
+    stall_urgency,
+    RUN_BUDGET_SECONDS
+)
+import checkpoint
+import clock
+import json_codec
+import log
+import metrics
+import profiler
+import shadow
+from settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# Часовой пояс Москвы (объект — moscow_tz())
+MOSCOW_TZ_NAME = 'Europe/Moscow'
 MARKER = ' 📅'  # Маркер для обработанных строк OpenAI (находится в конце строки)
 
 COMMENT_TASK_MARKER = '📝'  # Маркер для задачи "Заполнить комментарий оператора"
@@ -27,11 +61,13 @@ CONTACT_TASK_MARKER = '📲'  # Маркер для задачи "заплани
 MISSED_CALL_TASK_MARKER = '📞'  # Маркер для запущенного регламента НДЗ
 
 # --- НОВЫЙ ФАЙЛ-ТРЕКЕР ДЛЯ РЕГЛАМЕНТА НДЗ ---
-NDZ_TRACKER_FILE = 'ndz_tracker.json'
+NDZ_TRACKER_FILE = shard_path('ndz_tracker.json')
 
 MISSED_CALL_METHOD = "vkhodiashchii-zvonok"
 
-TRACKER_FILE = 'status_trackers.json'
+TRACKER_FILE = shard_path('status_trackers.json')
+# Запись трекеров элементами очереди планировщика (из нескольких потоков)
+_TRACKER_LOCK = threading.Lock()
 STATUS_CONFIGS = {
     # Ключ: Символьный код статуса
     "klient-zhdet-foto-s-zakupki": {
@@ -48,6 +84,12 @@ STATUS_CONFIGS = {
     }
 }
 TRACKED_STATUSES = list(STATUS_CONFIGS.keys())
+# Служебный ключ трекера статусов: с какого момента искать сменившие статус заказы и когда была полная сверка
+TRACKER_INDEX_KEY = '_index'
+# Как часто трекер статусов сверяется со всеми заказами в отслеживаемых статусах, часы (0 — каждый запуск)
+TRACKER_RECONCILE_HOURS = SETTINGS.tracker_reconcile_hours
+# Формат дат в фильтрах RetailCRM (createdAtFrom, statusUpdatedAtFrom)
+CRM_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 ALLOWED_STATUSES = [
     "new",
@@ -90,10 +132,42 @@ ALLOWED_STATUSES = [
 ]
 EXCLUDED_METHODS = ['servisnoe-obsluzhivanie', 'komus']
 
+# Сводные задачи: правила, задачи которых объединяются в одну задачу на менеджера
+# ('status_stall', 'undelivered', 'evening_check' через запятую; пусто — задача на каждый заказ)
+DIGEST_RULES = SETTINGS.digest_rules
+# Минимум заказов в группе для сводной задачи: по меньшей группе ставятся обычные задачи на заказ
+DIGEST_MIN_ORDERS = SETTINGS.digest_min_orders
+
+# Пояснения для отложенных задач (см. TaskDigest и Scheduler)
+DEFERRED_NOTES = {
+    'digest': "добавлен в сводную задачу менеджера",
+    'queue': "задача поставлена в очередь по срочности",
+}
+
+# Конвейер анализа комментариев: число потоков стадий и размер очередей между ними
+PIPELINE_ENABLED = SETTINGS.pipeline_enabled
+PIPELINE_ANALYZE_WORKERS = SETTINGS.pipeline_analyze_workers
+PIPELINE_WRITE_WORKERS = SETTINGS.pipeline_write_workers
+PIPELINE_QUEUE_SIZE = SETTINGS.pipeline_queue_size
+
 UNDELIVERED_CODES = ["self-delivery", "storonniaia-dostavka"]
 DELIVERED_STATUSES = ["send-to-delivery", "dostavlen"]
 
 
+@functools.lru_cache(maxsize=None)
+def moscow_tz():
+    """Часовой пояс Москвы; pytz импортируется при первом обращении, а не при старте процесса."""
+    import pytz
+    return pytz.timezone(MOSCOW_TZ_NAME)
+
+
+def __getattr__(name: str):
+    # Совместимость: main.MOSCOW_TZ по-прежнему доступен снаружи, но без импорта pytz при старте
+    if name == 'MOSCOW_TZ':
+        return moscow_tz()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 # --- ФУНКЦИИ ДЛЯ РАБОТЫ С ТРЕКЕРОМ НДЗ ---
 
 def load_ndz_tracker() -> Dict[str, Dict[str, Any]]:
@@ -101,84 +175,174 @@ def load_ndz_tracker() -> Dict[str, Dict[str, Any]]:
     Загружает данные отслеживания регламента НДЗ из JSON-файла.
     Формат: { 'order_id': { 'day': int, 'last_task_date': 'YYYY-MM-DD' }, ... }
     """
-    if not os.path.exists(NDZ_TRACKER_FILE):
-        print(f"Файл {NDZ_TRACKER_FILE} не найден. Создаю пустой трекер НДЗ.")
+    path = tenant_path(NDZ_TRACKER_FILE)
+    if not os.path.exists(path):
+        logger.info("Файл %s не найден. Создаю пустой трекер НДЗ.", path)
         return {}
 
     try:
-        with open(NDZ_TRACKER_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (IOError, json.JSONDecodeError) as e:
-        print(f"Ошибка при чтении или парсинге {NDZ_TRACKER_FILE}: {e}. Использую пустой трекер НДЗ.")
+        with metrics.timed('tracker_io_seconds', op='load', tracker='ndz'):
+            return json_codec.load_file(path)
+    except (IOError, json_codec.JSONDecodeError) as e:
+        logger.error("Ошибка при чтении или парсинге %s: %s. Использую пустой трекер НДЗ.", path, e)
         return {}
 
 
 def save_ndz_tracker(data: Dict[str, Dict[str, Any]]):
     """Сохраняет данные отслеживания регламента НДЗ в JSON-файл."""
+    path = tenant_path(NDZ_TRACKER_FILE)
     try:
-        with open(NDZ_TRACKER_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4)
-        print(f"Трекер НДЗ успешно сохранен в {NDZ_TRACKER_FILE}.")
+        with metrics.timed('tracker_io_seconds', op='save', tracker='ndz'):
+            json_codec.dump_file(path, data)
+        logger.info("Трекер НДЗ успешно сохранен в %s.", path)
     except IOError as e:
-        print(f"Ошибка при записи в {NDZ_TRACKER_FILE}: {e}")
+        logger.error("Ошибка при записи в %s: %s", path, e)
+
+
+def ndz_due_date(entry: Dict[str, Any]) -> date:
+    """День следующего шага регламента НДЗ: назавтра после последней задачи (без даты — сразу)."""
+    try:
+        return datetime.strptime(entry['last_task_date'], '%Y-%m-%d').date() + timedelta(days=1)
+    except (KeyError, ValueError, TypeError):
+        return date.min
 
 
 # --- ФУНКЦИИ ДЛЯ РАБОТЫ С ТРЕКЕРОМ СТАТУСОВ (ОСТАВЛЕНЫ БЕЗ ИЗМЕНЕНИЙ) ---
 
 def load_trackers() -> Dict[str, Dict[str, str]]:
-    # ... (оставлено без изменений)
     default_trackers = {status: {} for status in TRACKED_STATUSES}
+    path = tenant_path(TRACKER_FILE)
 
-    if not os.path.exists(TRACKER_FILE):
-        print(f"Файл {TRACKER_FILE} не найден. Создаю пустой трекер.")
+    if not os.path.exists(path):
+        logger.info("Файл %s не найден. Создаю пустой трекер.", path)
         return default_trackers
 
     try:
-        with open(TRACKER_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            # Убеждаемся, что все ключи статусов присутствуют
-            for status in TRACKED_STATUSES:
-                if status not in data:
-                    data[status] = {}
-            return data
-    except (IOError, json.JSONDecodeError) as e:
-        print(f"Ошибка при чтении или парсинге {TRACKER_FILE}: {e}. Использую пустой трекер.")
+        with metrics.timed('tracker_io_seconds', op='load', tracker='status'):
+            data = json_codec.load_file(path)
+        # Убеждаемся, что все ключи статусов присутствуют
+        for status in TRACKED_STATUSES:
+            if status not in data:
+                data[status] = {}
+        return data
+    except (IOError, json_codec.JSONDecodeError) as e:
+        logger.error("Ошибка при чтении или парсинге %s: %s. Использую пустой трекер.", path, e)
         return default_trackers
 
 
 def save_trackers(data: Dict[str, Dict[str, str]]):
-    # ... (оставлено без изменений)
+    path = tenant_path(TRACKER_FILE)
     try:
-        with open(TRACKER_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4)
-        print(f"Трекер статусов успешно сохранен в {TRACKER_FILE}.")
+        with metrics.timed('tracker_io_seconds', op='save', tracker='status'):
+            json_codec.dump_file(path, data)
+        logger.info("Трекер статусов успешно сохранен в %s.", path)
     except IOError as e:
-        print(f"Ошибка при записи в {TRACKER_FILE}: {e}")
+        logger.error("Ошибка при записи в %s: %s", path, e)
+
+
+def status_due_date(date_added_str: str, max_days: int) -> date:
+    """День, когда заказ превысит лимит дней в статусе (date_added + max_days + 1); без даты — сразу."""
+    try:
+        return datetime.strptime(date_added_str, '%Y-%m-%d').date() + timedelta(days=max_days + 1)
+    except (ValueError, TypeError):
+        return date.min
+
+
+def status_reconcile_due(index: Dict[str, str], now_moscow: datetime) -> bool:
+    """Пора ли сверить трекер статусов со всеми заказами в отслеживаемых статусах."""
+    if not index.get('reconciled_at') or not index.get('discovered_from') or TRACKER_RECONCILE_HOURS <= 0:
+        return True
+    try:
+        reconciled_at = datetime.strptime(index['reconciled_at'], CRM_DATETIME_FORMAT)
+    except ValueError:
+        return True
+    return now_moscow.replace(tzinfo=None) - reconciled_at >= timedelta(hours=TRACKER_RECONCILE_HOURS)
+
+
+def fetch_all_status_orders(tracker_data: Dict[str, Dict[str, str]]) -> Dict[str, Order]:
+    """Полная сверка: все заказы в отслеживаемых статусах и все заказы трекера, которых среди них нет."""
+    logger.info("Запрос заказов со статусами: %s...", ', '.join(TRACKED_STATUSES))
+    crm_orders = {
+        str(order.id): order for order in iter_orders({'filter[extendedStatus][]': TRACKED_STATUSES})
+        if owns_order(order.id)
+    }
+    if not crm_orders:
+        return crm_orders
+
+    # Отслеживаемые заказы, которых нет в выборке (вышли из статусов или выборка оборвалась),
+    # догружаем по ID, чтобы решение об удалении из трекера принималось по их актуальному статусу.
+    missing_ids = [
+        order_id for status_code in STATUS_CONFIGS
+        for order_id in tracker_data.get(status_code, {})
+        if order_id not in crm_orders
+    ]
+    if missing_ids:
+        for order_id, order_data in get_orders_by_ids(missing_ids).items():
+            crm_orders[order_id] = Order.from_api(order_data)
+    return crm_orders
+
+
+def fetch_due_status_orders(tracker_data: Dict[str, Dict[str, str]], discovered_from: str,
+                            today: date) -> Tuple[Dict[str, Order], bool]:
+    """
+    Заказы трекера, у которых сегодня истекает лимит, и заказы, сменившие статус с discovered_from.
+    Второе значение — удалось ли получить сменившие статус заказы (иначе курсор поиска не сдвигается).
+    """
+    due_ids = [
+        order_id for status_code, config in STATUS_CONFIGS.items()
+        for order_id, date_added_str in tracker_data.get(status_code, {}).items()
+        if status_due_date(date_added_str, config['max_days']) <= today
+    ]
+    tracked = sum(len(tracker_data.get(status_code, {})) for status_code in STATUS_CONFIGS)
+    logger.info("Лимит истекает у %s из %s заказов трекера статусов.", len(due_ids), tracked)
+    metrics.inc('tracker_orders_skipped', tracked - len(due_ids), tracker='status')
+
+    changed = get_orders_by_status_update(TRACKED_STATUSES, discovered_from)
+    crm_orders = {str(order.id): order for order in changed or [] if owns_order(order.id)}
+    due_ids = [order_id for order_id in due_ids if order_id not in crm_orders]
+    if due_ids:
+        for order_id, order_data in get_orders_by_ids(due_ids).items():
+            crm_orders[order_id] = Order.from_api(order_data)
+    return crm_orders, changed is not None
 
 
 def process_status_trackers(now_moscow: datetime):
-    # ... (оставлено без изменений)
     """
     Проверяет заказы на "зависание" в целевых статусах, обновляет трекер и ставит задачи.
+    Из CRM запрашиваются только заказы, у которых сегодня истекает лимит, и заказы, сменившие
+    статус с прошлого запуска; раз в TRACKER_RECONCILE_HOURS — все заказы в отслеживаемых статусах.
     """
-    print("\n--- Запуск отслеживания 'зависших' статусов ---")
+    logger.info("--- Запуск отслеживания 'зависших' статусов ---")
 
     # 1. Загрузка данных трекера
     tracker_data = load_trackers()
+    index = tracker_data.setdefault(TRACKER_INDEX_KEY, {})
     today_date_str = now_moscow.strftime('%Y-%m-%d')
-
-    # 2. Получение текущих заказов из CRM для всех целевых статусов
-    crm_orders_data = get_orders_by_statuses(statuses=TRACKED_STATUSES)
-
-    if not crm_orders_data or not crm_orders_data.get('orders'):
-        print("Не удалось получить текущие заказы из CRM или список пуст. Сохраняю трекер без изменений.")
-        save_trackers(tracker_data)
-        print("-" * 50)
-        return
-
-    crm_orders_list = crm_orders_data['orders']
-    crm_current_statuses = {str(order['id']): order['status'] for order in crm_orders_list}
-    crm_manager_ids = {str(order['id']): order.get('managerId') for order in crm_orders_list}
+    run_started = now_moscow.strftime(CRM_DATETIME_FORMAT)
+
+    # 2. Получение заказов из CRM: полная сверка или только те, по которым есть работа
+    if status_reconcile_due(index, now_moscow):
+        logger.info("Полная сверка трекера статусов с CRM.")
+        crm_orders = fetch_all_status_orders(tracker_data)
+        if not crm_orders:
+            logger.info("Не удалось получить текущие заказы из CRM или список пуст. Сохраняю трекер без изменений.")
+            save_trackers(tracker_data)
+            return
+        index['reconciled_at'] = index['discovered_from'] = run_started
+        # Заказ трекера, которого нет ни в выборке, ни среди догруженных по ID, считается вышедшим из статуса
+        checked_ids: Optional[Set[str]] = None
+    else:
+        crm_orders, discovered = fetch_due_status_orders(tracker_data, index['discovered_from'], now_moscow.date())
+        if discovered:
+            index['discovered_from'] = run_started
+        # Остальные заказы трекера в этот запуск не проверяются: их лимит ещё не истёк
+        checked_ids = set(crm_orders)
+
+    metrics.inc('orders_scanned', len(crm_orders), block='status_trackers')
+    crm_current_statuses = {order_id: order.status for order_id, order in crm_orders.items()}
+    crm_manager_ids = {order_id: order.manager_id for order_id, order in crm_orders.items()}
+    crm_numbers = {order_id: order.number for order_id, order in crm_orders.items()}
+    crm_status_updates = {order_id: order.status_updated_at for order_id, order in crm_orders.items()}
 
     # Задача ставится на завтра в 10:00
     tomorrow_10am = (now_moscow + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
@@ -189,7 +353,8 @@ def process_status_trackers(now_moscow: datetime):
         max_days = config["max_days"]
         task_text = config["task_text"]
 
-        print(f"\nОбработка статуса '{status_code}' (лимит: {max_days} дн.):")
+        logger.info("Обработка статуса '%s' (лимит: %s дн.):", status_code, max_days)
+        digest = TaskDigest('status_stall', f'status_stall:{status_code}', task_text, task_datetime_str)
 
         # --- Часть 3А: Проверка существующих заказов на превышение лимита и удаление ---
         orders_to_remove = []
@@ -198,75 +363,94 @@ def process_status_trackers(now_moscow: datetime):
         current_tracker = tracker_data.get(status_code, {}).copy()
 
         for order_id, date_added_str in current_tracker.items():
-            order_id_int = int(order_id)
-            current_status = crm_current_statuses.get(order_id)
-            manager_id = crm_manager_ids.get(order_id)
-
-            # ПРОВЕРКА 1: Изменился ли статус?
-            if current_status != status_code:
-                # Статус изменился -> удаляем из трекера
-                print(f"  Заказ {order_id} изменил статус на '{current_status}'. Удаляю из трекера.")
-                orders_to_remove.append(order_id)
+            if checked_ids is not None and order_id not in checked_ids:
                 continue
+            with log.order_context(order_id):
+                order_id_int = int(order_id)
+                current_status = crm_current_statuses.get(order_id)
+                manager_id = crm_manager_ids.get(order_id)
+
+                # ПРОВЕРКА 1: Изменился ли статус?
+                if current_status != status_code:
+                    # Статус изменился -> удаляем из трекера
+                    logger.info("Заказ %s изменил статус на '%s'. Удаляю из трекера.", order_id, current_status)
+                    orders_to_remove.append(order_id)
+                    continue
 
-            # ПРОВЕРКА 2: Превышен ли лимит дней?
-            if manager_id:
-                try:
-                    date_added = datetime.strptime(date_added_str, '%Y-%m-%d').replace(tzinfo=MOSCOW_TZ)
-                    days_in_status = (now_moscow.date() - date_added.date()).days
-
-                    if days_in_status > max_days:
-                        print(f"  ⚠️ Заказ {order_id} завис в статусе {days_in_status} дней! Ставлю задачу.")
-
-                        commentary = (
-                            f"Заказ находится в статусе '{status_code}' уже {days_in_status} дней. "
-                            f"Лимит {max_days} дней превышен. Необходимо выполнить действие: {task_text}."
-                        )
-
-                        task_data = {
-                            'text': task_text,
-                            'commentary': commentary,
-                            'datetime': task_datetime_str,  # Завтра в 10:00
-                            'performerId': manager_id,
-                            'order': {'id': order_id_int}
-                        }
-
-                        response = create_task(task_data)
+                # Статус менялся уже после постановки в трекер: заказ выходил из статуса и вернулся
+                status_updated_at = crm_status_updates.get(order_id)
+                if status_updated_at and status_updated_at[:10] > date_added_str:
+                    logger.info("Заказ %s вернулся в статус '%s'. Отсчёт дней заново.", order_id, status_code)
+                    tracker_data[status_code][order_id] = today_date_str
+                    continue
 
-                        if response.get('success'):
-                            print(f"    ✅ Задача успешно создана! ID задачи: {response.get('id')}")
+                # ПРОВЕРКА 2: Превышен ли лимит дней?
+                if manager_id:
+                    try:
+                        date_added = datetime.strptime(date_added_str, '%Y-%m-%d').replace(tzinfo=moscow_tz())
+                        days_in_status = (now_moscow.date() - date_added.date()).days
+
+                        if days_in_status > max_days:
+                            logger.warning("⚠️ Заказ %s завис в статусе %s дней! Ставлю задачу.",
+                                           order_id, days_in_status)
+
+                            commentary = (
+                                f"Заказ находится в статусе '{status_code}' уже {days_in_status} дней. "
+                                f"Лимит {max_days} дней превышен. Необходимо выполнить действие: {task_text}."
+                            )
+
+                            task_data = {
+                                'text': task_text,
+                                'commentary': commentary,
+                                'datetime': task_datetime_str,  # Завтра в 10:00
+                                'performerId': manager_id,
+                                'order': {'id': order_id_int}
+                            }
+
+                            response = digest.add(order_id, crm_numbers.get(order_id), task_data,
+                                                  f"в статусе {days_in_status} дн. (лимит {max_days})",
+                                                  urgency=stall_urgency(days_in_status - max_days),
+                                                  progress={'tracker': 'status', 'status': status_code})
+
+                            if response.get('deferred'):
+                                logger.info("📋 Заказ %s: %s.", order_id, DEFERRED_NOTES[response['deferred']])
+                            elif response.get('success'):
+                                logger.info("✅ Задача успешно создана! ID задачи: %s", response.get('id'))
+                            else:
+                                logger.error("❌ Ошибка при создании задачи: %s", response)
+
+                            # Заказ с задачей в очереди остаётся в трекере, пока задача не создана
+                            if not response.get('queued'):
+                                orders_to_remove.append(order_id)
                         else:
-                            print(f"    ❌ Ошибка при создании задачи: {response}")
+                            logger.debug("Заказ %s находится в статусе %s дней. ОК.", order_id, days_in_status)
 
+                    except ValueError:
+                        logger.error("Ошибка парсинга даты '%s' для заказа %s. Удаляю.", date_added_str, order_id)
                         orders_to_remove.append(order_id)
-                    else:
-                        print(f"  Заказ {order_id} находится в статусе {days_in_status} дней. ОК.")
-
-                except ValueError:
-                    print(f"  Ошибка парсинга даты '{date_added_str}' для заказа {order_id}. Удаляю.")
-                    orders_to_remove.append(order_id)
-            else:
-                print(f"  У заказа {order_id} нет менеджера. Пропускаю проверку лимита.")
+                else:
+                    logger.debug("У заказа %s нет менеджера. Пропускаю проверку лимита.", order_id)
 
+        digest.flush()
         for order_id in orders_to_remove:
             tracker_data[status_code].pop(order_id, None)
 
         # --- Часть 3Б: Добавление новых заказов в трекер ---
 
         new_orders_in_status = [
-            str(order['id']) for order in crm_orders_list
-            if order.get('status') == status_code
+            order_id for order_id, order in crm_orders.items()
+            if order.status == status_code
         ]
 
         for order_id in new_orders_in_status:
             if order_id not in tracker_data[status_code]:
                 # Новый заказ -> добавляем в трекер с текущей датой
                 tracker_data[status_code][order_id] = today_date_str
-                print(f"  + Новый заказ {order_id} добавлен в трекер.")
+                logger.debug("+ Новый заказ %s добавлен в трекер.", order_id)
 
     # 4. Сохранение обновленного трекера
     save_trackers(tracker_data)
-    print("--- Отслеживание статусов завершено ---")
+    logger.info("--- Отслеживание статусов завершено ---")
 
 
 def get_corrected_datetime(ai_datetime_str: str) -> str:
@@ -277,9 +461,9 @@ def get_corrected_datetime(ai_datetime_str: str) -> str:
     3. Если итоговое время попадает в нерабочее (после 20:00), переносит на завтра на 10:00.
     """
     try:
-        now_moscow = datetime.now(MOSCOW_TZ)
+        now_moscow = clock.now(moscow_tz())
 
-        task_dt = datetime.strptime(ai_datetime_str, '%Y-%m-%d %H:%M').replace(tzinfo=MOSCOW_TZ)
+        task_dt = datetime.strptime(ai_datetime_str, '%Y-%m-%d %H:%M').replace(tzinfo=moscow_tz())
 
         if task_dt.date() < now_moscow.date():
             raise ValueError("Задача относится к прошедшей дате и будет пропущена.")
@@ -298,6 +482,169 @@ def get_corrected_datetime(ai_datetime_str: str) -> str:
         raise e
 
 
+def create_task_once(order_id, step: str, task_data: Dict[str, Any], flow: Optional[str] = None,
+                     urgency: float = 0.0, progress: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Создаёт задачу, если шаг step по заказу ещё не выполнен в текущем (или продолженном) запуске.
+    После успешного создания шаг записывается в журнал запуска, поэтому повторный запуск
+    после сбоя не ставит ту же задачу второй раз.
+    В запуске с планировщиком задача не создаётся сразу, а ставится в очередь со срочностью urgency
+    (ответ {'success': True, 'deferred': 'queue', 'queued': True}). Трекер по такому заказу вызывающий
+    не продвигает: продвижение progress (см. advance_tracker) выполнит элемент очереди после создания задачи.
+    """
+    done = checkpoint.journal().get(order_id, step)
+    if done is not None:
+        logger.info("↩️ Задача по заказу %s (%s) уже создана в этом запуске (ID: %s). Пропускаю создание.",
+                    order_id, step, done.get('task_id'))
+        return {'success': True, 'id': done.get('task_id')}
+
+    work = current_scheduler()
+    if work is not None:
+        work.submit(urgency, 'task', order_id, step=step, task_data=task_data, flow=flow, progress=progress)
+        return {'success': True, 'deferred': 'queue', 'queued': True}
+
+    response = create_task(task_data)
+    if response.get('success'):
+        checkpoint.journal().record(order_id, step, flow=flow, task_id=response.get('id'))
+    return response
+
+
+class TaskDigest:
+    """
+    Сводные задачи одного правила: вместо задачи на каждый заказ менеджер получает одну задачу
+    со списком номеров заказов. Задачи группируются по performerId и создаются в flush().
+    Если правило не включено в DIGEST_RULES, add() сразу создаёт обычную задачу по заказу.
+    Шаг step журнала запуска отмечается по каждому заказу группы, поэтому повторный запуск
+    после сбоя не включает заказ в сводку второй раз.
+    В запуске с планировщиком сводные задачи тоже идут через очередь по срочности (элемент 'digest'):
+    иначе они создавались бы ещё на этапе планирования, в обход бюджета запуска.
+    """
+
+    def __init__(self, rule: str, step: str, title: str, task_datetime_str: str):
+        self.rule = rule
+        self.step = step
+        self.title = title
+        self.task_datetime_str = task_datetime_str
+        self.enabled = rule in DIGEST_RULES
+        self._groups: Dict[Any, List[Dict[str, Any]]] = {}
+
+    def add(self, order_id, number: Optional[str], task_data: Dict[str, Any], line: str,
+            urgency: float = 0.0, progress: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Ставит задачу по заказу или откладывает её в сводку.
+        Для отложенной задачи возвращается {'success': True, 'deferred': 'digest'}; с планировщиком
+        в ответе есть и 'queued': True — трекер продвинет элемент очереди (см. create_task_once).
+        """
+        if not self.enabled:
+            return create_task_once(order_id, self.step, task_data, urgency=urgency, progress=progress)
+
+        done = checkpoint.journal().get(order_id, self.step)
+        if done is not None:
+            logger.info("↩️ Задача по заказу %s (%s) уже создана в этом запуске (ID: %s). Пропускаю.",
+                        order_id, self.step, done.get('task_id'))
+            return {'success': True, 'id': done.get('task_id')}
+
+        self._groups.setdefault(task_data['performerId'], []).append(
+            {'order_id': order_id, 'number': number or order_id, 'task_data': task_data, 'line': line,
+             'urgency': urgency, 'progress': progress})
+        if current_scheduler() is not None:
+            return {'success': True, 'deferred': 'digest', 'queued': True}
+        return {'success': True, 'deferred': 'digest'}
+
+    def flush(self):
+        """Создаёт сводные задачи по накопленным группам (с планировщиком — ставит их в очередь)."""
+        work = current_scheduler()
+        for manager_id, items in self._groups.items():
+            if len(items) < DIGEST_MIN_ORDERS:
+                for item in items:
+                    response = create_task_once(item['order_id'], self.step, item['task_data'],
+                                                urgency=item['urgency'], progress=item['progress'])
+                    if not response.get('success'):
+                        logger.error("❌ Ошибка при создании задачи по заказу %s: %s", item['order_id'], response)
+                continue
+
+            numbers = ', '.join(str(item['number']) for item in items)
+            commentary = '\n'.join(
+                f"№ {item['number']}: {item['line']}" for item in items)
+            task_data = {
+                'text': f"{self.title} (заказов: {len(items)}): {numbers}"[:250],
+                'commentary': commentary,
+                'datetime': self.task_datetime_str,
+                'performerId': manager_id,
+            }
+            logger.info("📋 Сводная задача '%s' для менеджера %s: %s заказов.", self.title, manager_id, len(items))
+            orders = [{'order_id': item['order_id'], 'progress': item['progress']} for item in items]
+            if work is not None:
+                work.submit(max(item['urgency'] for item in items), 'digest', f"manager:{manager_id}",
+                            step=self.step, rule=self.rule, task_data=task_data, orders=orders)
+                continue
+            response = create_digest_task(self.rule, self.step, task_data, orders)
+            if not response.get('success'):
+                logger.error("❌ Ошибка при создании сводной задачи: %s", response)
+        self._groups = {}
+
+
+def create_digest_task(rule: str, step: str, task_data: Dict[str, Any], orders: List[Dict[str, Any]],
+                       apply_progress: bool = False) -> Dict[str, Any]:
+    """
+    Создаёт сводную задачу и отмечает шаг step журнала по каждому заказу группы.
+    apply_progress=True (элемент очереди) — заодно продвигает трекеры заказов группы.
+    """
+    response = create_task(task_data)
+    if response.get('success'):
+        for entry in orders:
+            checkpoint.journal().record(entry['order_id'], step, task_id=response.get('id'))
+            if apply_progress:
+                advance_tracker(entry['order_id'], entry.get('progress'))
+        metrics.inc('digest_tasks', rule=rule)
+        metrics.inc('digest_orders', len(orders), rule=rule)
+        logger.info("✅ Сводная задача успешно создана! ID задачи: %s", response.get('id'))
+    return response
+
+
+def advance_tracker(order_id, progress: Optional[Dict[str, Any]]):
+    """
+    Продвигает трекер по заказу, когда задача из очереди планировщика действительно создана:
+    {'tracker': 'ndz', 'day': N} отмечает день N регламента НДЗ сегодняшней датой,
+    {'tracker': 'status', 'status': код} снимает заказ с отслеживания зависшего статуса.
+    """
+    if not progress:
+        return
+    order_id = str(order_id)
+    # Элементы очереди выполняются в нескольких потоках, а трекер — один файл
+    with _TRACKER_LOCK:
+        if progress['tracker'] == 'ndz':
+            tracker = load_ndz_tracker()
+            if tracker.get(order_id, {}).get('day', 0) < progress['day']:
+                tracker[order_id] = {'day': progress['day'],
+                                     'last_task_date': clock.now(moscow_tz()).strftime('%Y-%m-%d')}
+                save_ndz_tracker(tracker)
+        elif progress['tracker'] == 'status':
+            tracker_data = load_trackers()
+            if tracker_data.get(progress['status'], {}).pop(order_id, None) is not None:
+                save_trackers(tracker_data)
+
+
+def refresh_task_datetime(task_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Срок задачи, перенесённой из очереди прошлого запуска, мог уже пройти: такой срок
+    переносится на завтра 10:00, как у задач регламентов. Актуальный срок не меняется.
+    """
+    now_moscow = clock.now(moscow_tz())
+    # Формат 'YYYY-MM-DD HH:MM' сравнивается как строка
+    if task_data.get('datetime', '') > now_moscow.strftime('%Y-%m-%d %H:%M'):
+        return task_data
+    tomorrow_10am = (now_moscow + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+    logger.info("Срок задачи %s уже прошёл. Переношу на %s.", task_data.get('datetime'),
+                tomorrow_10am.strftime('%Y-%m-%d %H:%M'))
+    return {**task_data, 'datetime': tomorrow_10am.strftime('%Y-%m-%d %H:%M')}
+
+
+def entries_hash(entries: str) -> str:
+    """Короткий ключ анализируемых записей: шаги журнала привязаны к конкретному тексту."""
+    return hashlib.sha1(entries.encode('utf-8')).hexdigest()[:12]
+
+
 def extract_last_entries(comment: str, num_entries: int = 3) -> str:
     """
     Извлекает последние записи из комментария менеджера, которые ещё не обработаны.
@@ -315,109 +662,164 @@ def extract_last_entries(comment: str, num_entries: int = 3) -> str:
     return '\n'.join(unprocessed_lines[-num_entries:])
 
 
-def process_undelivered_orders(orders_list: list, now_moscow: datetime):
+def process_undelivered_orders(orders_list: List[Order], now_moscow: datetime):
     """
     Обрабатывает список заказов с сегодняшней датой доставки (только в 21:00).
     Ставит задачу, если код доставки целевой, а статус не 'доставлен'.
     """
 
-    print("\n--- Проверка заказов с сегодняшней датой доставки ---")
+    logger.info("--- Проверка заказов с сегодняшней датой доставки ---")
 
     tomorrow_10am = (now_moscow + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
     task_datetime_str = tomorrow_10am.strftime('%Y-%m-%d %H:%M')
+    digest = TaskDigest('undelivered', 'undelivered', "Актуализировать дату доставки", task_datetime_str)
 
-    for order_data in orders_list:
-        order_id = order_data.get('id')
-        manager_id = order_data.get('managerId')
-        delivery_code = order_data.get('delivery', {}).get('code')
-        order_status = order_data.get('status')
+    for order in orders_list:
+        with log.order_context(order.id):
+            order_id = order.id
+            manager_id = order.manager_id
+            delivery_code = order.delivery_code
+            order_status = order.status
 
-        print(f"Проверка доставки заказа ID: {order_id}")
+            logger.debug("Проверка доставки заказа ID: %s", order_id)
 
-        if not manager_id:
-            print(f"  В заказе {order_id} не указан ответственный менеджер. Пропускаем.")
-            continue
+            if not manager_id:
+                logger.debug("В заказе %s не указан ответственный менеджер. Пропускаем.", order_id)
+                continue
 
-        # 1. Фильтр по коду доставки
-        if delivery_code not in UNDELIVERED_CODES:
-            print(f"  Код доставки '{delivery_code}' нецелевой. Пропускаем.")
-            continue
+            # 1. Фильтр по коду доставки
+            if delivery_code not in UNDELIVERED_CODES:
+                logger.debug("Код доставки '%s' нецелевой. Пропускаем.", delivery_code)
+                continue
 
-        # 2. Фильтр по статусу (если статус не "доставлен" или "отправлен")
-        if order_status not in DELIVERED_STATUSES:
-            print(
-                f"  ⚠️ Заказ ID: {order_id} имеет код доставки '{delivery_code}', но статус '{order_status}'. Создаю задачу.")
+            # 2. Фильтр по статусу (если статус не "доставлен" или "отправлен")
+            if order_status not in DELIVERED_STATUSES:
+                logger.warning("⚠️ Заказ ID: %s имеет код доставки '%s', но статус '%s'. Создаю задачу.",
+                               order_id, delivery_code, order_status)
 
-            commentary = (
-                f"Заказ со способом доставки '{delivery_code}' должен был быть доставлен сегодня, но имеет статус '{order_status}'. "
-                f"Необходимо актуализировать дату или статус."
-            )
+                commentary = (
+                    f"Заказ со способом доставки '{delivery_code}' должен был быть доставлен сегодня, но имеет статус '{order_status}'. "
+                    f"Необходимо актуализировать дату или статус."
+                )
 
-            task_data = {
-                'text': "Актуализировать дату доставки",
-                'commentary': commentary,
-                'datetime': task_datetime_str,
-                'performerId': manager_id,
-                'order': {'id': order_id}
-            }
+                task_data = {
+                    'text': "Актуализировать дату доставки",
+                    'commentary': commentary,
+                    'datetime': task_datetime_str,
+                    'performerId': manager_id,
+                    'order': {'id': order_id}
+                }
 
-            response = create_task(task_data)
+                response = digest.add(order_id, order.number, task_data,
+                                      f"доставка '{delivery_code}', статус '{order_status}'",
+                                      urgency=delivery_urgency(order.delivery_date, now_moscow.date()))
 
-            if response.get('success'):
-                print(f"  ✅ Задача 'Актуализировать дату доставки' успешно создана! ID задачи: {response.get('id')}")
+                if response.get('deferred'):
+                    logger.info("📋 Заказ %s: %s.", order_id, DEFERRED_NOTES[response['deferred']])
+                elif response.get('success'):
+                    logger.info("✅ Задача 'Актуализировать дату доставки' успешно создана! ID задачи: %s",
+                                response.get('id'))
+                else:
+                    logger.error("❌ Ошибка при создании задачи 'Актуализировать дату доставки': %s", response)
             else:
-                print(f"  ❌ Ошибка при создании задачи 'Актуализировать дату доставки': {response}")
-        else:
-            print(f"  Статус '{order_status}' указывает на доставку. Пропускаем.")
+                logger.debug("Статус '%s' указывает на доставку. Пропускаем.", order_status)
 
-        print("-" * 50)
+    digest.flush()
 
 
-def process_order(order_data: dict):
+def filter_order(order: Order) -> Optional[str]:
     """
-    Обрабатывает один заказ: анализирует последнюю запись комментария и создает задачи.
-    Включает логику для фильтрации, пустых и неформализованных комментариев, а также
-    НОВУЮ ЛОГИКУ предотвращения дублирования общих задач.
+    Дешёвые локальные фильтры заказа перед анализом комментария: метод оформления, статус,
+    менеджер, маркеры уже поставленных задач и уже обработанные строки.
+    Возвращает итог ('filtered' или 'marker'), если заказ дальше не обрабатывается, иначе None.
     """
-    order_id = order_data.get('id')
-    operator_comment = order_data.get('managerComment', '')
-    manager_id = order_data.get('managerId')
-    order_method = order_data.get('orderMethod')
-    order_status = order_data.get('status')
-
-    now_moscow = datetime.now(MOSCOW_TZ)
-
-    print(f"Обработка заказа ID: {order_id}")
+    order_id = order.id
+    operator_comment = order.manager_comment
 
     # 1. Фильтрация по методу оформления (исключение)
-    if order_method in EXCLUDED_METHODS:
-        print(f"  В заказе {order_id} метод оформления '{order_method}'. Пропускаем по фильтру методов.")
-        print("-" * 50)
-        return
+    if order.order_method in EXCLUDED_METHODS:
+        logger.debug("В заказе %s метод оформления '%s'. Пропускаем по фильтру методов.", order_id, order.order_method)
+        return 'filtered'
 
     # 2. Фильтрация по статусу (включение)
-    if order_status not in ALLOWED_STATUSES:
-        print(f"  В заказе {order_id} статус '{order_status}' не входит в список целевых. Пропускаем.")
-        print("-" * 50)
-        return
+    if order.status not in ALLOWED_STATUSES:
+        logger.debug("В заказе %s статус '%s' не входит в список целевых. Пропускаем.", order_id, order.status)
+        return 'filtered'
 
-    if not manager_id:
-        print(f"  В заказе {order_id} не указан ответственный менеджер. Пропускаем.")
-        return
+    if not order.manager_id:
+        logger.debug("В заказе %s не указан ответственный менеджер. Пропускаем.", order_id)
+        return 'filtered'
 
     if COMMENT_TASK_MARKER in operator_comment:
-        print(f"  ✅ В заказе {order_id} обнаружен маркер {COMMENT_TASK_MARKER}. Пропускаю задачу на заполнение.")
-        print("-" * 50)
-        return
+        logger.debug("✅ В заказе %s обнаружен маркер %s. Пропускаю задачу на заполнение.",
+                     order_id, COMMENT_TASK_MARKER)
+        return 'marker'
 
     # 2. Если в комментарии уже есть маркер для задачи "запланировать дату касания", пропускаем
     if CONTACT_TASK_MARKER in operator_comment:
-        print(f"  ✅ В заказе {order_id} обнаружен маркер {CONTACT_TASK_MARKER}. Пропускаю задачу на дату касания.")
-        print("-" * 50)
-        return
+        logger.debug("✅ В заказе %s обнаружен маркер %s. Пропускаю задачу на дату касания.",
+                     order_id, CONTACT_TASK_MARKER)
+        return 'marker'
+
+    # Проверяем, есть ли что-то для анализа
+    if operator_comment and not extract_last_entries(operator_comment):
+        logger.debug("✅ Все последние записи уже обработаны. Пропускаю заказ.")
+        return 'marker'
+
+    return None
+
+
+def analyze_order(order: Order) -> Optional[List[Dict[str, Any]]]:
+    """
+    Анализирует необработанные последние записи комментария через OpenAI.
+    Возвращает список найденных задач или None, если комментарий пуст и анализ не нужен.
+    Если OpenAI недоступен — LLMUnavailableError (результат не записывается в журнал).
+    """
+    if not order.manager_comment:
+        return None
+
+    last_entries_to_analyze = extract_last_entries(order.manager_comment)
+    step = f'analysed:{entries_hash(last_entries_to_analyze)}'
+
+    done = checkpoint.journal().get(order.id, step)
+    if done is not None:
+        logger.info("↩️ Записи заказа %s уже проанализированы в этом запуске. Использую сохранённый результат.",
+                    order.id)
+        return done.get('tasks') or []
+
+    logger.debug("Анализирую только последние записи заказа %s:\n%s", order.id, last_entries_to_analyze)
+    started = time.perf_counter()
+    with track_usage() as usage:
+        tasks_to_create = analyze_comment_with_openai(last_entries_to_analyze)
+    checkpoint.journal().record(order.id, step, flow='comment', tasks=tasks_to_create)
+
+    # Теневой режим: кандидат разбирает те же записи параллельно, его ответ только записывается в журнал
+    runner = shadow.shadow_runner()
+    if runner is not None:
+        runner.submit(order.id, last_entries_to_analyze,
+                      Extraction(tasks_to_create, time.perf_counter() - started,
+                                 usage['prompt_tokens'] + usage['completion_tokens']))
+    return tasks_to_create
+
+
+def write_order_tasks(order: Order, tasks_to_create: Optional[List[Dict[str, Any]]],
+                      fallback_task: bool = True) -> str:
+    """
+    Создаёт задачи в CRM по итогам анализа и помечает комментарий маркерами.
+    fallback_task=False — без задачи «запланировать дату касания», если задач не найдено (бэкфилл).
+    Возвращает итог обработки: 'empty_comment', 'llm', 'fallback_task' или 'no_tasks'.
+    """
+    order_id = order.id
+    operator_comment = order.manager_comment
+    manager_id = order.manager_id
+    entries_key = entries_hash(extract_last_entries(operator_comment)) if operator_comment else ''
+    # Заказ считается полностью обработанным, только если все маркеры записаны в комментарий
+    comment_updated = True
+
+    now_moscow = clock.now(moscow_tz())
 
     if not operator_comment:
-        print(f"  ⚠️ В заказе {order_id} нет комментария менеджера. Создаю задачу на заполнение.")
+        logger.warning("⚠️ В заказе %s нет комментария менеджера. Создаю задачу на заполнение.", order_id)
 
         if now_moscow.hour < 17:
             target_dt = now_moscow.replace(hour=17, minute=0, second=0, microsecond=0)
@@ -438,40 +840,29 @@ def process_order(order_data: dict):
             'order': {'id': order_id}
         }
 
-        response = create_task(task_data)
+        response = create_task_once(order_id, 'empty_comment_task', task_data, flow='comment')
 
         if response.get('success'):
-            print(f"  ✅ Задача 'Заполнить комментарий' успешно создана! ID задачи: {response.get('id')}")
+            logger.info("✅ Задача 'Заполнить комментарий' успешно создана! ID задачи: %s", response.get('id'))
 
             marker_with_timestamp = f"[{now_moscow.strftime('%Y-%m-%d %H:%M')}] {COMMENT_TASK_MARKER}"
             update_response = update_order_comment(order_id, marker_with_timestamp)
             if update_response.get('success'):
-                print(f"  ✅ Комментарий к заказу обновлен маркером {COMMENT_TASK_MARKER}.")
+                logger.info("✅ Комментарий к заказу обновлен маркером %s.", COMMENT_TASK_MARKER)
+                checkpoint.journal().record(order_id, checkpoint.DONE_STEP, flow='comment')
             else:
-                print(f"  ❌ Ошибка при обновлении комментария маркером {COMMENT_TASK_MARKER}: {update_response}")
+                logger.error("❌ Ошибка при обновлении комментария маркером %s: %s",
+                             COMMENT_TASK_MARKER, update_response)
 
         else:
-            print(f"  ❌ Ошибка при создании задачи 'Заполнить комментарий': {response}")
+            logger.error("❌ Ошибка при создании задачи 'Заполнить комментарий': %s", response)
 
-        print("-" * 50)
-        return
+        return 'empty_comment'
 
     # --- Логика обработки при НЕПУСТОМ комментарии (Сценарий Б и В) ---
 
-    last_entries_to_analyze = extract_last_entries(operator_comment)
-
-    # Проверяем, есть ли что-то для анализа
-    if not last_entries_to_analyze:
-        print(f"  ✅ Все последние записи уже обработаны. Пропускаю заказ.")
-        print("-" * 50)
-        return
-
-    print(f"  Анализирую только последние записи:\n{last_entries_to_analyze}")
-
-    tasks_to_create = analyze_comment_with_openai(last_entries_to_analyze)
-
     if tasks_to_create:
-        print("  ✅ OpenAI успешно нашел следующие задачи. Попытка их создания...")
+        logger.info("✅ OpenAI успешно нашел задачи для заказа %s. Попытка их создания...", order_id)
         for i, task_info in enumerate(tasks_to_create):
             try:
                 task_date_str = task_info.get('date_time')
@@ -479,8 +870,8 @@ def process_order(order_data: dict):
                 task_comment = task_info.get('commentary')
 
                 if not (task_date_str and task_text and task_date_str.strip() and task_text.strip()):
-                    print(
-                        f"    В ответе OpenAI отсутствуют обязательные поля (task, date_time) или они пусты. Пропускаем задачу #{i + 1}.")
+                    logger.warning("В ответе OpenAI отсутствуют обязательные поля (task, date_time) или они пусты. "
+                                   "Пропускаем задачу #%s.", i + 1)
                     continue
 
                 corrected_datetime_str = get_corrected_datetime(task_date_str)
@@ -493,29 +884,34 @@ def process_order(order_data: dict):
                     'order': {'id': order_id}
                 }
 
-                response = create_task(task_data)
+                response = create_task_once(order_id, f'task:{entries_key}:{i}', task_data, flow='comment')
 
                 if response.get('success'):
                     task_id = response.get('id')
-                    print(f"    Задача #{i + 1} успешно создана! ID задачи: {task_id}")
+                    logger.info("Задача #%s успешно создана! ID задачи: %s", i + 1, task_id)
 
                     line_to_mark = task_info.get('marked_line')
                     new_comment = operator_comment.replace(line_to_mark, f"{line_to_mark}{MARKER}")
 
                     update_response = update_order_comment(order_id, new_comment)
                     if update_response.get('success'):
-                        print(f"    ✅ Комментарий к заказу успешно обновлен.")
+                        logger.info("✅ Комментарий к заказу успешно обновлен.")
                         operator_comment = new_comment
                     else:
-                        print(f"    ❌ Ошибка при обновлении комментария: {update_response}")
+                        logger.error("❌ Ошибка при обновлении комментария: %s", update_response)
+                        comment_updated = False
                 else:
-                    print(f"    ❌ Ошибка при создании задачи #{i + 1}: {response}")
+                    logger.error("❌ Ошибка при создании задачи #%s: %s", i + 1, response)
 
             except (ValueError, TypeError) as e:
-                print(f"    Ошибка при обработке задачи #{i + 1}: {e}. Пропускаем.")
+                logger.error("Ошибка при обработке задачи #%s: %s. Пропускаем.", i + 1, e)
+
+    elif not fallback_task:
+        logger.info("Задач в строгом формате 'ДАТА - ДЕЙСТВИЕ' не найдено (заказ %s). Заглушку не ставлю.", order_id)
+        return 'no_tasks'
 
     else:
-        print("  ❌ OpenAI не нашел явных задач в строгом формате 'ДАТА - ДЕЙСТВИЕ'.")
+        logger.info("OpenAI не нашел явных задач в строгом формате 'ДАТА - ДЕЙСТВИЕ' (заказ %s).", order_id)
 
         tomorrow_10am = now_moscow + timedelta(days=1)
         tomorrow_10am = tomorrow_10am.replace(hour=10, minute=0, second=0, microsecond=0)
@@ -529,32 +925,61 @@ def process_order(order_data: dict):
             'order': {'id': order_id}
         }
 
-        response = create_task(task_data)
+        response = create_task_once(order_id, f'fallback_task:{entries_key}', task_data, flow='comment')
 
         if response.get('success'):
-            print(f"  ✅ Задача 'запланировать дату касания' успешно создана! ID задачи: {response.get('id')}")
+            logger.info("✅ Задача 'запланировать дату касания' успешно создана! ID задачи: %s", response.get('id'))
 
             new_comment = f"{operator_comment}\n[{now_moscow.strftime('%Y-%m-%d %H:%M')}] {CONTACT_TASK_MARKER}"
             update_response = update_order_comment(order_id, new_comment)
             if update_response.get('success'):
-                print(f"    ✅ Комментарий к заказу обновлен маркером {CONTACT_TASK_MARKER}.")
+                logger.info("✅ Комментарий к заказу обновлен маркером %s.", CONTACT_TASK_MARKER)
             else:
-                print(f"    ❌ Ошибка при обновлении комментария: {update_response}")
+                logger.error("❌ Ошибка при обновлении комментария: %s", update_response)
+                comment_updated = False
 
         else:
-            print(f"  ❌ Ошибка при создании задачи 'запланировать дату касания': {response}")
+            logger.error("❌ Ошибка при создании задачи 'запланировать дату касания': %s", response)
 
-    print("-" * 50)
+    if comment_updated:
+        checkpoint.journal().record(order_id, checkpoint.DONE_STEP, flow='comment')
+    return 'llm' if tasks_to_create else 'fallback_task'
+
+
+def process_order(order: Order) -> str:
+    """
+    Обрабатывает один заказ: анализирует последнюю запись комментария и создает задачи.
+    Включает логику для фильтрации, пустых и неформализованных комментариев, а также
+    НОВУЮ ЛОГИКУ предотвращения дублирования общих задач.
+    Последовательно выполняет те же шаги, что и стадии конвейера комментариев:
+    filter_order -> analyze_order -> write_order_tasks.
+    Возвращает итог обработки: 'filtered', 'marker', 'empty_comment', 'llm', 'fallback_task'
+    или 'llm_unavailable' (OpenAI недоступен; вызывающий переносит заказ в следующий запуск).
+    """
+    with log.order_context(order.id):
+        logger.debug("Обработка заказа ID: %s", order.id)
+
+        outcome = filter_order(order)
+        if outcome:
+            return outcome
+
+        try:
+            tasks_to_create = analyze_order(order)
+        except LLMUnavailableError as e:
+            logger.warning("⏸️ Анализ заказа %s отложен: %s", order.id, e)
+            return 'llm_unavailable'
+        return write_order_tasks(order, tasks_to_create)
 
 
 # --- ОБНОВЛЕННАЯ ФУНКЦИЯ: РЕГЛАМЕНТ ДЛЯ ПРОПУЩЕННЫХ ЗВОНКОВ ---
 
-def process_missed_call_reglament(orders_list: list, now_moscow: datetime, ndz_tracker: Dict[str, Dict[str, Any]]):
+def process_missed_call_reglament(orders_list: List[Order], now_moscow: datetime,
+                                  ndz_tracker: Dict[str, Dict[str, Any]]):
     """
     Обрабатывает список заказов по новому упрощенному регламенту "Входящий звонок" (3 дня, 1 задача в день).
     Использует ndz_tracker для отслеживания дня.
     """
-    print(f"\n--- Запуск регламента НДЗ для {len(orders_list)} заказов ({MISSED_CALL_METHOD}) ---")
+    logger.info("--- Запуск регламента НДЗ для %s заказов (%s) ---", len(orders_list), MISSED_CALL_METHOD)
 
     tomorrow_10am = (now_moscow + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
     task_datetime_str = tomorrow_10am.strftime('%Y-%m-%d %H:%M')
@@ -563,86 +988,91 @@ def process_missed_call_reglament(orders_list: list, now_moscow: datetime, ndz_t
     # Создаем локальную копию трекера для изменений
     tracker = ndz_tracker.copy()
 
-    for order_data in orders_list:
-        order_id = str(order_data.get('id'))
-        manager_id = order_data.get('managerId')
-        order_status = order_data.get('status')
+    for order in orders_list:
+        with log.order_context(order.id):
+            order_id = str(order.id)
+            manager_id = order.manager_id
+            order_status = order.status
 
-        print(f"Обработка заказа ID: {order_id}")
+            logger.debug("Обработка заказа ID: %s", order_id)
 
-        if not manager_id:
-            print(f"  В заказе {order_id} нет менеджера. Пропускаю.")
-            continue
+            if not manager_id:
+                logger.debug("В заказе %s нет менеджера. Пропускаю.", order_id)
+                continue
 
-        # 1. Проверка статуса (если не в целевом, удаляем из трекера и пропускаем)
-        if order_status not in ALLOWED_STATUSES:
-            if order_id in tracker:
-                print(f"  ✅ Заказ {order_id} вышел из целевого статуса ('{order_status}'). Удаляю из трекера НДЗ.")
-                tracker.pop(order_id)
-            else:
-                print(f"  Заказ {order_id} не в целевом статусе. Пропускаю.")
-            continue
+            # 1. Проверка статуса (если не в целевом, удаляем из трекера и пропускаем)
+            if order_status not in ALLOWED_STATUSES:
+                if order_id in tracker:
+                    logger.info("✅ Заказ %s вышел из целевого статуса ('%s'). Удаляю из трекера НДЗ.",
+                                order_id, order_status)
+                    tracker.pop(order_id)
+                else:
+                    logger.debug("Заказ %s не в целевом статусе. Пропускаю.", order_id)
+                continue
 
-        current_day = 0
-        last_task_date = None
-        last_task_date_str = None
+            current_day = 0
+            last_task_date = None
+            last_task_date_str = None
 
-        if order_id in tracker:
-            current_day = tracker[order_id].get('day', 0)
-            last_task_date_str = tracker[order_id].get('last_task_date')
-            try:
-                if last_task_date_str:
-                    last_task_date = datetime.strptime(last_task_date_str, '%Y-%m-%d').date()
-            except (ValueError, TypeError):
-                pass  # Пропускаем, если дата не парсится
-
-        next_day = current_day + 1
-
-        # 2. Проверка дня
-        if current_day >= 3:
-            # Цикл завершен
-            print(f"  ✅ Заказ {order_id}: Регламент НДЗ завершен (День 3). Удаляю из трекера.")
-            tracker.pop(order_id, None)
-            continue
-
-        # 3. Проверка паузы (Прошел ли минимум 1 день с последней постановки)
-        if last_task_date and last_task_date >= now_moscow.date():
-            # Если последняя задача ставилась сегодня или в будущем, пропускаем, чтобы не дублировать
-            print(
-                f"  Заказ {order_id}: Задача на День {current_day} уже поставлена на {last_task_date_str}. Ожидаю следующего дня.")
-            continue
-
-        # 4. Постановка задачи (День 1, 2 или 3)
-
-        task_text = f"Обзвон по регламенту НДЗ - день {next_day}"
-        commentary = (
-            f"Необходимо выполнить обзвон по регламенту 'Входящий звонок' (День {next_day}). "
-            f"Запланировано на {task_datetime_str}."
-        )
+            if order_id in tracker:
+                current_day = tracker[order_id].get('day', 0)
+                last_task_date_str = tracker[order_id].get('last_task_date')
+                try:
+                    if last_task_date_str:
+                        last_task_date = datetime.strptime(last_task_date_str, '%Y-%m-%d').date()
+                except (ValueError, TypeError):
+                    pass  # Пропускаем, если дата не парсится
+
+            next_day = current_day + 1
+
+            # 2. Проверка дня
+            if current_day >= 3:
+                # Цикл завершен
+                logger.info("✅ Заказ %s: Регламент НДЗ завершен (День 3). Удаляю из трекера.", order_id)
+                tracker.pop(order_id, None)
+                continue
 
-        task_data = {
-            'text': task_text,
-            'commentary': commentary,
-            'datetime': task_datetime_str,
-            'performerId': manager_id,
-            'order': {'id': int(order_id)}
-        }
+            # 3. Проверка паузы (Прошел ли минимум 1 день с последней постановки)
+            if last_task_date and last_task_date >= now_moscow.date():
+                # Если последняя задача ставилась сегодня или в будущем, пропускаем, чтобы не дублировать
+                logger.debug("Заказ %s: Задача на День %s уже поставлена на %s. Ожидаю следующего дня.",
+                             order_id, current_day, last_task_date_str)
+                continue
 
-        response = create_task(task_data)
+            # 4. Постановка задачи (День 1, 2 или 3)
 
-        if response.get('success'):
-            print(
-                f"  ✅ Заказ {order_id}: Задача '{task_text}' успешно создана на {task_datetime_str}. ID: {response.get('id')}")
+            task_text = f"Обзвон по регламенту НДЗ - день {next_day}"
+            commentary = (
+                f"Необходимо выполнить обзвон по регламенту 'Входящий звонок' (День {next_day}). "
+                f"Запланировано на {task_datetime_str}."
+            )
 
-            # Обновляем трекер
-            tracker[order_id] = {
-                'day': next_day,
-                'last_task_date': today_date_str
+            task_data = {
+                'text': task_text,
+                'commentary': commentary,
+                'datetime': task_datetime_str,
+                'performerId': manager_id,
+                'order': {'id': int(order_id)}
             }
-        else:
-            print(f"  ❌ Заказ {order_id}: Ошибка при создании задачи '{task_text}': {response}")
 
-        print("-" * 50)
+            response = create_task_once(order_id, f'ndz_day:{next_day}', task_data, urgency=ndz_urgency(next_day),
+                                        progress={'tracker': 'ndz', 'day': next_day})
+
+            if response.get('success'):
+                if response.get('deferred'):
+                    logger.info("📋 Заказ %s: %s ('%s').", order_id, DEFERRED_NOTES[response['deferred']], task_text)
+                else:
+                    logger.info("✅ Заказ %s: Задача '%s' успешно создана на %s. ID: %s",
+                                order_id, task_text, task_datetime_str, response.get('id'))
+
+                # Обновляем трекер (задачу из очереди трекер дождётся: его продвинет сам элемент очереди)
+                if not response.get('queued'):
+                    tracker[order_id] = {
+                        'day': next_day,
+                        'last_task_date': today_date_str
+                    }
+            else:
+                logger.error("❌ Заказ %s: Ошибка при создании задачи '%s': %s", order_id, task_text, response)
 
     # Сохраняем обновленный трекер
     save_ndz_tracker(tracker)
@@ -652,7 +1082,7 @@ def process_evening_check(now_moscow: datetime):
     """
     Проверяет заказы в 21:00 с доставкой на завтра и определенными статусами/типами.
     """
-    print("\n--- Запуск вечерней проверки заказов на завтра (21:00) ---")
+    logger.info("--- Запуск вечерней проверки заказов на завтра (21:00) ---")
 
     # 1. Определяем даты для фильтра (завтрашний день)
     tomorrow = now_moscow.date() + timedelta(days=1)
@@ -663,159 +1093,469 @@ def process_evening_check(now_moscow: datetime):
     orders_data = get_orders_for_evening_check(date_from, date_to)
 
     if not orders_data or not orders_data.get('orders'):
-        print("Не найдено заказов для вечерней проверки или произошла ошибка.")
-        print("-" * 50)
+        logger.warning("Не найдено заказов для вечерней проверки или произошла ошибка.")
         return
 
-    orders_list = orders_data['orders']
-    print(f"Найдено {len(orders_list)} заказов с доставкой на завтра для проверки.")
+    orders_list = [order for order in decode_orders(orders_data) if owns_order(order.id)]
+    metrics.inc('orders_scanned', len(orders_list), block='evening_check')
+    logger.info("Найдено %s заказов с доставкой на завтра для проверки.", len(orders_list))
 
     # 3. Определяем время для задачи (завтра в 10:00)
     task_datetime = (now_moscow + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
     task_datetime_str = task_datetime.strftime('%Y-%m-%d %H:%M')
+    digest = TaskDigest('evening_check', 'evening_check', "Актуализировать данные по заказу: дата и статус",
+                        task_datetime_str)
 
     # 4. Обрабатываем каждый заказ
     for order in orders_list:
-        order_id = order.get('id')
-        manager_id = order.get('managerId')
-
-        if not manager_id:
-            print(f"  В заказе {order_id} не указан ответственный менеджер. Пропускаем.")
-            continue
+        with log.order_context(order.id):
+            order_id = order.id
+            manager_id = order.manager_id
 
-        print(f"  ⚠️ Создаю задачу для заказа ID: {order_id}")
+            if not manager_id:
+                logger.debug("В заказе %s не указан ответственный менеджер. Пропускаем.", order_id)
+                continue
 
-        task_data = {
-            'text': "Актуализировать данные по заказу: дата и статус.",
-            'datetime': task_datetime_str,
-            'performerId': manager_id,
-            'order': {'id': order_id}
-        }
+            logger.warning("⚠️ Создаю задачу для заказа ID: %s", order_id)
 
-        response = create_task(task_data)
+            task_data = {
+                'text': "Актуализировать данные по заказу: дата и статус.",
+                'datetime': task_datetime_str,
+                'performerId': manager_id,
+                'order': {'id': order_id}
+            }
 
-        if response.get('success'):
-            print(f"    ✅ Задача успешно создана! ID задачи: {response.get('id')}")
-        else:
-            print(f"    ❌ Ошибка при создании задачи: {response}")
+            response = digest.add(order_id, order.number, task_data,
+                                  f"доставка {order.delivery_date}, статус '{order.status}'",
+                                  urgency=delivery_urgency(order.delivery_date, now_moscow.date()))
 
-    print("--- Вечерняя проверка заказов завершена ---")
+            if response.get('deferred'):
+                logger.info("📋 Заказ %s: %s.", order_id, DEFERRED_NOTES[response['deferred']])
+            elif response.get('success'):
+                logger.info("✅ Задача успешно создана! ID задачи: %s", response.get('id'))
+            else:
+                logger.error("❌ Ошибка при создании задачи: %s", response)
 
+    digest.flush()
+    logger.info("--- Вечерняя проверка заказов завершена ---")
 
-# --- ИЗМЕНЕННАЯ ФУНКЦИЯ main() ---
 
-def main():
-    """Главная функция для запуска периодической обработки."""
-    print("Запускаю периодическую проверку новых заказов...")
+# --- БЛОКИ ЗАПУСКА ---
 
-    now_moscow = datetime.now(MOSCOW_TZ)
-    current_time_str = now_moscow.strftime('%H:%M')
+def run_ndz_block(now_moscow: datetime):
+    """Регламент для пропущенных звонков (запускается в 12:00 и 16:00)."""
     current_hour = now_moscow.hour
-    is_evening_run = current_hour == 21
+    logger.info("--- Запускаю регламент НДЗ (Время: %s) ---", now_moscow.strftime('%H:%M'))
 
-    # --- БЛОК 1: Проверка на "зависшие" статусы ---
-    process_status_trackers(now_moscow)
+    # 1. Загружаем текущий трекер НДЗ. Из CRM нужны только заказы, по которым сегодня очередной шаг:
+    # у заказов с задачей, поставленной сегодня, следующий день регламента наступит только завтра
+    ndz_tracker = load_ndz_tracker()
+    due_tracker_ids = [order_id for order_id, entry in ndz_tracker.items()
+                       if ndz_due_date(entry) <= now_moscow.date()]
+    metrics.inc('tracker_orders_skipped', len(ndz_tracker) - len(due_tracker_ids), tracker='ndz')
 
-    # --- БЛОК 2: РЕГЛАМЕНТ ДЛЯ ПРОПУЩЕННЫХ ЗВОНКОВ (12:00 и 16:00) ---
-    if current_hour == 12 or current_hour == 16:
-        print(f"\n--- Запускаю регламент НДЗ (Время: {current_time_str}) ---")
+    # 2. Определяем временной диапазон для НОВЫХ заказов
+    date_from = None
+    date_to = now_moscow.strftime('%Y-%m-%d %H:%M:%S')
 
-        # 1. Загружаем текущий трекер НДЗ
-        ndz_tracker = load_ndz_tracker()
-        orders_in_tracker_ids = list(ndz_tracker.keys())
+    if current_hour == 12:
+        # С 16:01 предыдущего дня до 12:00 текущего дня
+        yesterday_1601 = (now_moscow - timedelta(days=1)).replace(hour=16, minute=1, second=0, microsecond=0)
+        date_from = yesterday_1601.strftime('%Y-%m-%d %H:%M:%S')
 
-        # 2. Определяем временной диапазон для НОВЫХ заказов
-        date_from = None
-        date_to = now_moscow.strftime('%Y-%m-%d %H:%M:%S')
+    elif current_hour == 16:
+        # С 12:01 до 16:00 текущего дня
+        today_1201 = now_moscow.replace(hour=12, minute=1, second=0, microsecond=0)
+        date_from = today_1201.strftime('%Y-%m-%d %H:%M:%S')
 
-        if current_hour == 12:
-            # С 16:01 предыдущего дня до 12:00 текущего дня
-            yesterday_1601 = (now_moscow - timedelta(days=1)).replace(hour=16, minute=1, second=0, microsecond=0)
-            date_from = yesterday_1601.strftime('%Y-%m-%d %H:%M:%S')
+    logger.info("Ищем НОВЫЕ заказы (%s) в диапазоне: %s — %s", MISSED_CALL_METHOD, date_from, date_to)
 
-        elif current_hour == 16:
-            # С 12:01 до 16:00 текущего дня
-            today_1201 = now_moscow.replace(hour=12, minute=1, second=0, microsecond=0)
-            date_from = today_1201.strftime('%Y-%m-%d %H:%M:%S')
+    # 3. Получаем только НОВЫЕ заказы из CRM, которые не в трекере
+    new_missed_call_orders_data = get_orders_by_method_and_date_range(MISSED_CALL_METHOD, date_from, date_to)
 
-        print(f"  Ищем НОВЫЕ заказы ({MISSED_CALL_METHOD}) в диапазоне: {date_from} — {date_to}")
+    new_orders = decode_orders(new_missed_call_orders_data)
 
-        # 3. Получаем только НОВЫЕ заказы из CRM, которые не в трекере
-        new_missed_call_orders_data = get_orders_by_method_and_date_range(MISSED_CALL_METHOD, date_from, date_to)
+    # Фильтруем, оставляя только те, которых НЕТ в трекере.
+    filtered_new_orders = [
+        order for order in new_orders
+        if str(order.id) not in ndz_tracker and owns_order(order.id)
+    ]
 
-        new_orders = new_missed_call_orders_data.get('orders', []) if new_missed_call_orders_data else []
+    # 4. Объединяем НОВЫЕ заказы с заказами, которые УЖЕ в трекере.
+    # Для заказов, которые в трекере, нужно запросить их актуальные данные (статус!)
 
-        # Фильтруем, оставляя только те, которых НЕТ в трекере.
-        filtered_new_orders = [
-            order for order in new_orders
-            if str(order.get('id')) not in orders_in_tracker_ids
-        ]
+    orders_for_processing = []
 
-        # 4. Объединяем НОВЫЕ заказы с заказами, которые УЖЕ в трекере.
-        # Для заказов, которые в трекере, нужно запросить их актуальные данные (статус!)
+    if filtered_new_orders:
+        orders_for_processing.extend(filtered_new_orders)
+        logger.info("Найдено %s абсолютно новых заказов.", len(filtered_new_orders))
 
-        orders_for_processing = []
+    if due_tracker_ids:
+        logger.info("Получаю данные для %s из %s заказов трекера НДЗ (очередной шаг сегодня).",
+                    len(due_tracker_ids), len(ndz_tracker))
+        # Получаем актуальные данные для заказов, которые уже в цикле
+        tracker_orders = get_orders_by_ids(due_tracker_ids)
+        orders_for_processing.extend(Order.from_api(order_data) for order_data in tracker_orders.values())
 
-        if filtered_new_orders:
-            orders_for_processing.extend(filtered_new_orders)
-            print(f"  Найдено {len(filtered_new_orders)} абсолютно новых заказов.")
+    metrics.inc('orders_scanned', len(orders_for_processing), block='ndz')
 
-        if orders_in_tracker_ids:
-            print(f"  Получаю данные для {len(orders_in_tracker_ids)} заказов, находящихся в трекере НДЗ.")
-            # Получаем актуальные данные для заказов, которые уже в цикле
-            tracker_orders_data = get_orders_by_statuses(statuses=None, order_ids=orders_in_tracker_ids)
-            if tracker_orders_data:
-                orders_for_processing.extend(tracker_orders_data.get('orders', []))
+    if orders_for_processing:
+        logger.info("Всего в обработку идет %s заказов.", len(orders_for_processing))
+        # 5. Запускаем регламент
+        process_missed_call_reglament(orders_for_processing, now_moscow, ndz_tracker)
+    else:
+        logger.info("Новых или отслеживаемых заказов по методу '%s' не найдено.", MISSED_CALL_METHOD)
 
-        if orders_for_processing:
-            print(f"  Всего в обработку идет {len(orders_for_processing)} заказов.")
-            # 5. Запускаем регламент
-            process_missed_call_reglament(orders_for_processing, now_moscow, ndz_tracker)
-        else:
-            print(f"  Новых или отслеживаемых заказов по методу '{MISSED_CALL_METHOD}' не найдено.")
-            print("-" * 50)
+
+def run_undelivered_block(now_moscow: datetime):
+    """Проверка не доставленных сегодня заказов (21:00)."""
+    logger.info("--- Запускаю проверку не доставленных заказов (Время: %s) ---", now_moscow.strftime('%H:%M'))
+    today_date_str = now_moscow.strftime('%Y-%m-%d')
+    undelivered_orders_data = get_orders_by_delivery_date(today_date_str)
+    if undelivered_orders_data:
+        undelivered_orders = [order for order in decode_orders(undelivered_orders_data) if owns_order(order.id)]
+        metrics.inc('orders_scanned', len(undelivered_orders), block='undelivered')
+        logger.info("Найдено %s заказов с доставкой на сегодня.", len(undelivered_orders))
+        process_undelivered_orders(undelivered_orders, now_moscow)
+    else:
+        logger.info("Не найдено заказов с доставкой на сегодня.")
+
+
+def build_comment_pipeline(include_filter: bool = True, fallback_task: bool = True) -> Pipeline:
+    """
+    Конвейер анализа комментариев: filter -> analyze -> write.
+    Дешёвая локальная фильтрация идёт впереди, пока медленные стадии (OpenAI, запись в CRM)
+    заняты; каждая стадия масштабируется своим числом потоков.
+    include_filter=False — для заказов, уже прошедших filter_order (бэкфилл);
+    fallback_task — как в write_order_tasks.
+    """
+
+    def filter_stage(order: Order) -> Optional[Order]:
+        with log.order_context(order.id), profiler.span('filter_order', cat='order', order_id=order.id) as span_args:
+            logger.debug("Обработка заказа ID: %s", order.id)
+            outcome = filter_order(order)
+            span_args['outcome'] = outcome
+        if outcome:
+            metrics.inc('orders_processed', outcome=outcome)
+            return None
+        return order
+
+    def analyze_stage(order: Order):
+        with log.order_context(order.id), profiler.span('analyze_order', cat='order', order_id=order.id):
+            try:
+                return order, analyze_order(order)
+            except LLMUnavailableError as e:
+                # Без задачи-заглушки: заказ переносится в очередь следующего запуска
+                logger.warning("⏸️ Анализ заказа %s отложен: %s", order.id, e)
+                metrics.inc('orders_processed', outcome='llm_unavailable')
+                defer_analysis(order)
+                return None
+
+    def write_stage(item) -> None:
+        order, tasks_to_create = item
+        with log.order_context(order.id):
+            with profiler.span('write_order_tasks', cat='order', order_id=order.id) as span_args:
+                outcome = write_order_tasks(order, tasks_to_create, fallback_task)
+                span_args['outcome'] = outcome
+            metrics.inc('orders_processed', outcome=outcome)
+        return None
+
+    stages = [
+        Stage('filter', filter_stage, workers=1, queue_size=PIPELINE_QUEUE_SIZE),
+        Stage('analyze', analyze_stage, workers=PIPELINE_ANALYZE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE),
+        Stage('write', write_stage, workers=PIPELINE_WRITE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE),
+    ]
+    return Pipeline(stages if include_filter else stages[1:])
+
+
+def defer_analysis(order: Order):
+    """
+    Переносит анализ заказа, отложенный из-за недоступности или лимитов OpenAI, в очередь следующего
+    запуска (pending_work.json): иначе заказ, выпавший из последних 50, так и остался бы без анализа.
+    """
+    urgency = delivery_urgency(order.delivery_date, clock.now(moscow_tz()).date())
+    if carry_over(urgency, 'comment', order.id):
+        logger.info("📋 Анализ заказа %s перенесён в очередь следующего запуска.", order.id)
+
+
+def run_comment_block(now_moscow: datetime):
+    """Обработка последних 50 заказов для анализа комментариев."""
+    logger.info("--- Запускаю обработку последних 50 заказов для анализа комментариев ---")
+
+    # Заказы обрабатываются по мере потокового разбора страницы, не дожидаясь её целиком
+    logger.info("Запрос последних 50 заказов...")
+    orders = (order for order in iter_orders(limit=50, max_orders=50) if owns_order(order.id))
+
+    work = current_scheduler()
+    if work is not None:
+        # Запуск с бюджетом: локальный фильтр сейчас, анализ — в общей очереди по срочности доставки
+        scanned = 0
+        for order in orders:
+            scanned += 1
+            outcome = filter_order(order)
+            if outcome:
+                metrics.inc('orders_processed', outcome=outcome)
+            else:
+                work.submit(delivery_urgency(order.delivery_date, now_moscow.date()), 'comment', order.id, obj=order)
+    elif PIPELINE_ENABLED:
+        comment_pipeline = build_comment_pipeline()
+        comment_pipeline.run(orders)
+        comment_pipeline.log_stats()
+        scanned = comment_pipeline.source_count
+    else:
+        scanned = 0
+        for order in orders:
+            scanned += 1
+            with profiler.span('process_order', cat='order', order_id=order.id) as span_args:
+                outcome = process_order(order)
+                span_args['outcome'] = outcome
+            metrics.inc('orders_processed', outcome=outcome)
+            if outcome == 'llm_unavailable':
+                defer_analysis(order)
+
+    metrics.inc('orders_scanned', scanned, block='comments')
+    if scanned:
+        logger.info("Обработано %s последних заказов.", scanned)
+    else:
+        logger.warning("Нет заказов для обработки или произошла ошибка при их получении. Завершение работы блока.")
+
+
+# --- ИЗМЕНЕННАЯ ФУНКЦИЯ main() ---
+
+def main(now_moscow: Optional[datetime] = None, budget_seconds: float = RUN_BUDGET_SECONDS):
+    """
+    Главная функция для запуска периодической обработки.
+    now_moscow позволяет запустить проверку «как будто» в заданное время (бенчмарки, отладка слотов).
+    budget_seconds > 0 включает обработку по срочности в пределах бюджета (см. scheduler.py).
+    """
+    metrics.METRICS.reset()
+    if run_locked(now_moscow, budget_seconds):
+        shadow.drain()
+        metrics.write_run_report()
+
+
+def run_lock() -> LeaseLock:
+    """
+    Блокировка обработки заказов шарда и тенанта. Её берут все, кто ставит задачи по заказам:
+    периодический запуск, worker приёмника триггеров и бэкфилл — иначе один заказ может
+    анализироваться параллельно и получить задачи дважды.
+    """
+    return LeaseLock(f"task_manager{tenant_suffix()}{shard_suffix()}")
+
+
+def run_locked(now_moscow: Optional[datetime] = None, budget_seconds: float = RUN_BUDGET_SECONDS) -> bool:
+    """
+    Запуск блоков под блокировкой с арендой: параллельный запуск того же шарда и тенанта
+    (затянувшийся cron, ручной запуск, второй хост) сразу завершается. Возвращает False,
+    если блокировка занята.
+    """
+    with run_lock() as acquired:
+        if not acquired:
+            logger.info("Другой запуск этого шарда уже выполняется (блокировка занята). Завершаю работу.")
+            return False
+        run_all_blocks(now_moscow, budget_seconds)
+        return True
+
+
+def run_tenants(tenant_list: List[Tenant], now_moscow: Optional[datetime] = None,
+                budget_seconds: float = RUN_BUDGET_SECONDS):
+    """
+    Обслуживает несколько аккаунтов/сайтов RetailCRM в одном процессе.
+    Каждый тенант работает в своём потоке со своим клиентом (пул соединений и бюджет запросов),
+    своими трекерами, журналом и блокировкой; метрики размечаются меткой tenant.
+    """
+    metrics.METRICS.reset()
+    if now_moscow is None:
+        now_moscow = clock.now(moscow_tz())
+
+    durations: Dict[str, float] = {}
+    completed: Dict[str, bool] = {}
+
+    def run_tenant(tenant: Tenant):
+        client = RetailCRMClient.for_tenant(tenant)
+        started = time.perf_counter()
+        try:
+            with use_tenant(tenant.name), use_client(client):
+                logger.info("=== Тенант %s (%s) ===", tenant.name, tenant.site_code)
+                completed[tenant.name] = run_locked(now_moscow, budget_seconds)
+        except Exception as e:
+            logger.error("❌ Ошибка при обработке тенанта %s: %s", tenant.name, e)
+            completed[tenant.name] = False
+        finally:
+            client.close()
+            durations[tenant.name] = time.perf_counter() - started
+
+    threads = [threading.Thread(target=run_tenant, args=(tenant,), name=f"tenant-{tenant.name}")
+               for tenant in tenant_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print_tenant_summary(tenant_list, durations, completed)
+    if any(completed.values()):
+        shadow.drain()
+        metrics.write_run_report()
+
+
+def print_tenant_summary(tenant_list: List[Tenant], durations: Dict[str, float], completed: Dict[str, bool]):
+    """Разбивка запуска по тенантам: длительность, запросы к CRM и LLM, ожидание бюджета, задачи."""
+    logger.info("Итоги по тенантам:")
+    for tenant in tenant_list:
+        name = tenant.name
+        status = 'ok' if completed.get(name) else 'пропущен/ошибка'
+        crm_requests = metrics.METRICS.counter_value('retailcrm_requests', tenant=name)
+        throttled = metrics.METRICS.histogram_sum('retailcrm_rate_limit_wait_seconds', tenant=name)
+        # Запросы теневого кандидата (lane=shadow) не относятся к работе запуска
+        llm_requests = (metrics.METRICS.counter_value('openai_requests', tenant=name)
+                        - metrics.METRICS.counter_value('openai_requests', tenant=name, lane='shadow'))
+        tasks = metrics.METRICS.counter_value('tasks_created', tenant=name)
+        logger.info("%-16s %7.2f с  CRM: %g запросов (ожидание лимита %.2f с)  LLM: %g  задач: %g  [%s]",
+                    name, durations.get(name, 0), crm_requests, throttled, llm_requests, tasks, status)
+
+
+def run_all_blocks(now_moscow: Optional[datetime] = None, budget_seconds: float = RUN_BUDGET_SECONDS):
+    """
+    Все блоки периодической обработки по порядку.
+    С бюджетом (или если от прошлого запуска осталась очередь) блоки только планируют работу,
+    а задачи и анализ комментариев выполняются затем по срочности, пока хватает бюджета.
+    """
+    logger.info("Запускаю периодическую проверку новых заказов...")
+    checkpoint.journal().start()
+
+    work = Scheduler(budget_seconds)
+    if budget_seconds > 0 or work.has_pending():
+        work.load_pending()
+        with use_scheduler(work):
+            run_blocks(now_moscow)
+        run_scheduled_work(work)
+    else:
+        # Без бюджета работа выполняется сразу; в очередь следующего запуска попадает только
+        # отложенный анализ (OpenAI недоступен или исчерпал лимиты, см. defer_analysis)
+        work.planning = False
+        with use_scheduler(work):
+            run_blocks(now_moscow)
+        work.save_carried()
+
+    logger.info("Обработка завершена.")
+    checkpoint.journal().finish()
+
+
+def run_blocks(now_moscow: Optional[datetime] = None):
+    """Блоки обработки по расписанию слотов."""
+    if now_moscow is None:
+        now_moscow = clock.now(moscow_tz())
+    current_time_str = now_moscow.strftime('%H:%M')
+    current_hour = now_moscow.hour
+    is_evening_run = current_hour == 21
+
+    # --- БЛОК 1: Проверка на "зависшие" статусы ---
+    with metrics.timed('block_seconds', block='status_trackers'):
+        process_status_trackers(now_moscow)
+
+    # --- БЛОК 2: РЕГЛАМЕНТ ДЛЯ ПРОПУЩЕННЫХ ЗВОНКОВ (12:00 и 16:00) ---
+    if current_hour == 12 or current_hour == 16:
+        with metrics.timed('block_seconds', block='ndz'):
+            run_ndz_block(now_moscow)
 
     # --- БЛОК 3: Проверки в 21:00 ---
     if is_evening_run:
         # Проверка не доставленных сегодня заказов
-        print(f"\n--- Запускаю проверку не доставленных заказов (Время: {current_time_str}) ---")
-        today_date_str = now_moscow.strftime('%Y-%m-%d')
-        undelivered_orders_data = get_orders_by_delivery_date(today_date_str)
-        if undelivered_orders_data:
-            undelivered_orders = undelivered_orders_data.get('orders', [])
-            print(f"Найдено {len(undelivered_orders)} заказов с доставкой на сегодня.")
-            process_undelivered_orders(undelivered_orders, now_moscow)
-        else:
-            print("Не найдено заказов с доставкой на сегодня.")
+        with metrics.timed('block_seconds', block='undelivered'):
+            run_undelivered_block(now_moscow)
 
         # Новая проверка заказов на завтра
-        process_evening_check(now_moscow)
+        with metrics.timed('block_seconds', block='evening_check'):
+            process_evening_check(now_moscow)
     else:
-        print(f"\n--- Вечерние проверки пропущены (Запуск в {current_time_str}) ---")
-
+        logger.info("--- Вечерние проверки пропущены (Запуск в %s) ---", current_time_str)
 
     # --- БЛОК 4: Обработка последних 50 заказов для анализа комментариев (ОСТАВЛЕНО) ---
-    print("\n--- Запускаю обработку последних 50 заказов для анализа комментариев ---")
+    with metrics.timed('block_seconds', block='comments'):
+        run_comment_block(now_moscow)
 
-    # Шаг 1: Получаем последние 50 заказов
-    orders_data = get_recent_orders(limit=50)
 
-    if not orders_data:
-        print("Ошибка при получении списка последних заказов. Завершение работы блока.")
-    else:
-        orders = orders_data.get('orders', [])
+def run_scheduled_work(work: Scheduler):
+    """Выполняет запланированные задачи и анализ комментариев по убыванию срочности."""
 
-        if not orders:
-            print("Нет новых заказов для обработки. Завершение работы блока.")
-        else:
-            print(f"Найдено {len(orders)} последних заказов.")
+    def prepare(items: List[WorkItem]):
+        # Заказы из очереди прошлого запуска получаем заново одним пакетом
+        missing = [item for item in items if item.kind == 'comment' and item.obj is None]
+        if missing:
+            fetched = get_orders_by_ids(item.order_id for item in missing)
+            for item in missing:
+                if item.order_id in fetched:
+                    item.obj = Order.from_api(fetched[item.order_id])
 
-            # Шаг 2: Обрабатываем каждый заказ из полученного списка
-            for order_data in orders:
-                process_order(order_data)
+    def run_task(item: WorkItem):
+        response = create_task_once(item.order_id, item.payload['step'],
+                                    refresh_task_datetime(item.payload['task_data']), flow=item.payload.get('flow'))
+        if response.get('success'):
+            logger.info("✅ Задача по заказу %s (%s) создана. ID: %s",
+                        item.order_id, item.payload['step'], response.get('id'))
+            advance_tracker(item.order_id, item.payload.get('progress'))
+        elif response.get('unavailable'):
+            # CRM недоступна: элемент остаётся в очереди следующего запуска
+            raise DependencyUnavailableError(f"RetailCRM недоступна: {response.get('error')}")
+        else:
+            # Ошибка CRM: планировщик повторит элемент в следующем запуске
+            raise RuntimeError(f"задача {item.payload['step']} не создана: {response}")
 
-    print("\nОбработка завершена.")
+    def run_digest(item: WorkItem):
+        step = item.payload['step']
+        orders = [entry for entry in item.payload['orders']
+                  if checkpoint.journal().get(entry['order_id'], step) is None]
+        if not orders:
+            logger.info("↩️ Сводная задача (%s) уже создана в этом запуске. Пропускаю.", step)
+            return
+        response = create_digest_task(item.payload['rule'], step, refresh_task_datetime(item.payload['task_data']),
+                                      orders, apply_progress=True)
+        if response.get('unavailable'):
+            raise DependencyUnavailableError(f"RetailCRM недоступна: {response.get('error')}")
+        if not response.get('success'):
+            raise RuntimeError(f"сводная задача {step} не создана: {response}")
+
+    def run_comment(item: WorkItem):
+        if item.obj is None:
+            if not current_client().breaker.available():
+                raise DependencyUnavailableError(f"RetailCRM недоступна, заказ {item.order_id} не получен")
+            logger.info("Заказ %s не получен из CRM. Пропускаю.", item.order_id)
+            return
+        with profiler.span('process_order', cat='order', order_id=item.order_id) as span_args:
+            outcome = process_order(item.obj)
+            span_args['outcome'] = outcome
+        if outcome == 'llm_unavailable':
+            raise LLMUnavailableError(f"анализ заказа {item.order_id} отложен")
+        metrics.inc('orders_processed', outcome=outcome)
+
+    with metrics.timed('block_seconds', block='scheduled_work'):
+        work.run({'task': run_task, 'digest': run_digest, 'comment': run_comment}, prepare=prepare)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Периодическая обработка заказов RetailCRM.")
+    parser.add_argument('--profile', action='store_true',
+                        help="записать трассу блоков и заказов в формате Chrome Trace / Perfetto")
+    parser.add_argument('--trace-file', default=profiler.TRACE_FILE,
+                        help=f"файл трассы для --profile (по умолчанию {profiler.TRACE_FILE})")
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help="дополнительно сохранить профиль cProfile всех потоков запуска в FILE "
+                             "(только вместе с --profile)")
+    parser.add_argument('--budget', type=float, default=RUN_BUDGET_SECONDS, metavar='SECONDS',
+                        help="бюджет запуска: обрабатывать работу по срочности и перенести остаток в следующий запуск")
+    parser.add_argument('--tenants', metavar='FILE', default=TENANTS_FILE or None,
+                        help="обслужить все аккаунты из файла конфигурации тенантов (по умолчанию TENANTS_FILE)")
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    main()
+    args = parse_args(sys.argv[1:])
+    if args.tenants:
+        entry_point = functools.partial(run_tenants, load_tenants(args.tenants), budget_seconds=args.budget)
+    else:
+        entry_point = functools.partial(main, budget_seconds=args.budget)
+    log.configure()
+    if args.profile:
+        profiler.run_profiled(entry_point, trace_file=args.trace_file, cprofile_file=args.cprofile)
+    else:
+        entry_point()
@@ -0,0 +1,252 @@
+# metrics.py
+
+import os
+import re
+import time
+import threading
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+import json_codec
+import profiler
+from settings import SETTINGS
+from sharding import shard_path
+from tenants import current_tenant
+
+logger = logging.getLogger(__name__)
+
+# Куда писать итоги запуска (у каждого шарда свои файлы). Пустое значение отключает отчёт.
+METRICS_JSON_FILE = shard_path(SETTINGS.metrics_json_file)
+# Файл для textfile-коллектора node_exporter (должен лежать в его --collector.textfile.directory)
+METRICS_PROM_FILE = shard_path(SETTINGS.metrics_prom_file)
+METRICS_PREFIX = 'taskmanager'
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Сколько последних наблюдений хранить для расчёта перцентилей
+MAX_SAMPLES = 10000
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+# Метки, которые получают все серии, записанные в контексте (например, lane=shadow у теневого кандидата)
+_CONTEXT_LABELS: ContextVar[Dict[str, str]] = ContextVar('metrics_context_labels', default={})
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _with_context(labels: Dict[str, Any]) -> Dict[str, Any]:
+    # В многотенантном запуске каждая серия получает метку tenant — видно, как делится запуск
+    tenant = current_tenant()
+    if tenant is not None and 'tenant' not in labels:
+        labels['tenant'] = tenant
+    for name, value in _CONTEXT_LABELS.get().items():
+        labels.setdefault(name, value)
+    return labels
+
+
+@contextmanager
+def labelled(**labels) -> Iterator[None]:
+    """Серии, записанные внутри блока (и в потоках, запущенных из него через copy_context), получают labels."""
+    token = _CONTEXT_LABELS.set({**_CONTEXT_LABELS.get(), **{k: str(v) for k, v in labels.items()}})
+    try:
+        yield
+    finally:
+        _CONTEXT_LABELS.reset(token)
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    """Перцентиль q (0..100) по списку наблюдений (метод ближайшего ранга)."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class Histogram:
+    """Гистограмма задержек: корзины, сумма, количество и окно последних наблюдений."""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.samples: List[float] = []
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+        self.samples.append(value)
+        if len(self.samples) > MAX_SAMPLES:
+            del self.samples[:len(self.samples) - MAX_SAMPLES]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'avg': round(self.sum / self.count, 6) if self.count else None,
+            'p50': percentile(self.samples, 50),
+            'p99': percentile(self.samples, 99),
+            'max': max(self.samples) if self.samples else None,
+        }
+
+
+class Metrics:
+    """Потокобезопасный реестр счётчиков, текущих значений (gauge) и гистограмм одного процесса."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self._started_monotonic = time.monotonic()
+            self.counters: Dict[str, Dict[LabelKey, float]] = {}
+            self.gauges: Dict[str, Dict[LabelKey, float]] = {}
+            self.histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _label_key(_with_context(labels))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """Записывает текущее значение величины (последнее записанное попадает в отчёт)."""
+        key = _label_key(_with_context(labels))
+        with self._lock:
+            self.gauges.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _label_key(_with_context(labels))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    @contextmanager
+    def timed(self, name: str, **labels):
+        """
+        Контекстный менеджер: записывает длительность блока в гистограмму name.
+        При включённой трассировке (--profile) блок также попадает в трассу как span.
+        """
+        span_name = ' '.join([name.replace('_seconds', '')] + [str(v) for v in labels.values()])
+        start = time.perf_counter()
+        try:
+            with profiler.span(span_name, cat=name, **labels):
+                yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter_value(self, name: str, **labels) -> float:
+        """Сумма счётчика по всем сериям, совпадающим с переданными метками."""
+        wanted = set(_label_key(labels))
+        with self._lock:
+            return sum(v for k, v in self.counters.get(name, {}).items() if wanted <= set(k))
+
+    def histogram_sum(self, name: str, **labels) -> float:
+        """Сумма наблюдений гистограммы по всем сериям, совпадающим с переданными метками."""
+        wanted = set(_label_key(labels))
+        with self._lock:
+            return sum(h.sum for k, h in self.histograms.get(name, {}).items() if wanted <= set(k))
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Итоги запуска в виде JSON-совместимого словаря."""
+        with self._lock:
+            return {
+                'started_at': self.started_at,
+                'duration_seconds': round(time.monotonic() - self._started_monotonic, 6),
+                'counters': {
+                    name: [{'labels': dict(k), 'value': v} for k, v in sorted(series.items())]
+                    for name, series in sorted(self.counters.items())
+                },
+                'gauges': {
+                    name: [{'labels': dict(k), 'value': v} for k, v in sorted(series.items())]
+                    for name, series in sorted(self.gauges.items())
+                },
+                'histograms': {
+                    name: [{'labels': dict(k), **h.summary()} for k, h in sorted(series.items())]
+                    for name, series in sorted(self.histograms.items())
+                },
+            }
+
+    def to_prometheus(self) -> str:
+        """Текущее состояние в текстовом формате Prometheus (значения относятся к последнему запуску)."""
+
+        def fmt_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+            pairs = list(key) + ([extra] if extra else [])
+            if not pairs:
+                return ''
+            escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+            return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+        lines = []
+        with self._lock:
+            run_name = f'{METRICS_PREFIX}_last_run'
+            lines.append(f'# TYPE {run_name}_timestamp_seconds gauge')
+            lines.append(f'{run_name}_timestamp_seconds {self.started_at:.3f}')
+            lines.append(f'# TYPE {run_name}_duration_seconds gauge')
+            lines.append(f'{run_name}_duration_seconds {time.monotonic() - self._started_monotonic:.6f}')
+
+            for name, series in sorted({**self.counters, **self.gauges}.items()):
+                metric = f'{METRICS_PREFIX}_{name}'
+                lines.append(f'# TYPE {metric} gauge')
+                for key, value in sorted(series.items()):
+                    lines.append(f'{metric}{fmt_labels(key)} {value:g}')
+
+            for name, series in sorted(self.histograms.items()):
+                metric = f'{METRICS_PREFIX}_{name}'
+                lines.append(f'# TYPE {metric} histogram')
+                for key, hist in sorted(series.items()):
+                    for bound, count in zip(hist.buckets, hist.bucket_counts):
+                        lines.append(f'{metric}_bucket{fmt_labels(key, ("le", f"{bound:g}"))} {count}')
+                    lines.append(f'{metric}_bucket{fmt_labels(key, ("le", "+Inf"))} {hist.count}')
+                    lines.append(f'{metric}_sum{fmt_labels(key)} {hist.sum:.6f}')
+                    lines.append(f'{metric}_count{fmt_labels(key)} {hist.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _write_atomically(path: str, content: str):
+    # Пишем во временный файл и переименовываем: node_exporter не должен увидеть файл наполовину
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+METRICS = Metrics()
+
+inc = METRICS.inc
+set_gauge = METRICS.set_gauge
+observe = METRICS.observe
+timed = METRICS.timed
+
+
+def endpoint_label(endpoint: str) -> str:
+    """Нормализует endpoint для метки: 'orders/123/edit' -> 'orders/{id}/edit'."""
+    return re.sub(r'/\d+(?=/|$)', '/{id}', endpoint)
+
+
+def write_run_report(json_path: str = METRICS_JSON_FILE, prom_path: str = METRICS_PROM_FILE):
+    """Пишет JSON-сводку запуска и textfile для node_exporter."""
+    if json_path:
+        try:
+            _write_atomically(json_path, json_codec.dumps(METRICS.snapshot(), indent=True))
+            logger.info("Сводка метрик запуска сохранена в %s.", json_path)
+        except IOError as e:
+            logger.error("Ошибка при записи сводки метрик в %s: %s", json_path, e)
+    if prom_path:
+        try:
+            _write_atomically(prom_path, METRICS.to_prometheus())
+            logger.info("Метрики Prometheus сохранены в %s.", prom_path)
+        except IOError as e:
+            logger.error("Ошибка при записи метрик Prometheus в %s: %s", prom_path, e)
@@ -0,0 +1,58 @@
+# models.py
+
+from dataclasses import dataclass, field
+from typing import Dict, Any, Optional, List
+
+
+@dataclass(slots=True)
+class Order:
+    """
+    Компактная запись заказа: только поля, которые используют блоки обработки.
+    Декодируется один раз из ответа API (Order.from_api), остальное дерево заказа
+    (товары, клиент, доставка целиком) не хранится. Полный payload доступен через
+    свойство payload: он либо сохранён при декодировании (keep_payload=True),
+    либо догружается из CRM при первом обращении.
+    """
+    id: int
+    number: Optional[str] = None
+    manager_id: Optional[int] = None
+    status: Optional[str] = None
+    order_method: Optional[str] = None
+    manager_comment: str = ''
+    delivery_code: Optional[str] = None
+    delivery_date: Optional[str] = None
+    status_updated_at: Optional[str] = None
+    _payload: Optional[Dict[str, Any]] = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def from_api(cls, data: Dict[str, Any], keep_payload: bool = False) -> 'Order':
+        """Создаёт запись из JSON-объекта заказа RetailCRM."""
+        delivery = data.get('delivery') or {}
+        return cls(
+            id=data['id'],
+            number=data.get('number'),
+            manager_id=data.get('managerId'),
+            status=data.get('status'),
+            order_method=data.get('orderMethod'),
+            manager_comment=data.get('managerComment') or '',
+            delivery_code=delivery.get('code'),
+            delivery_date=delivery.get('date'),
+            status_updated_at=data.get('statusUpdatedAt'),
+            _payload=data if keep_payload else None,
+        )
+
+    @property
+    def payload(self) -> Dict[str, Any]:
+        """Полный JSON заказа; при необходимости запрашивается из CRM один раз."""
+        if self._payload is None:
+            # Импорт здесь, чтобы модель не зависела от клиента API при загрузке модуля
+            from retailcrm_api import get_orders_by_ids
+            self._payload = get_orders_by_ids([self.id]).get(str(self.id), {})
+        return self._payload
+
+
+def decode_orders(data: Optional[Dict[str, Any]]) -> List[Order]:
+    """Декодирует список 'orders' из ответа API в записи Order."""
+    if not data:
+        return []
+    return [Order.from_api(order) for order in data.get('orders') or []]
@@ -1,28 +1,243 @@
-import os
-import openai
-import json
 import re
-from datetime import datetime
-from dotenv import load_dotenv
-from typing import List, Dict, Any
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import List, Dict, Any, Iterator, Optional
 
-load_dotenv()
+import clock
+import json_codec
+import metrics
+from circuit_breaker import CircuitBreaker, CircuitOpenError, DependencyUnavailableError
+from llm_scheduler import LLMRateScheduler, estimate_tokens
+from settings import SETTINGS
 
-# Устанавливаем ключ API из переменных окружения
-openai.api_key = os.getenv('OPENAI_API_KEY')
+logger = logging.getLogger(__name__)
 
+# Таймаут одного запроса к OpenAI, секунды (по умолчанию у клиента — 10 минут)
+OPENAI_REQUEST_TIMEOUT = SETTINGS.openai_request_timeout
+# Предохранитель OpenAI: при недоступности API анализ сразу откладывается, без ожидания таймаутов
+OPENAI_BREAKER = CircuitBreaker('openai')
+# Попыток на один анализ при 429 (между попытками — пауза по retry-after)
+OPENAI_MAX_ATTEMPTS = SETTINGS.openai_max_attempts
+# Очередь запросов в пределах RPM/TPM аккаунта
+LLM_SCHEDULER = LLMRateScheduler()
 
-def analyze_comment_with_openai(comment: str) -> List[Dict[str, Any]]:
+# Уровни анализа: локальный разбор без запроса, дешёвая модель, сильная модель для сложных записей
+TIER_LOCAL = 'local'
+TIER_CHEAP = 'cheap'
+TIER_STRONG = 'strong'
+# Модель задана явно (оценка экстрактора, теневой режим), без выбора уровня
+TIER_PINNED = 'pinned'
+LLM_LOCAL_TIER = SETTINGS.llm_local_tier
+LLM_CHEAP_MODEL = SETTINGS.llm_cheap_model
+LLM_STRONG_MODEL = SETTINGS.llm_strong_model
+# Оценка сложности, начиная с которой записи уходят в сильную модель
+LLM_STRONG_THRESHOLD = SETTINGS.llm_strong_threshold
+# Символов текста на один балл сложности
+COMPLEXITY_CHARS_PER_POINT = 200
+# Цена моделей, USD за 1M токенов (промпт, ответ); для моделей не из списка стоимость не считается
+MODEL_PRICES_PER_1M = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4.1-mini': (0.40, 1.60),
+    'gpt-4.1-nano': (0.10, 0.40),
+    'gpt-4.1': (2.00, 8.00),
+}
+
+# Дата DD.MM или DD/MM (кандидат в строку задачи) и строка строгого формата «ДАТА - ДЕЙСТВИЕ»
+_DATE = r'(?<![\d.,/])\d{1,2}[./]\d{1,2}(?:[./]\d{2,4})?(?!\d)'
+DATE_TOKEN_RE = re.compile(_DATE)
+STRICT_TASK_RE = re.compile(_DATE + r'\s*[-–—]\s*\S')
+# Относительные даты и дни недели: модель должна понять, что такие записи не подходят
+AMBIGUOUS_RE = re.compile(
+    r'завтра|сегодня|через\s+\d|на\s+(?:след|эт)\w*\s+недел'
+    r'|понедельник|вторник|сред[ауы]|четверг|пятниц|суббот|воскресень',
+    re.IGNORECASE)
+
+
+class LLMUnavailableError(DependencyUnavailableError):
+    """
+    Анализ не выполнен из-за недоступности OpenAI (ошибка API или разомкнутый предохранитель).
+    Это не «задач не найдено»: заказ нужно проанализировать в следующий раз, а не ставить задачу-заглушку.
+    """
+
+
+class LLMRateLimitedError(LLMUnavailableError):
+    """Лимит запросов/токенов аккаунта исчерпан дольше, чем запрос может ждать."""
+
+
+@dataclass(frozen=True)
+class LLMLane:
+    """Отдельные предохранитель и очередь RPM/TPM для трафика, который не должен влиять на рабочий путь."""
+    breaker: CircuitBreaker
+    scheduler: LLMRateScheduler
+
+
+@dataclass(frozen=True)
+class Route:
+    """Куда отправлен анализ записей: уровень, модель (None для локального разбора) и оценка сложности."""
+    tier: str
+    model: Optional[str]
+    score: float
+
+
+def comment_complexity(comment: str) -> float:
+    """
+    Оценка сложности записей: длина текста, число строк с датами и признаки неоднозначности —
+    даты вне строгого формата, несколько дат в строке, относительные даты.
     """
-    Отправляет комментарий на анализ в OpenAI и возвращает список найденных задач
-    в виде JSON-объектов.
+    score = len(comment) / COMPLEXITY_CHARS_PER_POINT
+    for line in comment.split('\n'):
+        dates = len(DATE_TOKEN_RE.findall(line))
+        if not dates:
+            continue
+        score += 1
+        if not STRICT_TASK_RE.search(line):
+            score += 1
+        score += dates - 1
+    score += len(AMBIGUOUS_RE.findall(comment))
+    return score
+
+
+def route_comment(comment: str) -> Route:
     """
+    Выбирает уровень анализа. Без единой строки строгого формата «ДАТА - ДЕЙСТВИЕ» ответ модели
+    по правилам промпта — пустой список, поэтому он получается локально, без запроса.
+    """
+    score = comment_complexity(comment)
+    if LLM_LOCAL_TIER and not STRICT_TASK_RE.search(comment):
+        return Route(TIER_LOCAL, None, score)
+    if score >= LLM_STRONG_THRESHOLD:
+        return Route(TIER_STRONG, LLM_STRONG_MODEL, score)
+    return Route(TIER_CHEAP, LLM_CHEAP_MODEL, score)
+
+
+def request_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Стоимость запроса в USD по MODEL_PRICES_PER_1M (0 для неизвестной модели)."""
+    prompt_price, completion_price = MODEL_PRICES_PER_1M.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+_USAGE: ContextVar[Optional[Dict[str, int]]] = ContextVar('llm_usage', default=None)
+# None — рабочий путь: OPENAI_BREAKER и LLM_SCHEDULER
+_LANE: ContextVar[Optional[LLMLane]] = ContextVar('llm_lane', default=None)
+
+
+@contextmanager
+def use_lane(lane: LLMLane) -> Iterator[LLMLane]:
+    """Анализы внутри блока идут через предохранитель и очередь lane, а не рабочего пути."""
+    token = _LANE.set(lane)
+    try:
+        yield lane
+    finally:
+        _LANE.reset(token)
+
+
+def _breaker() -> CircuitBreaker:
+    lane = _LANE.get()
+    return lane.breaker if lane is not None else OPENAI_BREAKER
+
+
+def _scheduler() -> LLMRateScheduler:
+    lane = _LANE.get()
+    return lane.scheduler if lane is not None else LLM_SCHEDULER
+
+
+@contextmanager
+def track_usage() -> Iterator[Dict[str, int]]:
+    """
+    Считает запросы и токены анализов, выполненных в этом контексте (и в потоках,
+    запущенных через contextvars.copy_context()): {'requests', 'prompt_tokens', 'completion_tokens'}.
+    """
+    usage = {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+    token = _USAGE.set(usage)
+    try:
+        yield usage
+    finally:
+        _USAGE.reset(token)
+
+
+def _openai():
+    """
+    Модуль openai импортируется при первом анализе: его импорт — самая дорогая часть старта процесса,
+    а запуски без анализа комментариев (НДЗ в 16:00, вечерняя проверка) его не используют.
+    Ключ берётся из настроек, если он не задан явно (например, бенчмарком).
+    """
+    import openai
     if not openai.api_key:
-        print("Ошибка: Ключ OpenAI API не установлен.")
-        return []
+        openai.api_key = SETTINGS.openai_api_key
+    # Повторы после 429 и пауз по лимитам выполняет LLM_SCHEDULER, а не клиент
+    openai.max_retries = 0
+    return openai
+
+
+def _create_completion(openai, model: str, messages: List[Dict[str, Any]], reserved_tokens: int):
+    """
+    Отправляет запрос в пределах RPM/TPM: ждёт бюджета, синхронизирует лимиты по заголовкам ответа,
+    после 429 ставит отправку на паузу и повторяет. Исчерпанные лимиты — LLMRateLimitedError.
+    """
+    scheduler = _scheduler()
+    for attempt in range(1, OPENAI_MAX_ATTEMPTS + 1):
+        if not scheduler.reserve(reserved_tokens):
+            raise LLMRateLimitedError(
+                f"Лимит OpenAI: бюджет запросов/токенов не освободился за {scheduler.max_wait_seconds:.0f} с")
+        try:
+            with metrics.timed('openai_request_seconds', model=model):
+                raw_response = openai.chat.completions.with_raw_response.create(
+                    model=model,
+                    timeout=OPENAI_REQUEST_TIMEOUT,
+                    response_format={"type": "json_object"},
+                    messages=messages
+                )
+        except openai.RateLimitError as e:
+            if e.code == 'insufficient_quota':
+                # Закончилась квота, а не минутный лимит: ожидание не поможет
+                raise
+            scheduler.sync(e.response.headers)
+            delay = scheduler.retry_delay(e.response.headers)
+            scheduler.pause(delay)
+            metrics.inc('openai_throttled', reason='429')
+            logger.warning("⏳ OpenAI ответил 429 (попытка %s из %s), пауза %.1f с.",
+                           attempt, OPENAI_MAX_ATTEMPTS, delay)
+            continue
+        scheduler.sync(raw_response.headers)
+        return raw_response.parse()
+    raise LLMRateLimitedError(f"Лимит OpenAI: запрос отклонён {OPENAI_MAX_ATTEMPTS} раз подряд (429)")
+
+
+def analyze_comment_with_openai(comment: str, model: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Анализирует записи комментария и возвращает список найденных задач в виде JSON-объектов.
+    Простые записи разбираются локально или дешёвой моделью, сложные — сильной (см. route_comment);
+    с явным model все записи уходят в эту модель.
+    Если OpenAI недоступен или лимиты аккаунта исчерпаны — LLMUnavailableError:
+    пустой список означает только «задач не найдено».
+    """
+    route = Route(TIER_PINNED, model, comment_complexity(comment)) if model else route_comment(comment)
+    metrics.inc('llm_tier_requests', tier=route.tier)
+    logger.debug("Уровень анализа: %s (%s), сложность %.1f", route.tier, route.model or '-', route.score)
+    with metrics.timed('llm_tier_seconds', tier=route.tier):
+        if route.tier == TIER_LOCAL:
+            return []
+        return _analyze_with_model(comment, route)
+
+
+def _analyze_with_model(comment: str, route: Route) -> List[Dict[str, Any]]:
+    """Отправляет записи на анализ в модель route.model."""
+    model = route.model
+    openai = _openai()
+    if not openai.api_key:
+        raise LLMUnavailableError("Ключ OpenAI API не установлен.")
+
+    breaker, scheduler = _breaker(), _scheduler()
+    try:
+        breaker.before_call()
+    except CircuitOpenError as e:
+        raise LLMUnavailableError(str(e)) from None
 
     # Получаем текущие дату и время для промпта
-    current_datetime_str = datetime.now().strftime("%Y-%m-%d %H:%M")
+    current_datetime_str = clock.now().strftime("%Y-%m-%d %H:%M")
 
     system_prompt = f"""
 Ты — продвинутый ассистент, CRM-менеджер-помощник. Твоя единственная задача — анализировать комментарии и извлекать из них **только будущие задачи для менеджеров по продажам**, которые соответствуют **СТРОГОМУ ФОРМАТУ**.
@@ -37,7 +252,7 @@ def analyze_comment_with_openai(comment: str) -> List[Dict[str, Any]]:
     -   Текущие статусы заказа ("дубль", "закрыл", "направлено кп").
     -   Задачи для других отделов (логистика, курьеры).
     -   Любые записи, не соответствующие формату "ДАТА - ДЕЙСТВИЕ".
-3.  **Год**: Для всех дат используй текущий год (`{datetime.now().year}`), если год не указан в тексте.
+3.  **Год**: Для всех дат используй текущий год (`{clock.now().year}`), если год не указан в тексте.
 4.  **Время**: Если в тексте не указано конкретное время, используй текущее время `{current_datetime_str}` и прибавь один час.
     **Важное правило:** Если итоговое время получается после 20:00, перенеси задачу на следующий день на 10:00.
 5.  **Слова-синонимы**: Слово "кас" является сокращением от "касание".
@@ -149,15 +364,26 @@ def analyze_comment_with_openai(comment: str) -> List[Dict[str, Any]]:
 
 Твой ответ должен содержать только один JSON-объект, который является массивом.
 """
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": comment}
+    ]
+    reserved_tokens = estimate_tokens(messages, scheduler.completion_estimate())
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            response_format={"type": "json_object"},
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": comment}
-            ]
-        )
+        response = _create_completion(openai, model, messages, reserved_tokens)
+        breaker.record_success()
+        metrics.inc('openai_requests', model=model, outcome='ok')
+        if response.usage is not None:
+            metrics.inc('openai_tokens', response.usage.prompt_tokens, type='prompt')
+            metrics.inc('openai_tokens', response.usage.completion_tokens, type='completion')
+            metrics.inc('llm_cost_usd', request_cost(model, response.usage.prompt_tokens,
+                                                     response.usage.completion_tokens), tier=route.tier)
+            usage = _USAGE.get()
+            if usage is not None:
+                usage['requests'] += 1
+                usage['prompt_tokens'] += response.usage.prompt_tokens
+                usage['completion_tokens'] += response.usage.completion_tokens
+            scheduler.settle(reserved_tokens, response.usage.prompt_tokens, response.usage.completion_tokens)
 
         raw_content = response.choices[0].message.content
 
@@ -165,13 +391,10 @@ def analyze_comment_with_openai(comment: str) -> List[Dict[str, Any]]:
         if raw_content is None:
             raw_content = ""
 
-        print(f"Сырой ответ от OpenAI: ```json\n{raw_content}\n```")
-
-        # Удаляем лишние символы из ответа, если они есть
-        clean_content = re.sub(r'```json\n|```', '', raw_content).strip()
+        logger.debug("Сырой ответ от OpenAI: ```json\n%s\n```", raw_content)
 
-        # Загружаем JSON-данные
-        parsed_data = json.loads(clean_content)
+        # Один вызов разбора: обёртка ```json ... ``` отбрасывается срезом по скобкам
+        parsed_data = json_codec.parse_llm_json(raw_content)
 
         if isinstance(parsed_data, list):
             return [item for item in parsed_data if item.get('task') and item.get('date_time')]
@@ -186,12 +409,24 @@ def analyze_comment_with_openai(comment: str) -> List[Dict[str, Any]]:
             else:
                 return []
         else:
-            print("Ошибка: Неожиданный формат ответа от OpenAI.")
+            logger.error("Ошибка: Неожиданный формат ответа от OpenAI.")
             return []
 
-    except json.JSONDecodeError as e:
-        print(f"Ошибка декодирования JSON: {e}. Сырой контент: {clean_content}")
+    except json_codec.JSONDecodeError as e:
+        logger.error("Ошибка декодирования JSON: %s. Сырой контент: %s", e, raw_content)
         return []
+    except LLMRateLimitedError:
+        breaker.release()
+        raise
     except openai.APIError as e:
-        print(f"Ошибка при запросе к OpenAI API: {e}")
-        return []
\ No newline at end of file
+        metrics.inc('openai_requests', model=model, outcome='error')
+        logger.error("Ошибка при запросе к OpenAI API: %s", e)
+        if isinstance(e, openai.BadRequestError):
+            # Ошибка в самом запросе, сервис доступен: повтор не поможет
+            breaker.record_success()
+            return []
+        breaker.record_failure()
+        raise LLMUnavailableError(f"Ошибка при запросе к OpenAI API: {e}") from e
+    except BaseException:
+        breaker.release()
+        raise
\ No newline at end of file
@@ -0,0 +1,148 @@
+# pipeline.py
+
+import time
+import queue
+import threading
+import contextvars
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Маркер конца потока элементов между стадиями
+_END = object()
+
+
+@dataclass
+class Stage:
+    """
+    Стадия конвейера. func получает элемент и возвращает элемент для следующей стадии
+    или None, если дальше элемент не идёт (отфильтрован или стадия последняя).
+    workers — число потоков стадии, queue_size — размер входной очереди стадии.
+    """
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+    queue_size: int = 20
+    processed: int = 0
+    passed: int = 0
+    errors: int = 0
+    busy_seconds: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, seconds: float, passed: bool, failed: bool = False):
+        with self._lock:
+            self.processed += 1
+            self.busy_seconds += seconds
+            if passed:
+                self.passed += 1
+            if failed:
+                self.errors += 1
+
+
+class Pipeline:
+    """
+    Конвейер из стадий, соединённых ограниченными очередями.
+    Каждая стадия работает в своих потоках; когда очередь следующей стадии заполнена,
+    предыдущая ждёт (backpressure), поэтому быстрые стадии не накапливают неограниченный хвост.
+    """
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+        self.source_count = 0
+        self.elapsed_seconds = 0.0
+
+    def _worker(self, index: int, finished: List[int], finished_lock: threading.Lock):
+        stage = self.stages[index]
+        inbox = self.queues[index]
+        outbox = self.queues[index + 1] if index + 1 < len(self.stages) else None
+
+        while True:
+            item = inbox.get()
+            if item is _END:
+                break
+
+            started = time.perf_counter()
+            try:
+                result = stage.func(item)
+                failed = False
+            except Exception as e:
+                logger.error("❌ Ошибка на стадии '%s': %s", stage.name, e)
+                result, failed = None, True
+            seconds = time.perf_counter() - started
+
+            stage.record(seconds, passed=result is not None, failed=failed)
+            metrics.observe('pipeline_stage_seconds', seconds, stage=stage.name)
+            metrics.inc('pipeline_stage_items', stage=stage.name,
+                        result='error' if failed else ('passed' if result is not None else 'done'))
+
+            if result is not None and outbox is not None:
+                outbox.put(result)
+
+        # Последний завершившийся поток стадии закрывает очередь следующей стадии
+        with finished_lock:
+            finished[index] += 1
+            last = finished[index] == stage.workers
+        if last and outbox is not None:
+            for _ in range(self.stages[index + 1].workers):
+                outbox.put(_END)
+
+    def run(self, source: Iterable[Any]) -> Dict[str, Dict[str, Any]]:
+        """Прогоняет все элементы source через стадии и возвращает статистику по стадиям."""
+        finished = [0] * len(self.stages)
+        finished_lock = threading.Lock()
+        # Потоки стадий работают в копии контекста вызывающего потока (текущий тенант, клиент CRM)
+        threads = [
+            threading.Thread(target=contextvars.copy_context().run,
+                             args=(self._worker, index, finished, finished_lock),
+                             name=f"{stage.name}-{n + 1}", daemon=True)
+            for index, stage in enumerate(self.stages)
+            for n in range(stage.workers)
+        ]
+
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            for item in source:
+                self.source_count += 1
+                self.queues[0].put(item)
+        finally:
+            for _ in range(self.stages[0].workers):
+                self.queues[0].put(_END)
+            for thread in threads:
+                thread.join()
+        self.elapsed_seconds = time.perf_counter() - started
+        return self.stats()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Пропускная способность и загрузка каждой стадии."""
+        result = {}
+        for stage in self.stages:
+            result[stage.name] = {
+                'workers': stage.workers,
+                'processed': stage.processed,
+                'passed': stage.passed,
+                'errors': stage.errors,
+                'busy_seconds': round(stage.busy_seconds, 3),
+                'items_per_second': round(stage.processed / self.elapsed_seconds, 2) if self.elapsed_seconds else None,
+                # Доля времени, когда потоки стадии были заняты: близко к 1 — стадия узкое место
+                'utilization': round(stage.busy_seconds / (self.elapsed_seconds * stage.workers), 2)
+                if self.elapsed_seconds else None,
+            }
+        return result
+
+    def log_stats(self):
+        """Статистика стадий в журнал процесса; в JSON-формате поля стадии идут отдельными ключами."""
+        logger.info("Конвейер: %s элементов за %.2f с.", self.source_count, self.elapsed_seconds,
+                    extra={'pipeline_items': self.source_count, 'pipeline_seconds': round(self.elapsed_seconds, 3)})
+        for name, stats in self.stats().items():
+            logger.info("%-10s потоков: %-3s обработано: %-5s передано дальше: %-5s ошибок: %-3s "
+                        "%.2f/с, загрузка %.0f%%",
+                        name, stats['workers'], stats['processed'], stats['passed'], stats['errors'],
+                        stats['items_per_second'] or 0, (stats['utilization'] or 0) * 100,
+                        extra={'stage': name, 'stage_stats': stats})
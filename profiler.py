@@ -0,0 +1,168 @@
+# profiler.py
+
+import os
+import time
+import pstats
+import cProfile
+import threading
+import logging
+from contextlib import contextmanager
+from typing import Dict, Any, List, Callable, Optional
+
+import json_codec
+
+logger = logging.getLogger(__name__)
+
+TRACE_FILE = 'trace.json'
+
+
+class Tracer:
+    """
+    Сборщик временных отрезков (span) в формате Chrome Trace Event.
+    Файл открывается в chrome://tracing или https://ui.perfetto.dev.
+    Пока трассировка не включена, span() ничего не записывает.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._events: List[Dict[str, Any]] = []
+        self._thread_names: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def enable(self):
+        with self._lock:
+            self.enabled = True
+            self._events = []
+            self._thread_names = {}
+            self._origin = time.perf_counter()
+
+    @contextmanager
+    def span(self, name: str, cat: str = 'run', **args):
+        """
+        Записывает отрезок времени выполнения блока.
+        Возвращает словарь args: в него можно дописать теги по ходу выполнения (например, outcome).
+        """
+        if not self.enabled:
+            yield args
+            return
+
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            thread = threading.current_thread()
+            event = {
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': round((start - self._origin) * 1e6, 3),
+                'dur': round((end - start) * 1e6, 3),
+                'pid': os.getpid(),
+                'tid': thread.ident,
+                'args': {k: v if isinstance(v, (int, float, bool)) or v is None else str(v) for k, v in args.items()},
+            }
+            with self._lock:
+                self._events.append(event)
+                self._thread_names.setdefault(thread.ident, thread.name)
+
+    def counter(self, name: str, cat: str = 'run', **values):
+        """Записывает значения счётчика (в Perfetto — график величины во времени)."""
+        if not self.enabled:
+            return
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'C',
+            'ts': round((time.perf_counter() - self._origin) * 1e6, 3),
+            'pid': os.getpid(),
+            'args': values,
+        }
+        with self._lock:
+            self._events.append(event)
+
+    def write_chrome_trace(self, path: str = TRACE_FILE):
+        """Сохраняет собранные отрезки в JSON-файл формата Chrome Trace."""
+        with self._lock:
+            metadata = [
+                {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                for tid, name in self._thread_names.items()
+            ]
+            trace = {'traceEvents': metadata + self._events, 'displayTimeUnit': 'ms'}
+        try:
+            json_codec.dump_file(path, trace)
+            logger.info("Трасса запуска (%s событий) сохранена в %s.", len(trace['traceEvents']), path)
+        except IOError as e:
+            logger.error("Ошибка при записи трассы в %s: %s", path, e)
+
+
+TRACER = Tracer()
+span = TRACER.span
+counter = TRACER.counter
+
+
+class ThreadProfiles:
+    """
+    cProfile по всем потокам: профиль вызывающего потока и отдельный профиль каждого потока,
+    запущенного во время профилирования (стадии конвейера, воркеры планировщика, пулы запросов).
+    Профиль потока включается при первом событии в нём через threading.setprofile; в конце
+    профили объединяются в один файл.
+    """
+
+    def __init__(self):
+        self._profiles: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+        self._failed = False
+
+    def _start_in_thread(self, frame, event, arg):
+        profile = cProfile.Profile()
+        try:
+            # enable() заменяет эту функцию собственным обработчиком профиля потока
+            profile.enable()
+        except ValueError:
+            # Python 3.12+: cProfile может быть активен только один на процесс
+            threading.setprofile(None)
+            self._failed = True
+            return
+        with self._lock:
+            self._profiles.append(profile)
+
+    def start(self):
+        main = cProfile.Profile()
+        main.enable()
+        self._profiles.append(main)
+        threading.setprofile(self._start_in_thread)
+
+    def stop(self, path: str):
+        threading.setprofile(None)
+        with self._lock:
+            main, *workers = self._profiles
+        main.disable()
+        stats = pstats.Stats(main)
+        for profile in workers:
+            stats.add(profile)
+        stats.dump_stats(path)
+        if self._failed:
+            logger.warning("Профиль %s содержит только вызывающий поток: в этой версии Python cProfile "
+                           "нельзя включить в нескольких потоках сразу.", path)
+        logger.info("Профиль cProfile (%s потоков) сохранён в %s.", 1 + len(workers), path)
+
+
+def run_profiled(func: Callable[[], Any], trace_file: str = TRACE_FILE, cprofile_file: Optional[str] = None):
+    """
+    Выполняет func с включённой трассировкой и сохраняет трассу в trace_file.
+    Если задан cprofile_file, дополнительно снимает профиль cProfile по всем потокам запуска
+    (смотреть через snakeviz / pstats).
+    """
+    TRACER.enable()
+    profiles = ThreadProfiles() if cprofile_file else None
+    try:
+        if profiles:
+            profiles.start()
+        with span('run', cat='run'):
+            return func()
+    finally:
+        if profiles:
+            profiles.stop(cprofile_file)
+        TRACER.write_chrome_trace(trace_file)
@@ -1,37 +1,414 @@
 # retailcrm_api.py
 
-import os
+import time
+import threading
+import contextvars
 import requests
-import json
-from dotenv import load_dotenv
-from typing import Dict, Any, Optional, List
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from typing import Dict, Any, Optional, List, Iterable, Iterator, Tuple
+
+import json_codec
+import log
+import metrics
+import profiler
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from models import Order
+from settings import SETTINGS
+
+try:
+    import ijson
+except ImportError:  # потоковый разбор необязателен: без ijson страница разбирается целиком
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+RETAILCRM_BASE_URL = SETTINGS.retailcrm_base_url
+RETAILCRM_API_KEY = SETTINGS.retailcrm_api_key
+RETAILCRM_SITE_CODE = SETTINGS.retailcrm_site_code
+
+REQUEST_TIMEOUT = SETTINGS.retailcrm_request_timeout  # seconds
+
+# Лимит страницы RetailCRM (допустимые значения: 20, 50, 100)
+PAGE_LIMIT = 100
+# Бюджет на длину query-строки с фильтром по ID, чтобы не упереться в лимиты URL
+MAX_IDS_QUERY_LENGTH = 1500
+# Одновременных запросов к одному аккаунту: начальный предел и потолок адаптивного предела.
+# Потолок также задаёт размер пула соединений и число потоков пакетной загрузки заказов.
+INITIAL_CONCURRENCY = SETTINGS.retailcrm_initial_concurrency
+MAX_CONCURRENCY = SETTINGS.retailcrm_max_concurrency
+# Во сколько раз задержка ответа должна превысить обычную для эндпоинта, чтобы считаться всплеском
+LATENCY_SPIKE_FACTOR = SETTINGS.retailcrm_latency_spike_factor
+# Всплески меньше этой величины (секунды) не учитываются: это шум, а не перегрузка
+MIN_LATENCY_SPIKE_SECONDS = 0.05
+
+# Разбирать страницы заказов потоково (нужен пакет ijson)
+STREAM_ORDERS = SETTINGS.retailcrm_stream_orders
+
+# Ошибки разбора ответа, которые означают оборванную или битую страницу
+_DECODE_ERRORS = (json_codec.JSONDecodeError, ValueError, Urllib3HTTPError) + ((ijson.JSONError,) if ijson else ())
+
+# Бюджет запросов в секунду на один аккаунт (RetailCRM ограничивает частоту запросов по API-ключу);
+# 0 — без ограничения на стороне клиента
+RATE_LIMIT = SETTINGS.retailcrm_rate_limit
+
+
+class RateLimiter:
+    """Token bucket: в среднем не больше rate запросов в секунду, всплеск — до burst запросов."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Ждёт, пока в бюджете появится запрос."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            metrics.observe('retailcrm_rate_limit_wait_seconds', waited)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Адаптивный предел одновременных запросов к аккаунту (AIMD).
+
+    Пока задержки ответов стабильны и предел используется полностью, он растёт примерно на 1
+    за каждый «оборот» запросов (+1/limit на каждый ответ). На 429/503, таймаут или всплеск задержки
+    (в LATENCY_SPIKE_FACTOR раз выше обычной для эндпоинта) предел уменьшается вдвое — не чаще
+    одного раза за обычную задержку, чтобы ответы на уже отправленные запросы не обрушили его до минимума.
+    Так число одновременных запросов само устанавливается на уровне, который выдерживает CRM.
+    """
+
+    def __init__(self, initial: int = INITIAL_CONCURRENCY, max_limit: int = MAX_CONCURRENCY,
+                 min_limit: int = 1, spike_factor: float = LATENCY_SPIKE_FACTOR):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial, min_limit), self.max_limit))
+        self.spike_factor = spike_factor
+        self.min_seen = self.max_seen = self.limit
+        self._in_flight = 0
+        self._baseline: Dict[str, float] = {}  # Обычная задержка по эндпоинтам (EWMA)
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def in_flight(self) -> int:
+        with self._cond:
+            return self._in_flight
+
+    def acquire(self):
+        """Ждёт свободного места в пределе."""
+        started = time.monotonic()
+        with self._cond:
+            while self._in_flight >= int(self.limit):
+                self._cond.wait()
+            self._in_flight += 1
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            metrics.observe('retailcrm_concurrency_wait_seconds', waited)
+
+    def release(self, endpoint: str, latency: float, overloaded: bool = False):
+        """Освобождает место и подстраивает предел по итогу запроса."""
+        with self._cond:
+            saturated = self._in_flight >= int(self.limit)
+            self._in_flight -= 1
+            baseline = self._baseline.get(endpoint)
+            spike = (baseline is not None and latency > baseline * self.spike_factor
+                     and latency - baseline > MIN_LATENCY_SPIKE_SECONDS)
+
+            reason = None
+            if overloaded or spike:
+                now = time.monotonic()
+                if now - self._last_decrease >= (baseline or latency):
+                    reason = 'overload' if overloaded else 'latency'
+                    self.limit = max(float(self.min_limit), self.limit / 2)
+                    self._last_decrease = now
+            elif saturated and self.limit < self.max_limit:
+                reason = 'increase'
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+            if not overloaded:
+                # Всплески сдвигают обычную задержку медленно: устойчивое замедление CRM со временем станет нормой
+                weight = 0.05 if spike else 0.2
+                self._baseline[endpoint] = latency if baseline is None else (1 - weight) * baseline + weight * latency
+            self.min_seen = min(self.min_seen, self.limit)
+            self.max_seen = max(self.max_seen, self.limit)
+            self._cond.notify_all()
+
+        if reason is not None:
+            metrics.inc('retailcrm_concurrency_adjustments', reason=reason)
+        self.publish()
+
+    def publish(self):
+        """Текущий предел и его диапазон за запуск — в метрики, история — в трассу (--profile)."""
+        with self._cond:
+            limit, low, high, in_flight = int(self.limit), int(self.min_seen), int(self.max_seen), self._in_flight
+        metrics.set_gauge('retailcrm_concurrency_limit', limit)
+        metrics.set_gauge('retailcrm_concurrency_limit_min', low)
+        metrics.set_gauge('retailcrm_concurrency_limit_max', high)
+        profiler.counter('retailcrm_concurrency', cat='retailcrm', limit=limit, in_flight=in_flight)
+
+
+class CRMUnavailableError(CircuitOpenError, requests.exceptions.RequestException):
+    """
+    Запрос отклонён предохранителем аккаунта. Это RequestException, поэтому функции модуля
+    обрабатывают его как обычную ошибку запроса — только без ожидания таймаута.
+    """
+
+
+def is_unavailable_status(status_code: int) -> bool:
+    """Ответы, означающие недоступность CRM (а не ошибку в самом запросе)."""
+    return status_code >= 500 or status_code == 429
+
+
+def is_unavailable_error(error: Exception) -> bool:
+    """Ошибка запроса, после которой работу стоит повторить в следующий раз, а не считать выполненной."""
+    if isinstance(error, (CircuitOpenError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    response = getattr(error, 'response', None)
+    return response is not None and is_unavailable_status(response.status_code)
+
+
+class RetailCRMClient:
+    """
+    Подключение к одному аккаунту/сайту RetailCRM: свой пул соединений и свой бюджет запросов.
+    Функции модуля работают через текущий клиент контекста (см. use_client), поэтому
+    несколько аккаунтов обслуживаются в одном процессе параллельно, каждый в своём потоке.
+    """
+
+    def __init__(self, base_url: str, api_key: str, site_code: str,
+                 rate_limit: Optional[float] = None, pool_size: int = MAX_CONCURRENCY):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.site_code = site_code
+        rate_limit = RATE_LIMIT if rate_limit is None else rate_limit
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit > 0 else None
+        # Недоступный аккаунт перестаёт ждать таймауты после нескольких отказов подряд
+        self.breaker = CircuitBreaker('retailcrm')
+        # Число одновременных запросов подстраивается под то, что выдерживает аккаунт
+        self.concurrency = AdaptiveConcurrencyLimiter(max_limit=pool_size)
+        # Пул соединений: повторные запросы не открывают новое TCP/TLS-соединение
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        self.session.mount("http://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+
+    @classmethod
+    def from_env(cls, rate_limit: Optional[float] = None) -> 'RetailCRMClient':
+        return cls(RETAILCRM_BASE_URL, RETAILCRM_API_KEY, RETAILCRM_SITE_CODE, rate_limit=rate_limit)
+
+    @classmethod
+    def for_tenant(cls, tenant, rate_limit: Optional[float] = None) -> 'RetailCRMClient':
+        return cls(tenant.base_url, tenant.api_key, tenant.site_code,
+                   rate_limit=tenant.rate_limit if rate_limit is None else rate_limit)
+
+    def url(self, endpoint: str) -> str:
+        return f"{self.base_url}/api/v5/{endpoint}"
+
+    def request(self, method: str, endpoint: str, params: Optional[Dict[str, Any]] = None,
+                **kwargs) -> requests.Response:
+        """
+        HTTP-запрос к API в рамках бюджета; apiKey и site передаются параметрами URL.
+        Пока предохранитель разомкнут, запрос сразу завершается CRMUnavailableError.
+        """
+        params = dict(params or {})
+        params["apiKey"] = self.api_key
+        params["site"] = self.site_code
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError as e:
+            raise CRMUnavailableError(e.name, e.retry_in) from None
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        endpoint_name = metrics.endpoint_label(endpoint)
+        self.concurrency.acquire()
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, self.url(endpoint), params=params,
+                                            timeout=REQUEST_TIMEOUT, **kwargs)
+        except requests.exceptions.Timeout:
+            self.concurrency.release(endpoint_name, time.monotonic() - started, overloaded=True)
+            self.breaker.record_failure()
+            raise
+        except requests.exceptions.ConnectionError:
+            self.concurrency.release(endpoint_name, time.monotonic() - started)
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.concurrency.release(endpoint_name, time.monotonic() - started)
+            self.breaker.release()
+            raise
+        self.concurrency.release(endpoint_name, time.monotonic() - started,
+                                 overloaded=response.status_code in (429, 503))
+        if is_unavailable_status(response.status_code):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+_CURRENT_CLIENT: ContextVar[Optional[RetailCRMClient]] = ContextVar('retailcrm_client', default=None)
+_default_client: Optional[RetailCRMClient] = None
+_default_client_lock = threading.Lock()
 
-load_dotenv()
 
-RETAILCRM_BASE_URL = os.getenv('RETAILCRM_BASE_URL')
-RETAILCRM_API_KEY = os.getenv('RETAILCRM_API_KEY')
-RETAILCRM_SITE_CODE = os.getenv('RETAILCRM_SITE_CODE')
+def current_client() -> RetailCRMClient:
+    """Клиент текущего контекста; вне use_client — клиент из настроек .env."""
+    global _default_client
+    client = _CURRENT_CLIENT.get()
+    if client is not None:
+        return client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = RetailCRMClient.from_env()
+        return _default_client
 
-REQUEST_TIMEOUT = 120  # seconds
+
+def set_default_client(client: RetailCRMClient):
+    """Заменяет клиент по умолчанию (бенчмарки и локальная отладка)."""
+    global _default_client
+    with _default_client_lock:
+        _default_client = client
+
+
+@contextmanager
+def use_client(client: RetailCRMClient) -> Iterator[RetailCRMClient]:
+    """Делает client текущим в этом контексте. Потоки наследуют его через contextvars.copy_context()."""
+    token = _CURRENT_CLIENT.set(client)
+    try:
+        yield client
+    finally:
+        _CURRENT_CLIENT.reset(token)
 
 
 def fetch_data_from_retailcrm(endpoint: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """Универсальная функция для GET-запросов к RetailCRM API."""
-    url = f"{RETAILCRM_BASE_URL}/api/v5/{endpoint}"
-    if params is None:
-        params = {}
+    # apiKey и site передаются как параметры URL (см. RetailCRMClient.request)
+    client = current_client()
+    endpoint_name = metrics.endpoint_label(endpoint)
+    try:
+        with metrics.timed('retailcrm_request_seconds', method='GET', endpoint=endpoint_name):
+            response = client.request('GET', endpoint, params=params)
+            response.raise_for_status()
+            result = json_codec.loads(response.content)
+        metrics.inc('retailcrm_requests', method='GET', endpoint=endpoint_name, outcome='ok')
+        return result
+    except (requests.exceptions.RequestException, json_codec.JSONDecodeError) as e:
+        metrics.inc('retailcrm_requests', method='GET', endpoint=endpoint_name, outcome='error')
+        logger.error("Ошибка при запросе к RetailCRM API (endpoint: %s): %s", endpoint, e)
+        return {}
 
-    # ВОЗВРАЩАЕМСЯ К ИСХОДНОМУ РЕШЕНИЮ: Передаем apiKey и site как параметры URL
-    params["apiKey"] = RETAILCRM_API_KEY
-    params["site"] = RETAILCRM_SITE_CODE
 
+def _stream_page_orders(response: requests.Response, pagination: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Потоково разбирает ответ 'orders' по мере получения байтов из сокета и отдаёт заказы по одному.
+    В памяти одновременно находится только текущий заказ. Поля 'pagination' записываются в pagination.
+    """
+    response.raw.decode_content = True
+    builder = None
+    for prefix, event, value in ijson.parse(response.raw, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == 'orders.item' and event == 'end_map':
+                yield builder.value
+                builder = None
+        elif prefix == 'orders.item' and event == 'start_map':
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix.startswith('pagination.') and event == 'number':
+            pagination[prefix.split('.', 1)[1]] = value
+
+
+def _decode_page_orders(response: requests.Response, pagination: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Разбирает страницу 'orders' целиком (json_codec: orjson, если установлен)."""
+    data = json_codec.loads(response.content)
+    pagination.update(data.get('pagination') or {})
+    yield from data.get('orders') or []
+
+
+def iter_orders(params: Optional[Dict[str, Any]] = None, limit: int = PAGE_LIMIT,
+                max_orders: Optional[int] = None, stream: bool = STREAM_ORDERS) -> Iterator[Order]:
+    """
+    Постранично обходит результат запроса 'orders' и отдаёт заказы по одному в виде Order.
+    Страница разбирается потоково (ijson), поэтому обработка первых заказов начинается
+    до того, как страница получена целиком, а память не растёт с размером выборки.
+    max_orders ограничивает общее число заказов. При ошибке обход прекращается.
+    """
+    client = current_client()
+    decode_page = _stream_page_orders if stream and ijson else _decode_page_orders
+    yielded = 0
+    page = 1
+
+    while True:
+        page_params = dict(params or {})
+        page_params.update({'limit': limit, 'page': page})
+        pagination: Dict[str, Any] = {}
+        response = None
+        try:
+            with metrics.timed('retailcrm_request_seconds', method='GET', endpoint='orders'):
+                response = client.request('GET', 'orders', params=page_params, stream=True)
+                response.raise_for_status()
+            for order_data in decode_page(response, pagination):
+                yield Order.from_api(order_data)
+                yielded += 1
+                if max_orders is not None and yielded >= max_orders:
+                    metrics.inc('retailcrm_requests', method='GET', endpoint='orders', outcome='ok')
+                    return
+            metrics.inc('retailcrm_requests', method='GET', endpoint='orders', outcome='ok')
+        except (requests.exceptions.RequestException,) + _DECODE_ERRORS as e:
+            metrics.inc('retailcrm_requests', method='GET', endpoint='orders', outcome='error')
+            logger.error("Ошибка при получении страницы %s заказов из RetailCRM API: %s", page, e)
+            return
+        finally:
+            if response is not None:
+                response.close()
+
+        if page >= int(pagination.get('totalPageCount') or 1):
+            return
+        page += 1
+
+
+def fetch_orders_page(params: Optional[Dict[str, Any]] = None, page: int = 1,
+                      limit: int = PAGE_LIMIT) -> Optional[Tuple[List[Order], Dict[str, Any]]]:
+    """
+    Одна страница 'orders' целиком: (заказы, pagination) или None при ошибке.
+    В отличие от iter_orders позволяет запрашивать несколько страниц параллельно.
+    """
+    client = current_client()
+    page_params = dict(params or {})
+    page_params.update({'limit': limit, 'page': page})
+    pagination: Dict[str, Any] = {}
     try:
-        response = requests.get(url, params=params, timeout=REQUEST_TIMEOUT)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Ошибка при запросе к RetailCRM API (endpoint: {endpoint}): {e}")
-        return {}
+        with metrics.timed('retailcrm_request_seconds', method='GET', endpoint='orders'):
+            response = client.request('GET', 'orders', params=page_params)
+            response.raise_for_status()
+            orders = [Order.from_api(order_data) for order_data in _decode_page_orders(response, pagination)]
+        metrics.inc('retailcrm_requests', method='GET', endpoint='orders', outcome='ok')
+        return orders, pagination
+    except (requests.exceptions.RequestException,) + _DECODE_ERRORS as e:
+        metrics.inc('retailcrm_requests', method='GET', endpoint='orders', outcome='error')
+        logger.error("Ошибка при получении страницы %s заказов из RetailCRM API: %s", page, e)
+        return None
 
 
 def post_data_to_retailcrm(endpoint: str, data: Dict[str, Any], use_json: bool = False) -> Dict[str, Any]:
@@ -39,35 +416,35 @@ def post_data_to_retailcrm(endpoint: str, data: Dict[str, Any], use_json: bool =
     Универсальная функция для POST-запросов к RetailCRM API.
     Обрабатывает ошибки и выводит детали.
     """
-    url = f"{RETAILCRM_BASE_URL}/api/v5/{endpoint}"
-
-    # API-ключ и сайт передаются в POST-параметрах
-    params = {
-        "apiKey": RETAILCRM_API_KEY,
-        "site": RETAILCRM_SITE_CODE
-    }
-
+    # API-ключ и сайт передаются в POST-параметрах (см. RetailCRMClient.request)
+    client = current_client()
+    endpoint_name = metrics.endpoint_label(endpoint)
     try:
-        if use_json:
-            print(f"Отправляемый JSON-payload: {json.dumps(data, indent=2)}")
-            response = requests.post(url, params=params, json=data, timeout=REQUEST_TIMEOUT)
-        else:
-            print(f"Отправляемые form-data: {data}")
-            response = requests.post(url, params=params, data=data, timeout=REQUEST_TIMEOUT)
-
-        response.raise_for_status()  # Вызовет исключение для ошибок 4xx/5xx
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        with metrics.timed('retailcrm_request_seconds', method='POST', endpoint=endpoint_name):
+            if use_json:
+                logger.debug("Отправляемый JSON-payload: %s", log.lazy_json(data))
+                response = client.request('POST', endpoint, json=data)
+            else:
+                logger.debug("Отправляемые form-data: %s", data)
+                response = client.request('POST', endpoint, data=data)
+
+            response.raise_for_status()  # Вызовет исключение для ошибок 4xx/5xx
+            result = json_codec.loads(response.content)
+        metrics.inc('retailcrm_requests', method='POST', endpoint=endpoint_name, outcome='ok')
+        return result
+    except (requests.exceptions.RequestException, json_codec.JSONDecodeError) as e:
+        metrics.inc('retailcrm_requests', method='POST', endpoint=endpoint_name, outcome='error')
         # Детальный вывод ошибок
         error_info = f"Ошибка при POST-запросе к RetailCRM API (endpoint: {endpoint}): {e}"
-        if e.response is not None:
+        error_response = getattr(e, 'response', None)
+        if error_response is not None:
             try:
-                error_details = e.response.json()
+                error_details = json_codec.loads(error_response.content)
                 error_info += f". Детали: {error_details}"
-            except json.JSONDecodeError:
-                error_info += f". Текст ответа: {e.response.text}"
-        print(error_info)
-        return {"success": False, "error": error_info}
+            except json_codec.JSONDecodeError:
+                error_info += f". Текст ответа: {error_response.text}"
+        logger.error("%s", error_info)
+        return {"success": False, "error": error_info, "unavailable": is_unavailable_error(e)}
 
 
 def get_order_history(since_id: Optional[int] = None) -> Dict[str, Any]:
@@ -81,7 +458,7 @@ def get_order_history_by_dates(start_date: str, end_date: str) -> Dict[str, Any]
     Получает историю изменений заказов в заданном диапазоне дат.
     Формат дат: Y-m-d H:i:s.
     """
-    print(f"Запрос истории изменений с {start_date} до {end_date}...")
+    logger.info("Запрос истории изменений с %s до %s...", start_date, end_date)
     params = {
         'filter[startDate]': start_date,
         'filter[endDate]': end_date
@@ -93,7 +470,7 @@ def get_recent_orders(limit: int = 50) -> Optional[Dict[str, Any]]:
     """
     Получает последние заказы из RetailCRM.
     """
-    print(f"Запрос последних {limit} заказов...")
+    logger.info("Запрос последних %s заказов...", limit)
     params = {'limit': limit}
     data = fetch_data_from_retailcrm("orders", params=params)
     if data.get('success') and data.get('orders'):
@@ -103,22 +480,72 @@ def get_recent_orders(limit: int = 50) -> Optional[Dict[str, Any]]:
 
 def get_order_by_id(order_id: int) -> Optional[Dict[str, Any]]:
     """Получает полные данные заказа по его внутреннему ID."""
-    print(f"Запрос полных данных заказа {order_id}...")
-    params = {'filter[ids][]': order_id}
-    data = fetch_data_from_retailcrm("orders", params=params)
-    if data.get('success') and data.get('orders'):
-        return data['orders'][0]
-    return None
+    logger.debug("Запрос полных данных заказа %s...", order_id)
+    return get_orders_by_ids([order_id]).get(str(order_id))
+
+
+def chunk_order_ids(order_ids: Iterable[Any], max_size: int = PAGE_LIMIT,
+                    max_query_length: int = MAX_IDS_QUERY_LENGTH) -> List[List[str]]:
+    """
+    Делит список ID на пачки, каждая из которых помещается и в лимит страницы,
+    и в бюджет длины query-строки (с учётом URL-кодирования 'filter[ids][]').
+    Повторяющиеся ID отбрасываются с сохранением порядка.
+    """
+    chunks: List[List[str]] = []
+    current: List[str] = []
+    current_length = 0
+
+    for order_id in dict.fromkeys(str(i) for i in order_ids):
+        # Длина фрагмента 'filter%5Bids%5D%5B%5D=<id>&'
+        item_length = len(urlencode({'filter[ids][]': order_id})) + 1
+        if current and (len(current) >= max_size or current_length + item_length > max_query_length):
+            chunks.append(current)
+            current, current_length = [], 0
+        current.append(order_id)
+        current_length += item_length
+
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def get_orders_by_ids(order_ids: Iterable[Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    Пакетно получает заказы по внутренним ID.
+    ID делятся на пачки (см. chunk_order_ids), пачки запрашиваются параллельно
+    через сессию текущего клиента. Возвращает словарь { 'order_id': заказ }; ключи — строки,
+    как в файлах-трекерах. Заказы, которые не удалось получить, в словарь не попадают.
+    """
+    chunks = chunk_order_ids(order_ids)
+    if not chunks:
+        return {}
+
+    logger.info("Пакетный запрос %s заказов по ID (%s запросов)...", sum(len(c) for c in chunks), len(chunks))
+
+    def fetch_chunk(chunk: List[str]) -> List[Dict[str, Any]]:
+        params = {'filter[ids][]': chunk, 'limit': PAGE_LIMIT}
+        data = fetch_data_from_retailcrm("orders", params=params)
+        return data.get('orders', []) if data.get('success') else []
+
+    orders_by_id: Dict[str, Dict[str, Any]] = {}
+    # Потоков — по потолку адаптивного предела: сколько запросов реально идёт одновременно, решает он
+    with ThreadPoolExecutor(max_workers=min(current_client().concurrency.max_limit, len(chunks))) as executor:
+        # Каждый поток получает копию контекста, чтобы запросы шли через клиент текущего тенанта
+        futures = [executor.submit(contextvars.copy_context().run, fetch_chunk, chunk) for chunk in chunks]
+        for future in futures:
+            for order in future.result():
+                orders_by_id[str(order['id'])] = order
+    return orders_by_id
 
 
 def create_task(task_data: dict) -> dict:
     """
     Создает задачу в RetailCRM, сериализуя данные в JSON-строку.
     """
-    print("Попытка создать задачу в RetailCRM...")
+    logger.debug("Попытка создать задачу в RetailCRM...")
 
     # Сериализуем словарь задачи в JSON-строку
-    task_json_string = json.dumps(task_data)
+    task_json_string = json_codec.dumps(task_data)
 
     # Формируем итоговый payload для отправки в виде form-data
     payload = {
@@ -126,14 +553,16 @@ def create_task(task_data: dict) -> dict:
     }
 
     # Отправляем form-data (use_json=False)
-    return post_data_to_retailcrm('tasks/create', data=payload, use_json=False)
+    response = post_data_to_retailcrm('tasks/create', data=payload, use_json=False)
+    metrics.inc('tasks_created' if response.get('success') else 'tasks_failed')
+    return response
 
 
 def update_order_comment(order_id: int, new_comment: str) -> Dict[str, Any]:
     """
     Обновляет комментарий менеджера в заказе.
     """
-    print(f"Попытка обновить комментарий для заказа ID: {order_id}...")
+    logger.debug("Попытка обновить комментарий для заказа ID: %s...", order_id)
 
     # Формируем словарь заказа с обновленным комментарием
     order_payload = {
@@ -142,7 +571,7 @@ def update_order_comment(order_id: int, new_comment: str) -> Dict[str, Any]:
     }
 
     # Сериализуем словарь заказа в JSON-строку
-    order_json_string = json.dumps(order_payload)
+    order_json_string = json_codec.dumps(order_payload)
 
     # Формируем итоговый POST-запрос для обновления
     payload = {
@@ -160,7 +589,7 @@ def get_orders_by_delivery_date(date_str: str) -> Optional[Dict[str, Any]]:
     Формат даты: YYYY-MM-DD.
     Устанавливает лимит 100 для обработки всех заказов с доставкой на сегодня.
     """
-    print(f"Запрос заказов с датой доставки: {date_str}...")
+    logger.info("Запрос заказов с датой доставки: %s...", date_str)
     params = {
         'filter[deliveryDateFrom]': date_str,
         'filter[deliveryDateTo]': date_str,
@@ -178,10 +607,10 @@ def get_orders_by_statuses(statuses: List[str], order_ids: Optional[List[str]] =
     """
     params = {'limit': 100}
     if statuses:
-        print(f"Запрос заказов со статусами: {', '.join(statuses)}...")
+        logger.info("Запрос заказов со статусами: %s...", ', '.join(statuses))
         params['filter[extendedStatus][]'] = statuses
     if order_ids:
-        print(f"Запрос заказов по ID: {', '.join(order_ids)}...")
+        logger.debug("Запрос заказов по ID: %s...", ', '.join(order_ids))
         params['filter[ids][]'] = order_ids
 
     data = fetch_data_from_retailcrm("orders", params=params)
@@ -191,13 +620,33 @@ def get_orders_by_statuses(statuses: List[str], order_ids: Optional[List[str]] =
     return None
 
 
+def get_orders_by_status_update(statuses: List[str], updated_from: str) -> Optional[List[Order]]:
+    """
+    Все страницы заказов в статусах statuses, статус которых менялся начиная с updated_from
+    (формат Y-m-d H:i:s). None — если какую-то страницу получить не удалось.
+    """
+    logger.info("Запрос заказов со статусами, изменёнными с %s: %s...", updated_from, ', '.join(statuses))
+    params = {'filter[extendedStatus][]': statuses, 'filter[statusUpdatedAtFrom]': updated_from}
+    orders: List[Order] = []
+    page = 1
+    while True:
+        result = fetch_orders_page(params, page=page)
+        if result is None:
+            return None
+        page_orders, pagination = result
+        orders.extend(page_orders)
+        if page >= int(pagination.get('totalPageCount') or 1):
+            return orders
+        page += 1
+
+
 # --- НОВАЯ ФУНКЦИЯ ДЛЯ РЕГЛАМЕНТА "ВХОДЯЩИЙ ЗВОНОК" ---
 def get_orders_by_method_and_date_range(method_code: str, date_from: str, date_to: str) -> Optional[Dict[str, Any]]:
     """
     Получает заказы по коду метода оформления и в заданном диапазоне даты создания.
     Формат дат: Y-m-d H:i:s.
     """
-    print(f"Запрос заказов методом '{method_code}' (созданы с {date_from} по {date_to})...")
+    logger.info("Запрос заказов методом '%s' (созданы с %s по %s)...", method_code, date_from, date_to)
     params = {
         'filter[orderMethods][]': method_code,
         'filter[createdAtFrom]': date_from,
@@ -216,7 +665,7 @@ def get_orders_for_evening_check(date_from: str, date_to: str) -> Optional[Dict[
     """
     Получает заказы для вечерней проверки (21:00) по набору фильтров.
     """
-    print(f"Запрос заказов для вечерней проверки с доставкой от {date_from} до {date_to}...")
+    logger.info("Запрос заказов для вечерней проверки с доставкой от %s до %s...", date_from, date_to)
 
     params = {
         'filter[extendedStatus][]': [
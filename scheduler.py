@@ -0,0 +1,294 @@
+# scheduler.py
+
+import os
+import time
+import threading
+import contextvars
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import json_codec
+import log
+import metrics
+from circuit_breaker import DependencyUnavailableError
+from settings import SETTINGS
+from sharding import shard_path
+from tenants import tenant_path
+
+logger = logging.getLogger(__name__)
+
+# Бюджет запуска по часам, секунды (0 — без ограничения). Отсчитывается от начала запуска.
+RUN_BUDGET_SECONDS = SETTINGS.run_budget_seconds
+# Работа, не выполненная до конца бюджета, переносится в следующий запуск через этот файл
+PENDING_WORK_FILE = shard_path(SETTINGS.pending_work_file)
+# Сколько элементов работы выполняется одновременно
+SCHEDULER_WORKERS = SETTINGS.scheduler_workers
+# Сколько раз элемент, завершившийся ошибкой, повторяется в следующих запусках, прежде чем будет отброшен
+SCHEDULER_MAX_ATTEMPTS = SETTINGS.scheduler_max_attempts
+
+# Шкала срочности: 100 — доставка сегодня; просроченная доставка выше, далёкая — ниже (до 0).
+# Регламент НДЗ и зависшие статусы укладываются между доставкой «завтра» и «через 2–3 дня».
+DELIVERY_TODAY_URGENCY = 100.0
+DELIVERY_URGENCY_PER_DAY = 10.0
+NDZ_BASE_URGENCY = 80.0
+STALL_BASE_URGENCY = 60.0
+
+
+def delivery_urgency(delivery_date: Optional[str], today: date) -> float:
+    """Срочность по дате доставки: чем ближе (или сильнее просрочена) дата, тем выше. Без даты — 0."""
+    if not delivery_date:
+        return 0.0
+    try:
+        delivery_day = datetime.strptime(delivery_date[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return 0.0
+    days_left = max((delivery_day - today).days, -3)
+    return max(0.0, DELIVERY_TODAY_URGENCY - DELIVERY_URGENCY_PER_DAY * days_left)
+
+
+def ndz_urgency(day: int) -> float:
+    """Срочность задачи регламента НДЗ: каждый следующий день обзвона срочнее предыдущего."""
+    return NDZ_BASE_URGENCY + 5.0 * day
+
+
+def stall_urgency(overdue_days: int) -> float:
+    """Срочность задачи по зависшему статусу: растёт с превышением лимита max_days."""
+    return STALL_BASE_URGENCY + 2.0 * min(max(overdue_days, 0), 15)
+
+
+@dataclass
+class WorkItem:
+    """
+    Элемент отложенной работы. payload сохраняется в файл очереди, поэтому должен быть JSON-совместим;
+    obj — несериализуемые данные текущего запуска (например, уже полученный Order).
+    """
+    urgency: float
+    kind: str
+    order_id: str
+    payload: Dict[str, Any] = field(default_factory=dict)
+    obj: Any = field(default=None, repr=False)
+
+    @property
+    def key(self) -> Tuple[str, str, Optional[str]]:
+        return self.kind, self.order_id, self.payload.get('step')
+
+    def to_json(self) -> Dict[str, Any]:
+        return {'urgency': self.urgency, 'kind': self.kind, 'order_id': self.order_id, 'payload': self.payload}
+
+
+class Scheduler:
+    """
+    Планировщик запуска с бюджетом времени.
+
+    Пока идёт планирование, блоки не выполняют дорогие действия (создание задач, анализ комментариев),
+    а передают их в submit() с оценкой срочности. run() выполняет работу по убыванию срочности
+    и перестаёт брать новые элементы, когда до конца бюджета не успеть выполнить ещё один
+    (по средней длительности элемента). Невыполненное сохраняется в файл очереди и
+    первым делом подхватывается следующим запуском; элемент, завершившийся ошибкой, повторяется
+    там же, пока не исчерпает SCHEDULER_MAX_ATTEMPTS попыток.
+    """
+
+    def __init__(self, budget_seconds: Optional[float] = None, path: Optional[str] = None,
+                 workers: int = SCHEDULER_WORKERS):
+        budget_seconds = RUN_BUDGET_SECONDS if budget_seconds is None else budget_seconds
+        self.budget_seconds = budget_seconds
+        self.deadline = time.monotonic() + budget_seconds if budget_seconds > 0 else None
+        self.path = path or tenant_path(PENDING_WORK_FILE)
+        self.workers = workers
+        self.planning = True
+        self._items: Dict[Tuple[str, str, Optional[str]], WorkItem] = {}
+        self._lock = threading.Lock()
+        self._avg_item_seconds = 0.0
+        # Элементы, не выполненные из-за недоступности CRM или OpenAI: остаются в очереди
+        self._unavailable: List[WorkItem] = []
+        # Элементы, завершившиеся ошибкой: повторяются в следующем запуске (до SCHEDULER_MAX_ATTEMPTS попыток)
+        self._failed: List[WorkItem] = []
+        self._dropped = 0
+        # Работа, перенесённая в следующий запуск без выполнения (запуск без бюджета, см. carry_over)
+        self._carried: List[WorkItem] = []
+
+    def remaining_seconds(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def submit(self, urgency: float, kind: str, order_id, obj: Any = None, **payload):
+        """Добавляет работу. Повтор того же элемента сохраняет наибольшую срочность и свежие данные."""
+        item = WorkItem(urgency=urgency, kind=kind, order_id=str(order_id), payload=payload, obj=obj)
+        with self._lock:
+            existing = self._items.get(item.key)
+            if existing is not None:
+                item.urgency = max(item.urgency, existing.urgency)
+                item.obj = item.obj if item.obj is not None else existing.obj
+                # Свежие данные не обнуляют счётчик неудачных попыток перенесённого элемента
+                if 'attempts' in existing.payload:
+                    item.payload.setdefault('attempts', existing.payload['attempts'])
+            self._items[item.key] = item
+
+    def load_pending(self) -> int:
+        """Подхватывает работу, оставшуюся от предыдущего запуска."""
+        if not os.path.exists(self.path):
+            return 0
+        try:
+            records = json_codec.load_file(self.path)
+        except (IOError, json_codec.JSONDecodeError) as e:
+            logger.error("Ошибка при чтении очереди %s: %s. Продолжаю без перенесённой работы.", self.path, e)
+            return 0
+        for record in records:
+            self.submit(record['urgency'], record['kind'], record['order_id'], **record.get('payload', {}))
+        if records:
+            logger.info("Из предыдущего запуска перенесено %s элементов работы.", len(records))
+        return len(records)
+
+    def has_pending(self) -> bool:
+        return os.path.exists(self.path)
+
+    def save_pending(self, items: List[WorkItem]):
+        """Сохраняет очередь (пустая очередь удаляет файл)."""
+        try:
+            if not items:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            json_codec.dump_file(self.path, [item.to_json() for item in items], atomic=True)
+        except (IOError, OSError) as e:
+            logger.error("Ошибка при записи очереди %s: %s", self.path, e)
+
+    def carry_over(self, urgency: float, kind: str, order_id, **payload):
+        """Откладывает работу в очередь следующего запуска, не выполняя её в этом."""
+        with self._lock:
+            self._carried.append(WorkItem(urgency=urgency, kind=kind, order_id=str(order_id), payload=payload))
+
+    def save_carried(self):
+        """Сохраняет отложенную через carry_over работу (запуск без бюджета очередь не выполняет)."""
+        with self._lock:
+            items = sorted(self._carried, key=lambda i: i.urgency, reverse=True)
+        self.save_pending(items)
+        if items:
+            logger.warning("⏸️ %s элементов работы отложено и перенесено в %s.", len(items), self.path)
+
+    def _out_of_budget(self) -> bool:
+        remaining = self.remaining_seconds()
+        return remaining is not None and remaining <= self._avg_item_seconds
+
+    def _execute(self, handlers: Dict[str, Callable[[WorkItem], Any]], item: WorkItem):
+        started = time.perf_counter()
+        outcome = 'done'
+        with log.order_context(item.order_id):
+            try:
+                handlers[item.kind](item)
+            except DependencyUnavailableError as e:
+                outcome = 'unavailable'
+                with self._lock:
+                    self._unavailable.append(item)
+                logger.warning("⏸️ '%s' по заказу %s перенесён в следующий запуск: %s", item.kind, item.order_id, e)
+            except Exception as e:
+                attempts = item.payload.get('attempts', 0) + 1
+                if attempts < SCHEDULER_MAX_ATTEMPTS:
+                    outcome = 'retry'
+                    item.payload['attempts'] = attempts
+                    with self._lock:
+                        self._failed.append(item)
+                    logger.error("❌ Ошибка при выполнении '%s' по заказу %s (попытка %s из %s), "
+                                 "повтор в следующем запуске: %s",
+                                 item.kind, item.order_id, attempts, SCHEDULER_MAX_ATTEMPTS, e)
+                else:
+                    outcome = 'error'
+                    with self._lock:
+                        self._dropped += 1
+                    logger.error("❌ Ошибка при выполнении '%s' по заказу %s (попытка %s из %s), элемент отброшен: %s",
+                                 item.kind, item.order_id, attempts, SCHEDULER_MAX_ATTEMPTS, e)
+        seconds = time.perf_counter() - started
+        with self._lock:
+            # Скользящее среднее длительности элемента — по нему решаем, успеем ли взять следующий
+            self._avg_item_seconds = seconds if not self._avg_item_seconds else \
+                0.8 * self._avg_item_seconds + 0.2 * seconds
+        metrics.observe('scheduled_item_seconds', seconds, kind=item.kind)
+        metrics.inc('scheduled_items', kind=item.kind, outcome=outcome)
+
+    def run(self, handlers: Dict[str, Callable[[WorkItem], Any]],
+            prepare: Optional[Callable[[List[WorkItem]], None]] = None) -> Dict[str, int]:
+        """Выполняет накопленную работу по срочности в пределах бюджета и сохраняет остаток."""
+        self.planning = False
+        with self._lock:
+            items = sorted(self._items.values(), key=lambda i: i.urgency, reverse=True)
+        if not items:
+            self.save_pending([])
+            return {'done': 0, 'deferred': 0}
+
+        # Очередь сохраняется до выполнения: если процесс убьют, работа не потеряется
+        # (повтор уже выполненных элементов отсекает журнал запуска)
+        self.save_pending(items)
+        if prepare is not None:
+            prepare(items)
+
+        remaining = self.remaining_seconds()
+        logger.info("--- Выполнение %s элементов работы по срочности%s ---",
+                    len(items), f' (осталось {remaining:.0f} с бюджета)' if remaining is not None else '')
+
+        started_count = 0
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for item in items:
+                while len(in_flight) >= self.workers:
+                    _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                if self._out_of_budget():
+                    break
+                # Копия контекста: текущий тенант и клиент CRM переходят в поток исполнителя
+                in_flight.add(executor.submit(contextvars.copy_context().run, self._execute, handlers, item))
+                started_count += 1
+            wait(in_flight)
+
+        not_started = items[started_count:]
+        for item in not_started:
+            metrics.inc('scheduled_items', kind=item.kind, outcome='deferred')
+        leftover = sorted(self._unavailable + self._failed + not_started, key=lambda i: i.urgency, reverse=True)
+        self.save_pending(leftover)
+        if not_started:
+            logger.warning("⏱️ Бюджет запуска исчерпан: %s элементов перенесено в %s (самый срочный из них: %.0f).",
+                           len(not_started), self.path, not_started[0].urgency)
+        if self._unavailable:
+            logger.warning("⏸️ %s элементов не выполнено из-за недоступности сервисов и перенесено в %s.",
+                           len(self._unavailable), self.path)
+        if self._failed:
+            logger.warning("🔁 %s элементов завершились ошибкой и будут повторены следующим запуском (%s).",
+                           len(self._failed), self.path)
+        done = started_count - len(self._unavailable) - len(self._failed) - self._dropped
+        return {'done': done, 'deferred': len(leftover)}
+
+
+_CURRENT_SCHEDULER: ContextVar[Optional[Scheduler]] = ContextVar('scheduler', default=None)
+
+
+def current_scheduler() -> Optional[Scheduler]:
+    """Планировщик, принимающий работу в этом контексте (только на этапе планирования)."""
+    scheduler = _CURRENT_SCHEDULER.get()
+    return scheduler if scheduler is not None and scheduler.planning else None
+
+
+def carry_over(urgency: float, kind: str, order_id, **payload) -> bool:
+    """
+    Переносит работу, которую не удалось выполнить сразу (например, OpenAI исчерпал лимиты),
+    в очередь следующего запуска. Возвращает False, если в контексте нет планировщика запуска.
+    """
+    scheduler = _CURRENT_SCHEDULER.get()
+    if scheduler is None:
+        return False
+    scheduler.carry_over(urgency, kind, order_id, **payload)
+    return True
+
+
+@contextmanager
+def use_scheduler(scheduler: Scheduler) -> Iterator[Scheduler]:
+    token = _CURRENT_SCHEDULER.set(scheduler)
+    try:
+        yield scheduler
+    finally:
+        _CURRENT_SCHEDULER.reset(token)
@@ -0,0 +1,135 @@
+# settings.py
+
+"""
+Конфигурация процесса: .env читается один раз при первом импорте модуля, значения переменных
+окружения разбираются в один объект SETTINGS. Модули берут настройки отсюда, а не читают
+окружение сами, поэтому порядок импортов больше не влияет на то, видны ли значения из .env.
+"""
+
+import os
+from dataclasses import dataclass, field
+from typing import FrozenSet, Optional
+
+
+def _load_dotenv():
+    # python-dotenv нужен только здесь и только один раз
+    from dotenv import load_dotenv
+    load_dotenv()
+
+
+def _env(name: str, default: Optional[str] = None) -> Optional[str]:
+    return os.getenv(name, default)
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    return os.getenv(name, '1' if default else '0') == '1'
+
+
+def _env_set(name: str) -> FrozenSet[str]:
+    return frozenset(item.strip() for item in os.getenv(name, '').split(',') if item.strip())
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Все настройки из окружения. Описание переменных — в README."""
+    # RetailCRM
+    retailcrm_base_url: Optional[str] = field(default_factory=lambda: _env('RETAILCRM_BASE_URL'))
+    retailcrm_api_key: Optional[str] = field(default_factory=lambda: _env('RETAILCRM_API_KEY'))
+    retailcrm_site_code: Optional[str] = field(default_factory=lambda: _env('RETAILCRM_SITE_CODE'))
+    retailcrm_rate_limit: float = field(default_factory=lambda: _env_float('RETAILCRM_RATE_LIMIT', 10))
+    retailcrm_stream_orders: bool = field(default_factory=lambda: _env_flag('RETAILCRM_STREAM_ORDERS', True))
+    retailcrm_initial_concurrency: int = field(default_factory=lambda: _env_int('RETAILCRM_INITIAL_CONCURRENCY', 4))
+    retailcrm_max_concurrency: int = field(default_factory=lambda: _env_int('RETAILCRM_MAX_CONCURRENCY', 16))
+    retailcrm_latency_spike_factor: float = field(
+        default_factory=lambda: _env_float('RETAILCRM_LATENCY_SPIKE_FACTOR', 2.0))
+    retailcrm_request_timeout: float = field(default_factory=lambda: _env_float('RETAILCRM_REQUEST_TIMEOUT', 120))
+
+    # OpenAI
+    openai_api_key: Optional[str] = field(default_factory=lambda: _env('OPENAI_API_KEY'))
+    openai_request_timeout: float = field(default_factory=lambda: _env_float('OPENAI_REQUEST_TIMEOUT', 60))
+    openai_rpm_limit: float = field(default_factory=lambda: _env_float('OPENAI_RPM_LIMIT', 500))
+    openai_tpm_limit: float = field(default_factory=lambda: _env_float('OPENAI_TPM_LIMIT', 200000))
+    openai_max_wait_seconds: float = field(default_factory=lambda: _env_float('OPENAI_MAX_WAIT_SECONDS', 30))
+    openai_max_attempts: int = field(default_factory=lambda: _env_int('OPENAI_MAX_ATTEMPTS', 3))
+    llm_local_tier: bool = field(default_factory=lambda: _env_flag('LLM_LOCAL_TIER', False))
+    llm_cheap_model: str = field(default_factory=lambda: _env('LLM_CHEAP_MODEL', 'gpt-4o-mini'))
+    llm_strong_model: str = field(default_factory=lambda: _env('LLM_STRONG_MODEL', 'gpt-4o-mini'))
+    llm_strong_threshold: float = field(default_factory=lambda: _env_float('LLM_STRONG_THRESHOLD', 4.0))
+
+    # Теневой режим экстрактора
+    shadow_backend: str = field(default_factory=lambda: _env('SHADOW_BACKEND', ''))
+    shadow_log_file: str = field(default_factory=lambda: _env('SHADOW_LOG_FILE', 'shadow_log.jsonl'))
+    shadow_workers: int = field(default_factory=lambda: _env_int('SHADOW_WORKERS', 2))
+    shadow_max_pending: int = field(default_factory=lambda: _env_int('SHADOW_MAX_PENDING', 100))
+    shadow_rate_share: float = field(default_factory=lambda: _env_float('SHADOW_RATE_SHARE', 0.2))
+
+    # Предохранители внешних зависимостей
+    circuit_failure_threshold: int = field(default_factory=lambda: _env_int('CIRCUIT_FAILURE_THRESHOLD', 3))
+    circuit_cooldown_seconds: float = field(default_factory=lambda: _env_float('CIRCUIT_COOLDOWN_SECONDS', 60))
+
+    # Правила и конвейер main.py
+    digest_rules: FrozenSet[str] = field(default_factory=lambda: _env_set('DIGEST_RULES'))
+    digest_min_orders: int = field(default_factory=lambda: _env_int('DIGEST_MIN_ORDERS', 2))
+    pipeline_enabled: bool = field(default_factory=lambda: _env_flag('PIPELINE_ENABLED', True))
+    pipeline_analyze_workers: int = field(default_factory=lambda: _env_int('PIPELINE_ANALYZE_WORKERS', 4))
+    pipeline_write_workers: int = field(default_factory=lambda: _env_int('PIPELINE_WRITE_WORKERS', 2))
+    pipeline_queue_size: int = field(default_factory=lambda: _env_int('PIPELINE_QUEUE_SIZE', 10))
+    tracker_reconcile_hours: float = field(default_factory=lambda: _env_float('TRACKER_RECONCILE_HOURS', 24))
+
+    # Бюджет запуска и отложенная работа
+    run_budget_seconds: float = field(default_factory=lambda: _env_float('RUN_BUDGET_SECONDS', 0))
+    pending_work_file: str = field(default_factory=lambda: _env('PENDING_WORK_FILE', 'pending_work.json'))
+    scheduler_workers: int = field(default_factory=lambda: _env_int('SCHEDULER_WORKERS', 4))
+    scheduler_max_attempts: int = field(default_factory=lambda: _env_int('SCHEDULER_MAX_ATTEMPTS', 3))
+
+    # Журнал процесса
+    log_level: str = field(default_factory=lambda: _env('LOG_LEVEL', 'INFO'))
+    log_format: str = field(default_factory=lambda: _env('LOG_FORMAT', 'json'))
+
+    # Журнал, метрики
+    run_journal_file: str = field(default_factory=lambda: _env('RUN_JOURNAL_FILE', 'run_journal.jsonl'))
+    run_journal_max_carries: int = field(default_factory=lambda: _env_int('RUN_JOURNAL_MAX_CARRIES', 6))
+    metrics_json_file: str = field(default_factory=lambda: _env('METRICS_JSON_FILE', 'run_metrics.json'))
+    metrics_prom_file: str = field(default_factory=lambda: _env('METRICS_PROM_FILE', 'task_manager.prom'))
+
+    # Блокировка и шардирование
+    lock_backend: str = field(default_factory=lambda: _env('LOCK_BACKEND', 'file'))
+    lock_dir: str = field(default_factory=lambda: _env('LOCK_DIR', '.'))
+    lock_db_file: str = field(default_factory=lambda: _env('LOCK_DB_FILE', 'locks.sqlite3'))
+    lock_ttl_seconds: float = field(default_factory=lambda: _env_float('LOCK_TTL_SECONDS', 900))
+    shard_count: int = field(default_factory=lambda: _env_int('SHARD_COUNT', 1))
+    shard_index: int = field(default_factory=lambda: _env_int('SHARD_INDEX', 0))
+
+    # Тенанты
+    tenants_file: str = field(default_factory=lambda: _env('TENANTS_FILE', ''))
+
+    # Бэкфилл
+    backfill_cursor_file: str = field(default_factory=lambda: _env('BACKFILL_CURSOR_FILE', 'backfill_cursor.json'))
+    backfill_page_workers: int = field(default_factory=lambda: _env_int('BACKFILL_PAGE_WORKERS', 4))
+    backfill_rate_share: float = field(default_factory=lambda: _env_float('BACKFILL_RATE_SHARE', 0.5))
+
+    # Приёмник триггеров
+    webhook_host: str = field(default_factory=lambda: _env('WEBHOOK_HOST', '0.0.0.0'))
+    webhook_port: int = field(default_factory=lambda: _env_int('WEBHOOK_PORT', 8080))
+    webhook_token: str = field(default_factory=lambda: _env('WEBHOOK_TOKEN', ''))
+    webhook_debounce_seconds: float = field(default_factory=lambda: _env_float('WEBHOOK_DEBOUNCE_SECONDS', 30))
+    webhook_queue_max_size: int = field(default_factory=lambda: _env_int('WEBHOOK_QUEUE_MAX_SIZE', 500))
+    webhook_drain_batch_size: int = field(default_factory=lambda: _env_int('WEBHOOK_DRAIN_BATCH_SIZE', 20))
+
+    @classmethod
+    def from_env(cls) -> 'Settings':
+        """Читает .env (без перезаписи уже заданных переменных) и окружение."""
+        _load_dotenv()
+        return cls()
+
+
+# Единственный объект настроек процесса
+SETTINGS = Settings.from_env()
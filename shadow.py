@@ -0,0 +1,234 @@
+# shadow.py
+
+"""
+Теневой режим экстрактора задач: сравнение кандидата с рабочим бэкендом на живых заказах.
+
+Задачи в CRM по-прежнему создаются по ответу рабочего пути (analyze_comment_with_openai).
+Если задан SHADOW_BACKEND (в формате бэкендов extractors.py: rules, model:<имя>, router),
+те же записи комментария асинхронно отправляются кандидату; его ответ никуда не пишется, кроме
+журнала SHADOW_LOG_FILE: ответы обоих, расхождение по задачам и датам, задержки и токены.
+Кандидат не замедляет запуск и не влияет на рабочий путь: у него свои предохранитель OpenAI и доля
+лимитов RPM/TPM (SHADOW_RATE_SHARE), его метрики пишутся с меткой lane=shadow, а при заполненной
+очереди или исчерпанном бюджете рабочего пути сравнение пропускается.
+
+Сводка по журналу — доля совпадений и ускорение кандидата:
+
+    python shadow.py
+    python shadow.py --log shadow_log.jsonl --show 20
+"""
+
+import sys
+import atexit
+import logging
+import argparse
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import json_codec
+import metrics
+import openai_processor
+from circuit_breaker import CircuitBreaker
+from extractors import Backend, Extraction, make_backend, task_keys
+from llm_scheduler import LLMRateScheduler
+from settings import SETTINGS
+from tenants import current_tenant
+
+logger = logging.getLogger(__name__)
+
+# Бэкенд-кандидат; пустое значение отключает теневой режим
+SHADOW_BACKEND = SETTINGS.shadow_backend
+SHADOW_LOG_FILE = SETTINGS.shadow_log_file
+SHADOW_WORKERS = SETTINGS.shadow_workers
+# Сколько сравнений может ждать в очереди; сверх этого сравнения пропускаются
+SHADOW_MAX_PENDING = SETTINGS.shadow_max_pending
+# Доля лимитов RPM/TPM аккаунта OpenAI, которую может расходовать кандидат
+SHADOW_RATE_SHARE = SETTINGS.shadow_rate_share
+# Сколько секунд конец запуска ждёт незавершённые сравнения
+SHADOW_DRAIN_SECONDS = 60
+
+
+def _side(result: Extraction) -> Dict[str, Any]:
+    return {'tasks': result.tasks, 'latency': round(result.latency, 6), 'tokens': result.tokens,
+            'error': result.error}
+
+
+def diff_tasks(primary: List[Dict[str, Any]], candidate: List[Dict[str, Any]]) -> Dict[str, List[List[str]]]:
+    """Пары (строка, день-месяц), которые нашёл только рабочий бэкенд (missing) или только кандидат (extra)."""
+    _, primary_dates = task_keys(primary)
+    _, candidate_dates = task_keys(candidate)
+    return {'missing': [list(key) for key in (primary_dates - candidate_dates).elements()],
+            'extra': [list(key) for key in (candidate_dates - primary_dates).elements()]}
+
+
+class ShadowRunner:
+    """
+    Пул потоков кандидата и запись журнала сравнений. Кандидат обращается к OpenAI через свои
+    предохранитель и очередь (доля rate_share лимитов аккаунта), а не через рабочие.
+    """
+
+    def __init__(self, backend: Backend, log_path: str = SHADOW_LOG_FILE, workers: int = SHADOW_WORKERS,
+                 max_pending: int = SHADOW_MAX_PENDING, rate_share: float = SHADOW_RATE_SHARE):
+        self.backend = backend
+        self.log_path = log_path
+        self.max_pending = max_pending
+        self.lane = openai_processor.LLMLane(CircuitBreaker('openai_shadow'), LLMRateScheduler(share=rate_share))
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shadow')
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def submit(self, order_id, comment: str, primary: Extraction):
+        """Ставит сравнение в очередь; не блокирует и не бросает исключений."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                metrics.inc('shadow_skipped', reason='queue_full')
+                return
+            self._pending += 1
+        self._executor.submit(contextvars.copy_context().run, self._compare, order_id, comment, primary)
+
+    def _compare(self, order_id, comment: str, primary: Extraction):
+        try:
+            if self.backend.llm and openai_processor.LLM_SCHEDULER.throttled():
+                # Бюджет рабочего пути исчерпан: запрос кандидата отнял бы его у реального анализа
+                metrics.inc('shadow_skipped', reason='throttled')
+                return
+            try:
+                with metrics.labelled(lane='shadow'), openai_processor.use_lane(self.lane):
+                    candidate = self.backend.extract(comment)
+            except Exception as e:
+                candidate = Extraction(None, 0.0, error=f"{type(e).__name__}: {e}")
+            record = {
+                'ts': datetime.now().isoformat(timespec='seconds'),
+                'tenant': current_tenant(),
+                'order_id': order_id,
+                'backend': self.backend.name,
+                'comment': comment,
+                'primary': _side(primary),
+                'candidate': _side(candidate),
+            }
+            if candidate.tasks is not None:
+                record['diff'] = diff_tasks(primary.tasks, candidate.tasks)
+                record['agree'] = not record['diff']['missing'] and not record['diff']['extra']
+                metrics.inc('shadow_comparisons', agree=str(record['agree']).lower())
+            else:
+                record['agree'] = None
+                metrics.inc('shadow_comparisons', agree='error')
+            self._append(record)
+        finally:
+            with self._lock:
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.notify_all()
+
+    def _append(self, record: Dict[str, Any]):
+        line = json_codec.dumps(record) + '\n'
+        with self._lock:
+            try:
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+            except IOError as e:
+                logger.error("Ошибка при записи журнала теневого режима %s: %s", self.log_path, e)
+
+    def drain(self, timeout: float = SHADOW_DRAIN_SECONDS) -> bool:
+        """Ждёт завершения поставленных сравнений; False — не дождались за timeout."""
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._pending, timeout=timeout)
+
+
+_runner: Optional[ShadowRunner] = None
+_runner_lock = threading.Lock()
+
+
+def shadow_runner() -> Optional[ShadowRunner]:
+    """Теневой режим процесса (создаётся при первом обращении) или None, если SHADOW_BACKEND не задан."""
+    global _runner
+    if not SHADOW_BACKEND:
+        return None
+    with _runner_lock:
+        if _runner is None:
+            _runner = ShadowRunner(make_backend(SHADOW_BACKEND))
+            atexit.register(_runner.drain)
+        return _runner
+
+
+def drain():
+    """Дожидается сравнений текущего процесса (конец запуска)."""
+    if _runner is not None and not _runner.drain():
+        logger.warning("⚠️ Теневой режим: не все сравнения завершились за %s с.", SHADOW_DRAIN_SECONDS)
+
+
+def load_log(path: str) -> List[Dict[str, Any]]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json_codec.loads(line) for line in f if line.strip()]
+
+
+def summarize(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Доля совпадений, задержки и токены обоих бэкендов, ускорение кандидата."""
+    compared = [r for r in records if r.get('agree') is not None]
+    summary: Dict[str, Any] = {
+        'records': len(records),
+        'compared': len(compared),
+        'candidate_errors': len(records) - len(compared),
+        'agreement': sum(1 for r in compared if r['agree']) / len(compared) if compared else None,
+    }
+    for side in ('primary', 'candidate'):
+        latencies = [r[side]['latency'] for r in compared]
+        summary[side] = {
+            'p50': metrics.percentile(latencies, 50),
+            'p95': metrics.percentile(latencies, 95),
+            'total_seconds': sum(latencies),
+            'tokens_per_comment': sum(r[side]['tokens'] for r in compared) / len(compared) if compared else None,
+        }
+    p50_primary, p50_candidate = summary['primary']['p50'], summary['candidate']['p50']
+    summary['speedup_p50'] = p50_primary / p50_candidate if p50_primary and p50_candidate else None
+    total_candidate = summary['candidate']['total_seconds']
+    summary['speedup_total'] = summary['primary']['total_seconds'] / total_candidate if total_candidate else None
+    return summary
+
+
+def _fmt(value: Optional[float], digits: int = 3) -> str:
+    return f"{value:.{digits}f}" if value is not None else '-'
+
+
+def print_summary(summary: Dict[str, Any], records: List[Dict[str, Any]], show: int):
+    backends = sorted({r.get('backend', '?') for r in records})
+    print(f"Теневой режим ({', '.join(backends) or '-'}): {summary['records']} записей, "
+          f"сравнено {summary['compared']}, ошибок кандидата {summary['candidate_errors']}")
+    print(f"  совпадение {_fmt(summary['agreement'])}")
+    for side, title in (('primary', 'рабочий'), ('candidate', 'кандидат')):
+        stats = summary[side]
+        print(f"  {title:<9} p50 {_fmt(stats['p50'])} с, p95 {_fmt(stats['p95'])} с, "
+              f"токенов на запись {_fmt(stats['tokens_per_comment'], 1)}")
+    print(f"  ускорение: по p50 {_fmt(summary['speedup_p50'], 1)}x, по суммарному времени "
+          f"{_fmt(summary['speedup_total'], 1)}x")
+    disagreements = [r for r in records if r.get('agree') is False]
+    for record in disagreements[-show:] if show else []:
+        print(f"\n  ✗ заказ {record['order_id']}: {record['comment']!r}")
+        print(f"    только у рабочего: {record['diff']['missing']}")
+        print(f"    только у кандидата: {record['diff']['extra']}")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Сводка теневого режима экстрактора задач.")
+    parser.add_argument('--log', default=SHADOW_LOG_FILE, help=f"журнал сравнений (по умолчанию {SHADOW_LOG_FILE})")
+    parser.add_argument('--show', type=int, default=10, help="сколько последних расхождений вывести")
+    parser.add_argument('--output', help="сохранить сводку в JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    records = load_log(args.log)
+    summary = summarize(records)
+    print_summary(summary, records, args.show)
+    if args.output:
+        json_codec.dump_file(args.output, summary, indent=True)
+        print(f"\nСводка сохранена в {args.output}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
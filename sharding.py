@@ -0,0 +1,40 @@
+# sharding.py
+
+import os
+import zlib
+from typing import Optional
+
+from settings import SETTINGS
+
+# Горизонтальное масштабирование: N воркеров делят заказы по хэшу ID.
+# Каждый воркер запускается со своим SHARD_INDEX (0..SHARD_COUNT-1).
+SHARD_COUNT = SETTINGS.shard_count
+SHARD_INDEX = SETTINGS.shard_index
+
+if not 0 <= SHARD_INDEX < SHARD_COUNT:
+    raise ValueError(f"SHARD_INDEX должен быть от 0 до {SHARD_COUNT - 1}, получено {SHARD_INDEX}.")
+
+
+def shard_of(order_id, shard_count: Optional[int] = None) -> int:
+    """Номер шарда заказа. crc32 стабилен между процессами (в отличие от hash())."""
+    return zlib.crc32(str(order_id).encode('utf-8')) % (shard_count or SHARD_COUNT)
+
+
+def owns_order(order_id) -> bool:
+    """Относится ли заказ к шарду текущего воркера."""
+    return SHARD_COUNT == 1 or shard_of(order_id) == SHARD_INDEX
+
+
+def shard_suffix() -> str:
+    return '' if SHARD_COUNT == 1 else f".shard-{SHARD_INDEX}-of-{SHARD_COUNT}"
+
+
+def shard_path(path: str) -> str:
+    """
+    Путь к файлу состояния этого шарда: 'ndz_tracker.json' -> 'ndz_tracker.shard-0-of-3.json'.
+    При одном шарде путь не меняется, поэтому существующие файлы трекеров подхватываются как есть.
+    """
+    if SHARD_COUNT == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}{shard_suffix()}{ext}"
@@ -0,0 +1,296 @@
+# simulator.py
+
+"""
+Симулятор многодневной работы регламентов на виртуальных часах.
+
+main() прогоняется по слотам cron (12:00, 16:00, 21:00) недель подряд за секунды: время подменяется
+через clock.use_clock, RetailCRM и OpenAI — фейковые (fake_servers.py) и вызываются в том же процессе,
+без сокетов. Между слотами заказы в CRM меняются: приходят новые (в том числе входящие звонки для НДЗ),
+заказы переходят между статусами, менеджеры дописывают строки в комментарии.
+
+Отчёт по каждому симулированному дню: поставленные задачи по регламентам, вызовы CRM и OpenAI,
+время работы main() и размеры трекеров. Журнал задач проверяется на нарушения регламентов
+(НДЗ — не больше одной задачи в день и не больше трёх дней подряд; зависшие статусы — только
+после лимита дней; без дублей задач регламентов); при нарушениях код выхода 1.
+
+    python simulator.py                               # 14 дней, база 1000 заказов
+    python simulator.py --days 60 --orders 20000 --new-per-day 300 --output sim.json
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+import httpx
+import openai
+
+import clock
+import json_codec
+import log
+import main as task_manager
+import openai_processor
+import retailcrm_api
+from fake_servers import (API_KEY, OTHER_STATUSES, FakeOpenAI, FakeRetailCRM, InProcessAdapter,
+                          generate_comment, generate_orders, in_process_transport)
+from llm_scheduler import LLMRateScheduler
+
+SLOT_HOURS = [12, 16, 21]
+START_DATE = datetime(2025, 10, 13)
+SIM_CRM_URL = 'http://crm.simulator'
+SIM_OPENAI_URL = 'http://openai.simulator/v1/'
+
+# Доли заказов, с которыми за сутки что-то происходит
+STATUS_CHANGE_PER_DAY = 0.15
+COMMENT_UPDATE_PER_DAY = 0.1
+
+RULE_NDZ = 'ndz'
+RULE_STATUS_STALL = 'status_stall'
+RULE_UNDELIVERED = 'undelivered'
+RULE_EVENING = 'evening_check'
+RULE_COMMENTS = 'comments'
+RULES = [RULE_NDZ, RULE_STATUS_STALL, RULE_UNDELIVERED, RULE_EVENING, RULE_COMMENTS]
+
+NDZ_TASK_PREFIX = "Обзвон по регламенту НДЗ - день "
+NDZ_CYCLE_DAYS = 3
+
+
+def task_rule(task: Dict[str, Any]) -> str:
+    """Регламент, поставивший задачу, — по тексту задачи."""
+    text = task.get('text') or ''
+    if text.startswith(NDZ_TASK_PREFIX):
+        return RULE_NDZ
+    if any(text == config['task_text'] for config in task_manager.STATUS_CONFIGS.values()):
+        return RULE_STATUS_STALL
+    if text.startswith("Актуализировать дату доставки"):
+        return RULE_UNDELIVERED
+    if text.startswith("Актуализировать данные по заказу"):
+        return RULE_EVENING
+    return RULE_COMMENTS
+
+
+class OrderWorld:
+    """Заказы фейковой CRM, которые меняются со временем: новые заказы, смены статусов, записи менеджеров."""
+
+    def __init__(self, crm: FakeRetailCRM, start: datetime, new_per_day: float, seed: int):
+        self.crm = crm
+        self.new_per_day = new_per_day
+        self.statuses = task_manager.ALLOWED_STATUSES + OTHER_STATUSES
+        self._random = random.Random(seed)
+        self._at = start
+        self._new_carry = 0.0
+        self._next_id = max(crm.orders, default=10000) + 1
+        # Когда заказ попал в текущий статус (для базы на старте — неизвестно, считаем что давно)
+        self.status_since: Dict[int, datetime] = {order_id: start - timedelta(days=365) for order_id in crm.orders}
+
+    def _sample(self, share: float) -> List[int]:
+        count = min(len(self.crm.orders), int(round(len(self.crm.orders) * share)))
+        return self._random.sample(sorted(self.crm.orders), count) if count else []
+
+    def advance(self, until: datetime):
+        """События в CRM с прошлого вызова до until."""
+        days = (until - self._at).total_seconds() / 86400
+        if days <= 0:
+            return
+        with self.crm._lock:
+            for order_id in self._sample(STATUS_CHANGE_PER_DAY * days):
+                order = self.crm.orders[order_id]
+                status = self._random.choice(self.statuses)
+                if status != order['status']:
+                    changed = self._random_moment(until)
+                    order['status'] = status
+                    order['statusUpdatedAt'] = changed.strftime('%Y-%m-%d %H:%M:%S')
+                    self.status_since[order_id] = changed
+            for order_id in self._sample(COMMENT_UPDATE_PER_DAY * days):
+                order = self.crm.orders[order_id]
+                line = generate_comment(self._random, until)
+                if line:
+                    order['managerComment'] = f"{order.get('managerComment') or ''}\n{line}".strip()
+
+            self._new_carry += self.new_per_day * days
+            count, self._new_carry = int(self._new_carry), self._new_carry - int(self._new_carry)
+            for order in generate_orders(count, now=until, seed=self._random.randrange(2 ** 32),
+                                         statuses=self.statuses, first_id=self._next_id):
+                created = self._random_moment(until)
+                order['createdAt'] = created.strftime('%Y-%m-%d %H:%M:%S')
+                order['delivery']['date'] = (created + timedelta(days=self._random.randint(0, 5))).strftime('%Y-%m-%d')
+                self.crm.orders[order['id']] = order
+                self.status_since[order['id']] = created
+            self._next_id += count
+        self._at = until
+
+    def _random_moment(self, until: datetime) -> datetime:
+        return self._at + (until - self._at) * self._random.random()
+
+
+def _tracker_sizes() -> Dict[str, int]:
+    ndz = task_manager.load_ndz_tracker()
+    statuses = task_manager.load_trackers()
+    return {'ndz': len(ndz), 'status': sum(len(statuses[status]) for status in task_manager.TRACKED_STATUSES)}
+
+
+def check_regulations(task_log: List[Dict[str, Any]]) -> List[str]:
+    """Нарушения регламентов в журнале задач симуляции."""
+    violations = []
+    ndz_days: Dict[Any, List[Dict[str, Any]]] = {}
+    stalls: Dict[Any, List[Dict[str, Any]]] = {}
+    seen = set()
+    for entry in task_log:
+        if entry['rule'] == RULE_COMMENTS:
+            # Разные строки комментария вправе дать одинаковые задачи: дубли ищем только у регламентов
+            continue
+        key = (entry['order_id'], entry['text'], entry['datetime'])
+        if key in seen:
+            violations.append(f"{entry['date']}: дубль задачи '{entry['text']}' по заказу {entry['order_id']}")
+        seen.add(key)
+        if entry['rule'] == RULE_NDZ:
+            ndz_days.setdefault(entry['order_id'], []).append(entry)
+        elif entry['rule'] == RULE_STATUS_STALL:
+            stalls.setdefault((entry['order_id'], entry['status']), []).append(entry)
+
+    for order_id, entries in ndz_days.items():
+        for previous, entry in zip([None] + entries, entries):
+            day = int(entry['text'][len(NDZ_TASK_PREFIX):])
+            expected = int(previous['text'][len(NDZ_TASK_PREFIX):]) + 1 if previous else 1
+            if day != expected or day > NDZ_CYCLE_DAYS:
+                violations.append(f"{entry['date']}: НДЗ по заказу {order_id} — день {day}, ожидался {expected}")
+            if previous and previous['date'] >= entry['date']:
+                violations.append(f"{entry['date']}: две задачи НДЗ за день по заказу {order_id}")
+
+    for (order_id, status), entries in stalls.items():
+        max_days = task_manager.STATUS_CONFIGS[status]['max_days']
+        for previous, entry in zip([None] + entries, entries):
+            if entry['days_in_status'] <= max_days:
+                violations.append(f"{entry['date']}: задача по зависшему статусу {status} заказа {order_id} "
+                                  f"через {entry['days_in_status']} дн. (лимит {max_days})")
+            if previous and (entry['date'] - previous['date']).days <= max_days:
+                violations.append(f"{entry['date']}: повторная задача по статусу {status} заказа {order_id} "
+                                  f"через {(entry['date'] - previous['date']).days} дн.")
+    return violations
+
+
+def simulate(days: int, orders: int, new_per_day: float, slot_hours: List[int], seed: int) -> Dict[str, Any]:
+    """Прогоняет main() по слотам days дней и возвращает отчёт по дням, журнал задач и нарушения."""
+    start = task_manager.moscow_tz().localize(START_DATE)
+    crm = FakeRetailCRM(generate_orders(orders, now=start, seed=seed))
+    llm = FakeOpenAI()
+    world = OrderWorld(crm, start, new_per_day, seed)
+
+    client = retailcrm_api.RetailCRMClient(SIM_CRM_URL, API_KEY, 'fake-site', rate_limit=0)
+    client.session.mount(SIM_CRM_URL, InProcessAdapter(crm))
+    retailcrm_api.set_default_client(client)
+    openai.api_key = 'fake-openai-key'
+    openai.base_url = SIM_OPENAI_URL
+    openai.http_client = httpx.Client(transport=in_process_transport(llm))
+    # Лимиты аккаунта OpenAI считаются по настоящему времени, а симулированные сутки длятся доли секунды
+    openai_processor.LLM_SCHEDULER = LLMRateScheduler(rpm=10 ** 9, tpm=10 ** 12)
+
+    report: List[Dict[str, Any]] = []
+    task_log: List[Dict[str, Any]] = []
+    virtual = clock.VirtualClock(start)
+    previous_cwd = os.getcwd()
+    with clock.use_clock(virtual), tempfile.TemporaryDirectory() as workdir:
+        # Трекеры, журнал запуска и отчёты пишутся во временный каталог
+        os.chdir(workdir)
+        try:
+            for day in range(days):
+                day_stats = {'date': (start + timedelta(days=day)).strftime('%Y-%m-%d'), 'runs': 0,
+                             'tasks': dict.fromkeys(RULES, 0), 'crm_calls': 0, 'crm_orders_fetched': 0,
+                             'openai_calls': 0, 'seconds': 0.0}
+                for hour in slot_hours:
+                    slot = start + timedelta(days=day, hours=hour)
+                    world.advance(slot)
+                    virtual.set(slot)
+                    tasks_before, crm_before = len(crm.tasks), sum(crm.request_counts.values())
+                    fetched_before, llm_before = crm.orders_served, llm.request_count
+                    started = time.perf_counter()
+                    task_manager.main(now_moscow=slot)
+                    day_stats['seconds'] += time.perf_counter() - started
+                    day_stats['runs'] += 1
+                    day_stats['crm_calls'] += sum(crm.request_counts.values()) - crm_before
+                    day_stats['crm_orders_fetched'] += crm.orders_served - fetched_before
+                    day_stats['openai_calls'] += llm.request_count - llm_before
+                    for task in crm.tasks[tasks_before:]:
+                        rule = task_rule(task)
+                        day_stats['tasks'][rule] += 1
+                        order_id = (task.get('order') or {}).get('id')
+                        order = crm.orders.get(order_id) or {}
+                        since = world.status_since.get(order_id, slot)
+                        task_log.append({'date': slot.date(), 'order_id': order_id, 'rule': rule,
+                                         'text': task.get('text'), 'datetime': task.get('datetime'),
+                                         'status': order.get('status'),
+                                         'days_in_status': (slot.date() - since.date()).days})
+                day_stats['seconds'] = round(day_stats['seconds'], 3)
+                day_stats['trackers'] = _tracker_sizes()
+                day_stats['orders'] = len(crm.orders)
+                report.append(day_stats)
+        finally:
+            os.chdir(previous_cwd)
+            client.close()
+
+    return {
+        'days': report,
+        'tasks_total': len(crm.tasks),
+        'crm_calls_total': sum(crm.request_counts.values()),
+        'crm_calls': dict(sorted(crm.request_counts.items())),
+        'crm_orders_fetched_total': crm.orders_served,
+        'openai_calls_total': llm.request_count,
+        'seconds_total': round(sum(d['seconds'] for d in report), 3),
+        'violations': check_regulations(task_log),
+    }
+
+
+def print_report(result: Dict[str, Any]):
+    print(f"{'дата':<10} {'НДЗ':>5} {'статус':>6} {'доставка':>8} {'вечер':>5} {'коммент':>7} "
+          f"{'CRM':>6} {'получено':>8} {'LLM':>5} {'с':>7} {'трекер НДЗ':>10} {'трекер статусов':>15} "
+          f"{'заказов':>8}")
+    for day in result['days']:
+        tasks = day['tasks']
+        print(f"{day['date']:<10} {tasks[RULE_NDZ]:>5} {tasks[RULE_STATUS_STALL]:>6} {tasks[RULE_UNDELIVERED]:>8} "
+              f"{tasks[RULE_EVENING]:>5} {tasks[RULE_COMMENTS]:>7} {day['crm_calls']:>6} "
+              f"{day['crm_orders_fetched']:>8} {day['openai_calls']:>5} {day['seconds']:>7.2f} "
+              f"{day['trackers']['ndz']:>10} {day['trackers']['status']:>15} "
+              f"{day['orders']:>8}")
+    print(f"\nИтого: задач {result['tasks_total']}, вызовов CRM {result['crm_calls_total']} "
+          f"(получено заказов {result['crm_orders_fetched_total']}), вызовов OpenAI {result['openai_calls_total']}, "
+          f"время main() {result['seconds_total']:.2f} с.")
+    for name, count in result['crm_calls'].items():
+        print(f"  {name:<28} {count:>7}")
+    if result['violations']:
+        print(f"\n❌ Нарушения регламентов ({len(result['violations'])}):")
+        for violation in result['violations'][:50]:
+            print(f"  {violation}")
+    else:
+        print("\n✅ Нарушений регламентов нет.")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Симуляция регламентов main() на виртуальных часах.")
+    parser.add_argument('--days', type=int, default=14, help="сколько суток симулировать")
+    parser.add_argument('--orders', type=int, default=1000, help="заказов в CRM на старте")
+    parser.add_argument('--new-per-day', type=float, default=40, help="новых заказов в сутки")
+    parser.add_argument('--slots', type=int, nargs='+', default=SLOT_HOURS, help="часы запусков main() (МСК)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--log-level', default='ERROR',
+                        help="уровень журнала main() в stderr (по умолчанию ERROR; INFO — для разбора нарушений)")
+    parser.add_argument('--output', help="сохранить отчёт в JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    log.configure(level=args.log_level, fmt='text', stream=sys.stderr)
+    result = simulate(args.days, args.orders, args.new_per_day, sorted(args.slots), args.seed)
+    print_report(result)
+    if args.output:
+        json_codec.dump_file(args.output, result, indent=True)
+        print(f"\nОтчёт сохранён в {args.output}.")
+    return 1 if result['violations'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,106 @@
+# startup_benchmark.py
+
+"""
+Бенчмарк холодного старта: время импорта точек входа по `python -X importtime`.
+
+Каждый модуль импортируется в новом процессе несколько раз, берётся медиана. Скрипт завершается
+с кодом 1, если медиана превышает бюджет или при старте импортируется тяжёлый модуль, который
+должен загружаться лениво (openai, pytz). Подходит для CI: регрессия старта ломает сборку.
+
+    python startup_benchmark.py
+    python startup_benchmark.py --budget-ms 250 --runs 7 --modules main backfill
+"""
+
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+# Бюджет времени импорта одной точки входа, мс (медиана по запускам)
+STARTUP_BUDGET_MS = float(os.getenv('STARTUP_BUDGET_MS', '350'))
+# Модули, которые импортируются только при первом использовании
+LAZY_MODULES = ('openai', 'pytz')
+DEFAULT_MODULES = ['main', 'webhook_server', 'backfill']
+# Шардированный воркер: пути файлов состояния вычисляются при импорте, поэтому точки входа
+# должны импортироваться и с SHARD_COUNT > 1
+SHARDED_ENV = {'SHARD_COUNT': '2', 'SHARD_INDEX': '1'}
+
+
+def import_profile(module: str, env: Optional[Dict[str, str]] = None) -> Tuple[float, Dict[str, float]]:
+    """
+    Импортирует module в новом процессе (с переменными env поверх окружения);
+    (общее время, мс; накопленное время каждого импорта, мс).
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env={**os.environ, **(env or {})})
+    if result.returncode != 0:
+        raise RuntimeError(f"Не удалось импортировать {module}:\n{result.stderr[-2000:]}")
+
+    cumulative: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative_us, name = (part.strip() for part in line[len('import time:'):].split('|'))
+        if cumulative_us.isdigit():
+            cumulative[name] = int(cumulative_us) / 1000
+    return cumulative.get(module, 0.0), cumulative
+
+
+def check_module(module: str, runs: int, budget_ms: float, top: int) -> List[str]:
+    """Замеряет модуль и возвращает список нарушений (пустой — всё в порядке)."""
+    totals = []
+    profile: Dict[str, float] = {}
+    for _ in range(runs):
+        total, profile = import_profile(module)
+        totals.append(total)
+    median = statistics.median(totals)
+
+    print(f"{module}: медиана {median:.1f} мс (min {min(totals):.1f}, max {max(totals):.1f}), бюджет {budget_ms:.0f} мс")
+    # Самые тяжёлые импорты верхнего уровня (по последнему запуску)
+    heaviest = sorted(((ms, name) for name, ms in profile.items() if name != module and '.' not in name),
+                      reverse=True)[:top]
+    for ms, name in heaviest:
+        print(f"    {name:<30} {ms:>8.1f} мс")
+
+    problems = []
+    if median > budget_ms:
+        problems.append(f"{module}: импорт {median:.1f} мс превышает бюджет {budget_ms:.0f} мс")
+    for lazy in LAZY_MODULES:
+        if lazy in profile:
+            problems.append(f"{module}: при старте импортируется {lazy}, который должен загружаться лениво")
+    try:
+        import_profile(module, SHARDED_ENV)
+    except RuntimeError as e:
+        problems.append(f"{module}: не импортируется с SHARD_COUNT={SHARDED_ENV['SHARD_COUNT']}: {e}")
+    return problems
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бенчмарк времени импорта точек входа с бюджетом.")
+    parser.add_argument('--modules', nargs='+', default=DEFAULT_MODULES, help="какие модули импортировать")
+    parser.add_argument('--runs', type=int, default=5, help="запусков на модуль")
+    parser.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS,
+                        help=f"бюджет медианы импорта, мс (по умолчанию {STARTUP_BUDGET_MS:.0f}, STARTUP_BUDGET_MS)")
+    parser.add_argument('--top', type=int, default=5, help="сколько самых тяжёлых импортов показать")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    problems: List[str] = []
+    for module in args.modules:
+        problems.extend(check_module(module, args.runs, args.budget_ms, args.top))
+    if problems:
+        print("\n❌ Регрессия холодного старта:")
+        for problem in problems:
+            print(f"  - {problem}")
+        return 1
+    print("\n✅ Старт укладывается в бюджет.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,92 @@
+# tenants.py
+
+import os
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Iterator, List, Optional
+
+import json_codec
+from settings import SETTINGS
+
+# Файл со списком аккаунтов/сайтов RetailCRM для обслуживания в одном процессе (см. README)
+TENANTS_FILE = SETTINGS.tenants_file
+
+# Имя тенанта попадает в имена файлов состояния и в метки метрик
+_TENANT_NAME_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# Текущий тенант контекста; None — однотенантный режим (настройки из .env)
+_CURRENT_TENANT: ContextVar[Optional[str]] = ContextVar('tenant', default=None)
+
+
+@dataclass
+class Tenant:
+    """Один аккаунт/сайт RetailCRM. rate_limit — бюджет запросов в секунду (None — по умолчанию)."""
+    name: str
+    base_url: str
+    api_key: str
+    site_code: str
+    rate_limit: Optional[float] = None
+
+
+def load_tenants(path: str = TENANTS_FILE) -> List[Tenant]:
+    """
+    Читает конфигурацию тенантов:
+        {"tenants": [{"name": "shop1", "base_url": "...", "api_key_env": "SHOP1_API_KEY",
+                      "site_code": "shop1", "rate_limit": 8}, ...]}
+    Ключ можно указать прямо в "api_key" или взять из переменной окружения "api_key_env".
+    Ошибка в конфигурации — ValueError: запускаться с частично прочитанным списком нельзя.
+    """
+    data = json_codec.load_file(path)
+
+    tenants: List[Tenant] = []
+    for entry in data.get('tenants') or []:
+        name = str(entry.get('name') or '')
+        if not _TENANT_NAME_RE.match(name):
+            raise ValueError(f"Недопустимое имя тенанта '{name}' в {path}: допустимы латиница, цифры, '_' и '-'.")
+        if any(t.name == name for t in tenants):
+            raise ValueError(f"Тенант '{name}' указан в {path} несколько раз.")
+
+        api_key = entry.get('api_key') or (os.getenv(entry['api_key_env']) if entry.get('api_key_env') else None)
+        if not entry.get('base_url') or not api_key or not entry.get('site_code'):
+            raise ValueError(f"Для тенанта '{name}' в {path} нужны base_url, api_key (или api_key_env) и site_code.")
+
+        rate_limit = entry.get('rate_limit')
+        tenants.append(Tenant(name=name, base_url=entry['base_url'].rstrip('/'), api_key=api_key,
+                              site_code=entry['site_code'],
+                              rate_limit=float(rate_limit) if rate_limit is not None else None))
+
+    if not tenants:
+        raise ValueError(f"В {path} не найдено ни одного тенанта.")
+    return tenants
+
+
+def current_tenant() -> Optional[str]:
+    return _CURRENT_TENANT.get()
+
+
+@contextmanager
+def use_tenant(name: str) -> Iterator[None]:
+    """Делает name текущим тенантом в этом контексте (поток или copy_context().run)."""
+    token = _CURRENT_TENANT.set(name)
+    try:
+        yield
+    finally:
+        _CURRENT_TENANT.reset(token)
+
+
+def tenant_suffix() -> str:
+    name = current_tenant()
+    return '' if name is None else f".{name}"
+
+
+def tenant_path(path: str) -> str:
+    """
+    Путь к файлу состояния текущего тенанта: 'ndz_tracker.json' -> 'ndz_tracker.shop1.json'.
+    Вне тенанта путь не меняется, поэтому однотенантный запуск работает с прежними файлами.
+    """
+    if current_tenant() is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}{tenant_suffix()}{ext}"
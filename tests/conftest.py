@@ -0,0 +1,63 @@
+# tests/conftest.py
+
+import os
+import sys
+from datetime import datetime
+
+import httpx
+import openai
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import checkpoint  # noqa: E402
+import clock  # noqa: E402
+import main as task_manager  # noqa: E402
+import openai_processor  # noqa: E402
+import retailcrm_api  # noqa: E402
+from fake_servers import (API_KEY, FakeOpenAI, FakeRetailCRM, InProcessAdapter,  # noqa: E402
+                          in_process_transport)
+from llm_scheduler import LLMRateScheduler  # noqa: E402
+
+TEST_CRM_URL = 'http://crm.test'
+TEST_OPENAI_URL = 'http://openai.test/v1/'
+START = task_manager.moscow_tz().localize(datetime(2025, 10, 13, 12, 0))
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Трекеры, журналы, курсоры и аренды каждого теста пишутся в свой временный каталог."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(autouse=True)
+def journal(workdir):
+    """Новый журнал запуска в каталоге теста: шаги прошлых тестов не пропускают работу."""
+    return checkpoint.journal().start()
+
+
+@pytest.fixture
+def virtual_clock():
+    virtual = clock.VirtualClock(START)
+    with clock.use_clock(virtual):
+        yield virtual
+
+
+@pytest.fixture
+def crm(monkeypatch):
+    """Пустая фейковая RetailCRM, подключённая клиентом по умолчанию; заказы добавляет тест."""
+    fake = FakeRetailCRM()
+    client = retailcrm_api.RetailCRMClient(TEST_CRM_URL, API_KEY, 'fake-site', rate_limit=0)
+    client.session.mount(TEST_CRM_URL, InProcessAdapter(fake))
+    monkeypatch.setattr(retailcrm_api, '_default_client', client)
+    return fake
+
+@pytest.fixture
+def llm(monkeypatch):
+    fake = FakeOpenAI()
+    monkeypatch.setattr(openai, 'api_key', 'fake-openai-key')
+    monkeypatch.setattr(openai, 'base_url', TEST_OPENAI_URL)
+    monkeypatch.setattr(openai, 'http_client', httpx.Client(transport=in_process_transport(fake)))
+    monkeypatch.setattr(openai_processor, 'LLM_SCHEDULER', LLMRateScheduler(rpm=10 ** 9, tpm=10 ** 12))
+    return fake
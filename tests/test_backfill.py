@@ -0,0 +1,61 @@
+# tests/test_backfill.py
+
+from collections import Counter
+from datetime import timedelta
+
+import backfill
+from conftest import START
+from fake_servers import generate_orders
+from main import ALLOWED_STATUSES
+
+
+def test_scan_params_pin_upper_bound_and_skip_status_filter():
+    params = backfill.scan_params('2025-01-01', '2025-12-31', created_to='2025-10-13 12:00:00')
+    assert params == {'filter[createdAtFrom]': '2025-01-01 00:00:00', 'filter[createdAtTo]': '2025-10-13 12:00:00'}
+    assert backfill.scan_params(date_to='2025-02-01', created_to='2025-10-13 12:00:00') == {
+        'filter[createdAtTo]': '2025-02-01 23:59:59'}
+
+
+def test_resume_after_interruption_sees_every_order_once(crm, llm, virtual_clock, monkeypatch):
+    original = generate_orders(450, now=START, seed=7)
+    crm.orders.update({order['id']: order for order in original})
+
+    seen = Counter()
+    candidate_outcome = backfill.candidate_outcome
+
+    def recording_outcome(order, only_dated):
+        seen[order.id] += 1
+        return candidate_outcome(order, only_dated)
+
+    monkeypatch.setattr(backfill, 'candidate_outcome', recording_outcome)
+
+    # Первый запуск: страницы после второй «не получены», обход останавливается на курсоре
+    fetch_pages = backfill.fetch_pages
+
+    def failing_fetch(params, pages, workers):
+        results = fetch_pages(params, pages, workers)
+        return {page: (result if page <= 2 else None) for page, result in results.items()}
+
+    monkeypatch.setattr(backfill, 'fetch_pages', failing_fetch)
+    first = backfill.run_backfill(page_workers=2)
+    assert not first['completed']
+    assert first['scanned'] == 200
+
+    # Между запусками в CRM появляются новые заказы, а часть старых меняет статус
+    virtual_clock.advance(timedelta(hours=1))
+    fresh = generate_orders(150, now=START + timedelta(days=61), seed=8, first_id=20000)
+    crm.orders.update({order['id']: order for order in fresh})
+    for order in original[::3]:
+        order['status'] = ALLOWED_STATUSES[0] if order['status'] not in ALLOWED_STATUSES else 'complete'
+
+    monkeypatch.setattr(backfill, 'fetch_pages', fetch_pages)
+    second = backfill.run_backfill(page_workers=2)
+    assert second['completed']
+
+    assert set(seen) == {order['id'] for order in original}
+    assert max(seen.values()) == 1
+
+
+def test_cursor_of_other_scan_is_ignored(workdir):
+    backfill.save_cursor(backfill.BACKFILL_CURSOR_FILE, {'scan': 'other', 'next_page': 3})
+    assert backfill.load_cursor(backfill.BACKFILL_CURSOR_FILE, 'this') == {}
@@ -0,0 +1,66 @@
+# tests/test_checkpoint.py
+
+import checkpoint
+import main
+from checkpoint import DONE_STEP, RunJournal
+
+TASK = {'text': 'Позвонить', 'datetime': '2025-10-14 10:00', 'performerId': 1, 'order': {'id': 101}}
+
+
+def test_interrupted_run_is_resumed_and_task_is_not_duplicated(crm, journal):
+    first = main.create_task_once('101', 'task:abc:0', TASK, flow='comment')
+    assert first['success'] and len(crm.tasks) == 1
+
+    # Процесс убит до finish(): следующий запуск продолжает тот же run_id
+    resumed = checkpoint.journal().start()
+    assert resumed.resumed and resumed.run_id == journal.run_id
+
+    again = main.create_task_once('101', 'task:abc:0', TASK, flow='comment')
+    assert again == {'success': True, 'id': first['id']}
+    assert len(crm.tasks) == 1
+
+
+def test_finished_run_carries_only_unfinished_comment_steps(workdir):
+    journal = RunJournal('journal.jsonl').start()
+    journal.record('1', 'task:a:0', flow='comment', task_id=10)
+    journal.record('2', 'task:b:0', flow='comment', task_id=11)
+    journal.record('2', DONE_STEP, flow='comment')
+    journal.record('3', 'ndz_day:1', task_id=12)
+    journal.finish()
+
+    next_run = RunJournal('journal.jsonl').start()
+    assert not next_run.resumed
+    assert next_run.get('1', 'task:a:0') == {'task_id': 10}
+    assert next_run.get('2', 'task:b:0') is None
+    assert next_run.get('3', 'ndz_day:1') is None
+
+
+def test_carried_steps_expire_after_max_carries(workdir, monkeypatch):
+    monkeypatch.setattr(checkpoint, 'RUN_JOURNAL_MAX_CARRIES', 2)
+    journal = RunJournal('journal.jsonl').start()
+    journal.record('1', 'task:a:0', flow='comment', task_id=10)
+    journal.finish()
+
+    carried = []
+    for _ in range(3):
+        journal = RunJournal('journal.jsonl').start()
+        carried.append(journal.get('1', 'task:a:0'))
+        journal.finish()
+
+    assert carried == [{'task_id': 10}, {'task_id': 10}, None]
+
+
+def test_resumed_run_keeps_carry_count(workdir, monkeypatch):
+    monkeypatch.setattr(checkpoint, 'RUN_JOURNAL_MAX_CARRIES', 1)
+    journal = RunJournal('journal.jsonl').start()
+    journal.record('1', 'task:a:0', flow='comment', task_id=10)
+    journal.finish()
+
+    carried = RunJournal('journal.jsonl').start()
+    assert carried.get('1', 'task:a:0') == {'task_id': 10}
+    # Запуск с перенесёнными шагами прерван и продолжен: счётчик переносов не сбрасывается
+    resumed = RunJournal('journal.jsonl').start()
+    assert resumed.resumed and resumed.get('1', 'task:a:0') == {'task_id': 10}
+    resumed.finish()
+
+    assert RunJournal('journal.jsonl').start().get('1', 'task:a:0') is None
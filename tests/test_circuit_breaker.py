@@ -0,0 +1,75 @@
+# tests/test_circuit_breaker.py
+
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+@pytest.fixture
+def now(monkeypatch):
+    """Управляемые монотонные часы предохранителя."""
+    moment = [1000.0]
+    monkeypatch.setattr(circuit_breaker.time, 'monotonic', lambda: moment[0])
+    return moment
+
+
+def fail(breaker: CircuitBreaker, times: int = 1):
+    for _ in range(times):
+        breaker.before_call()
+        breaker.record_failure()
+
+
+def test_threshold_of_consecutive_failures_opens_circuit(now):
+    breaker = CircuitBreaker('crm', failure_threshold=3, cooldown_seconds=30)
+    fail(breaker, 2)
+    breaker.before_call()
+    breaker.record_success()
+    # Успех сбрасывает счётчик: нужны три отказа подряд
+    fail(breaker, 2)
+    assert breaker.state == CLOSED
+    fail(breaker)
+    assert breaker.state == OPEN
+    assert not breaker.available()
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_call()
+    assert error.value.retry_in == pytest.approx(30)
+
+
+def test_half_open_lets_one_probe_through_and_success_closes(now):
+    breaker = CircuitBreaker('crm', failure_threshold=1, cooldown_seconds=30)
+    fail(breaker)
+    now[0] += 30
+    assert breaker.state == HALF_OPEN
+
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+
+    assert breaker.state == CLOSED
+    breaker.before_call()
+
+
+def test_failed_probe_reopens_for_full_cooldown(now):
+    breaker = CircuitBreaker('openai', failure_threshold=5, cooldown_seconds=30)
+    fail(breaker, 5)
+    now[0] += 31
+    fail(breaker)
+
+    assert breaker.state == OPEN
+    now[0] += 29
+    assert breaker.state == OPEN
+    now[0] += 1
+    assert breaker.state == HALF_OPEN
+
+
+def test_release_frees_probe_without_changing_state(now):
+    breaker = CircuitBreaker('crm', failure_threshold=1, cooldown_seconds=10)
+    fail(breaker)
+    now[0] += 10
+    breaker.before_call()
+    breaker.release()
+
+    assert breaker.state == HALF_OPEN
+    breaker.before_call()
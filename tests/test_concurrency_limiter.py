@@ -0,0 +1,69 @@
+# tests/test_concurrency_limiter.py
+
+import pytest
+
+import retailcrm_api
+from retailcrm_api import AdaptiveConcurrencyLimiter
+
+
+@pytest.fixture
+def now(monkeypatch):
+    moment = [1000.0]
+    monkeypatch.setattr(retailcrm_api.time, 'monotonic', lambda: moment[0])
+    return moment
+
+
+def run_batch(limiter: AdaptiveConcurrencyLimiter, latency: float, overloaded: bool = False):
+    """Заполняет предел целиком и завершает все запросы с одной задержкой."""
+    count = int(limiter.limit)
+    for _ in range(count):
+        limiter.acquire()
+    for _ in range(count):
+        limiter.release('orders', latency, overloaded=overloaded)
+
+
+def test_limit_grows_additively_while_saturated(now):
+    limiter = AdaptiveConcurrencyLimiter(initial=4, max_limit=10)
+    run_batch(limiter, 0.1)
+    # Насыщен был только первый ответ пачки: +1/limit
+    assert limiter.limit == pytest.approx(4.25)
+    for _ in range(200):
+        run_batch(limiter, 0.1)
+    assert limiter.limit == 10
+
+
+def test_unsaturated_limit_does_not_grow(now):
+    limiter = AdaptiveConcurrencyLimiter(initial=4, max_limit=10)
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release('orders', 0.1)
+    assert limiter.limit == 4
+
+
+def test_overload_halves_limit_once_per_latency(now):
+    limiter = AdaptiveConcurrencyLimiter(initial=8, max_limit=16)
+    run_batch(limiter, 0.2)
+    limit = limiter.limit
+
+    run_batch(limiter, 0.2, overloaded=True)
+    # Ответы на уже отправленные запросы не уменьшают предел повторно
+    assert limiter.limit == pytest.approx(limit / 2)
+
+    now[0] += 1
+    limiter.acquire()
+    limiter.release('orders', 0.2, overloaded=True)
+    assert limiter.limit == pytest.approx(limit / 4)
+
+
+def test_latency_spike_decreases_and_floor_is_min_limit(now):
+    limiter = AdaptiveConcurrencyLimiter(initial=2, max_limit=4, min_limit=1)
+    limiter.acquire()
+    limiter.release('orders', 0.1)
+    limiter.acquire()
+    limiter.release('orders', 1.0)
+    assert limiter.limit == 1
+
+    now[0] += 10
+    limiter.acquire()
+    limiter.release('orders', 5.0)
+    assert limiter.limit == 1
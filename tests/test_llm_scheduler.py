@@ -0,0 +1,68 @@
+# tests/test_llm_scheduler.py
+
+import os
+
+import pytest
+
+import json_codec
+import main
+import openai_processor
+import scheduler
+from conftest import START
+from llm_scheduler import LLMRateScheduler, parse_reset
+from fake_servers import generate_orders
+
+
+def test_reserve_gives_up_when_budget_is_exhausted():
+    limiter = LLMRateScheduler(rpm=2, tpm=10 ** 6, max_wait_seconds=0)
+    assert limiter.reserve(100)
+    assert limiter.reserve(100)
+    assert limiter.throttled()
+    assert not limiter.reserve(100)
+
+
+def test_token_budget_limits_requests():
+    limiter = LLMRateScheduler(rpm=100, tpm=1000, max_wait_seconds=0)
+    assert limiter.reserve(800)
+    assert not limiter.reserve(800)
+    # Ответ оказался дешевле оценки: остаток возвращается в бюджет
+    limiter.settle(800, prompt_tokens=100, completion_tokens=50)
+    assert limiter.reserve(800)
+
+
+def test_headers_lower_remaining_budget_and_share_splits_limits():
+    limiter = LLMRateScheduler(rpm=100, tpm=10 ** 6, max_wait_seconds=0, share=0.5)
+    assert limiter.requests.limit == 50
+    limiter.sync({'x-ratelimit-limit-requests': '100', 'x-ratelimit-remaining-requests': '0',
+                  'x-ratelimit-reset-requests': '60s'})
+    assert limiter.throttled()
+
+
+def test_retry_delay_from_headers():
+    limiter = LLMRateScheduler()
+    assert limiter.retry_delay({'retry-after-ms': '1500'}) == 1.5
+    assert limiter.retry_delay({'x-ratelimit-reset-tokens': '1m30s'}) == 90
+    assert parse_reset('250ms') == 0.25
+
+
+@pytest.mark.parametrize('pipeline', [True, False])
+def test_throttled_analysis_is_carried_to_next_run(crm, llm, virtual_clock, monkeypatch, pipeline):
+    monkeypatch.setattr(main, 'PIPELINE_ENABLED', pipeline)
+    crm.orders.update({order['id']: order for order in generate_orders(60, now=START, seed=3)})
+    now = START.replace(hour=14)
+    pending_path = scheduler.PENDING_WORK_FILE
+
+    # Лимит в один запрос и без ожидания: остальной анализ откладывается
+    monkeypatch.setattr(openai_processor, 'LLM_SCHEDULER', LLMRateScheduler(rpm=1, tpm=10 ** 9, max_wait_seconds=0))
+    main.run_all_blocks(now)
+
+    pending = json_codec.load_file(pending_path)
+    assert pending
+    assert {item['kind'] for item in pending} == {'comment'}
+
+    monkeypatch.setattr(openai_processor, 'LLM_SCHEDULER', LLMRateScheduler(rpm=10 ** 9, tpm=10 ** 12))
+    requests_before = llm.request_count
+    main.run_all_blocks(now.replace(hour=15))
+
+    assert not os.path.exists(pending_path)
+    assert llm.request_count > requests_before
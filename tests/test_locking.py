@@ -0,0 +1,55 @@
+# tests/test_locking.py
+
+from collections import Counter
+
+import pytest
+
+import locking
+import sharding
+from locking import FileLeaseBackend, LeaseLock, SQLiteLeaseBackend
+
+
+@pytest.fixture(params=['file', 'sqlite'])
+def backend(request, workdir):
+    return FileLeaseBackend(str(workdir)) if request.param == 'file' else SQLiteLeaseBackend('locks.sqlite3')
+
+
+def test_second_holder_is_rejected_until_release(backend):
+    first = LeaseLock('run', backend=backend, ttl=60)
+    second = LeaseLock('run', backend=backend, ttl=60)
+    with first as acquired:
+        assert acquired
+        with second as other:
+            assert not other
+    with second as acquired:
+        assert acquired
+
+
+def test_expired_lease_of_dead_owner_is_taken_over(backend, monkeypatch):
+    assert backend.acquire('run', 'dead-host:1', ttl=30)
+    assert not backend.acquire('run', 'live-host:2', ttl=30)
+
+    now = locking.time.time()
+    monkeypatch.setattr(locking.time, 'time', lambda: now + 31)
+    assert backend.acquire('run', 'live-host:2', ttl=30)
+    # Старый владелец не может ни продлить, ни снять чужую аренду
+    assert not backend.renew('run', 'dead-host:1', ttl=30)
+    backend.release('run', 'dead-host:1')
+    assert not backend.acquire('run', 'third:3', ttl=30)
+
+
+def test_shards_split_orders_stably_and_evenly():
+    owners = Counter(sharding.shard_of(order_id, 3) for order_id in range(10000, 13000))
+    assert set(owners) == {0, 1, 2}
+    assert min(owners.values()) > 900
+    assert [sharding.shard_of(str(order_id), 3) for order_id in (10000, 10001)] == \
+        [sharding.shard_of(order_id, 3) for order_id in (10000, 10001)]
+
+
+def test_shard_path_and_ownership(monkeypatch):
+    monkeypatch.setattr(sharding, 'SHARD_COUNT', 2)
+    monkeypatch.setattr(sharding, 'SHARD_INDEX', 1)
+    assert sharding.shard_path('ndz_tracker.json') == 'ndz_tracker.shard-1-of-2.json'
+    owned = [order_id for order_id in range(100) if sharding.owns_order(order_id)]
+    assert owned and len(owned) < 100
+    assert all(sharding.shard_of(order_id, 2) == 1 for order_id in owned)
@@ -0,0 +1,41 @@
+# tests/test_rate_limiter.py
+
+import pytest
+
+import retailcrm_api
+import tenants
+from retailcrm_api import RateLimiter
+
+
+@pytest.fixture
+def now(monkeypatch):
+    """Часы, которые двигает только sleep ограничителя."""
+    moment = [0.0]
+    slept = []
+
+    def sleep(seconds):
+        slept.append(seconds)
+        moment[0] += seconds
+
+    monkeypatch.setattr(retailcrm_api.time, 'monotonic', lambda: moment[0])
+    monkeypatch.setattr(retailcrm_api.time, 'sleep', sleep)
+    return slept
+
+
+def test_burst_passes_then_requests_are_spaced_by_rate(now):
+    # Шаг 1/4 с точно представим в float: часы теста двигает только sleep
+    limiter = RateLimiter(rate=4, burst=3)
+    for _ in range(3):
+        limiter.acquire()
+    assert now == []
+
+    for _ in range(5):
+        limiter.acquire()
+    assert now == [0.25] * 5
+
+
+def test_tenant_state_files_are_separate():
+    assert tenants.tenant_path('ndz_tracker.json') == 'ndz_tracker.json'
+    with tenants.use_tenant('shop2'):
+        assert tenants.tenant_path('ndz_tracker.json') == f"ndz_tracker{tenants.tenant_suffix()}.json"
+        assert tenants.tenant_suffix()
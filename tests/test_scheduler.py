@@ -0,0 +1,111 @@
+# tests/test_scheduler.py
+
+from datetime import timedelta
+
+import main
+import scheduler
+from conftest import START
+from scheduler import Scheduler, use_scheduler
+
+
+def test_run_orders_by_urgency_and_clears_queue(workdir):
+    work = Scheduler(0, path='pending.json', workers=1)
+    for urgency, order_id in [(10, 'a'), (90, 'b'), (50, 'c')]:
+        work.submit(urgency, 'task', order_id, step='s')
+    done = []
+
+    result = work.run({'task': lambda item: done.append(item.order_id)})
+
+    assert done == ['b', 'c', 'a']
+    assert result == {'done': 3, 'deferred': 0}
+    assert not work.has_pending()
+
+
+def test_budget_cutoff_saves_rest_and_next_run_loads_it(workdir):
+    work = Scheduler(3600, path='pending.json', workers=1)
+    for urgency in range(5):
+        work.submit(urgency, 'task', f'order-{urgency}', step='s', task_data={'text': str(urgency)})
+    done = []
+
+    def handler(item):
+        done.append(item.order_id)
+        # Бюджет исчерпан сразу после первого элемента
+        work.deadline = scheduler.time.monotonic()
+
+    result = work.run({'task': handler})
+
+    assert done == ['order-4']
+    assert result == {'done': 1, 'deferred': 4}
+
+    carried = Scheduler(0, path='pending.json', workers=1)
+    assert carried.load_pending() == 4
+    assert [item.payload['task_data'] for item in sorted(carried._items.values(), key=lambda i: -i.urgency)] == [
+        {'text': '3'}, {'text': '2'}, {'text': '1'}, {'text': '0'}]
+
+
+def test_failed_item_is_retried_until_max_attempts(workdir, monkeypatch):
+    monkeypatch.setattr(scheduler, 'SCHEDULER_MAX_ATTEMPTS', 2)
+
+    def failing(item):
+        raise RuntimeError('CRM отклонила задачу')
+
+    first = Scheduler(0, path='pending.json')
+    first.submit(1, 'task', '1', step='s')
+    assert first.run({'task': failing}) == {'done': 0, 'deferred': 1}
+
+    second = Scheduler(0, path='pending.json')
+    second.load_pending()
+    # Повторная постановка того же элемента не обнуляет счётчик попыток
+    second.submit(1, 'task', '1', step='s')
+    assert second.run({'task': failing}) == {'done': 0, 'deferred': 0}
+    assert not second.has_pending()
+
+
+def test_queued_ndz_task_advances_tracker_only_after_creation(crm, virtual_clock):
+    work = Scheduler(0, path='pending.json')
+    task_data = {'text': 'Обзвон', 'datetime': '2025-10-14 10:00', 'performerId': 1, 'order': {'id': 101}}
+    with use_scheduler(work):
+        response = main.create_task_once('101', 'ndz_day:1', task_data, progress={'tracker': 'ndz', 'day': 1})
+
+    assert response.get('queued')
+    assert main.load_ndz_tracker() == {}
+
+    main.run_scheduled_work(work)
+
+    assert main.load_ndz_tracker() == {'101': {'day': 1, 'last_task_date': '2025-10-13'}}
+    assert len(crm.tasks) == 1
+
+
+def test_carried_task_with_past_datetime_is_moved_to_tomorrow(crm, virtual_clock):
+    work = Scheduler(0, path='pending.json')
+    work.submit(1, 'task', '101', step='status_stall:x',
+                task_data={'text': 'Проверить', 'datetime': '2025-10-12 10:00', 'performerId': 1,
+                           'order': {'id': 101}},
+                progress={'tracker': 'status', 'status': 'x'})
+    main.save_trackers({'x': {'101': '2025-10-01'}})
+    virtual_clock.advance(timedelta(hours=1))
+
+    main.run_scheduled_work(work)
+
+    assert [task['datetime'] for task in crm.tasks] == [(START + timedelta(days=1)).strftime('%Y-%m-%d 10:00')]
+    assert '101' not in main.load_trackers().get('x', {})
+
+
+def test_digest_goes_through_queue(crm, virtual_clock, monkeypatch):
+    monkeypatch.setattr(main, 'DIGEST_RULES', ['status_stall'])
+    monkeypatch.setattr(main, 'DIGEST_MIN_ORDERS', 2)
+    main.save_trackers({'x': {'101': '2025-10-01', '102': '2025-10-01'}})
+    work = Scheduler(0, path='pending.json')
+    with use_scheduler(work):
+        digest = main.TaskDigest('status_stall', 'status_stall:x', "Проверить заказы", '2025-10-14 10:00')
+        for order_id in ('101', '102'):
+            response = digest.add(order_id, order_id, {'performerId': 7}, "завис",
+                                  progress={'tracker': 'status', 'status': 'x'})
+            assert response.get('queued')
+        digest.flush()
+
+    assert crm.tasks == []
+    main.run_scheduled_work(work)
+
+    assert len(crm.tasks) == 1
+    assert main.load_trackers()['x'] == {}
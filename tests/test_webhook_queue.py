@@ -0,0 +1,65 @@
+# tests/test_webhook_queue.py
+
+import time
+
+import webhook_server
+from webhook_server import OrderWorkQueue, extract_order_id
+
+
+def test_order_is_released_only_after_debounce():
+    work_queue = OrderWorkQueue(debounce_seconds=0.2)
+    work_queue.put(101)
+    assert work_queue.get_batch(10, timeout=0) == []
+
+    started = time.monotonic()
+    assert work_queue.get_batch(10, timeout=2) == ['101']
+    assert time.monotonic() - started > 0.1
+
+
+def test_repeated_events_are_merged_and_extend_debounce():
+    work_queue = OrderWorkQueue(debounce_seconds=0.3)
+    work_queue.put(101)
+    time.sleep(0.2)
+    work_queue.put(101)
+    work_queue.put(102)
+    assert len(work_queue) == 2
+
+    # Через 0.3 с после первого события заказ ещё ждёт: повтор отодвинул обработку
+    time.sleep(0.15)
+    assert work_queue.get_batch(10, timeout=0) == []
+    assert sorted(work_queue.get_batch(10, timeout=2)) == ['101', '102']
+
+
+def test_order_in_progress_is_not_handed_out_twice():
+    work_queue = OrderWorkQueue(debounce_seconds=0)
+    work_queue.put(101)
+    assert work_queue.get_batch(10, timeout=1) == ['101']
+
+    work_queue.put(101)
+    assert work_queue.get_batch(10, timeout=0.1) == []
+    work_queue.done(101)
+    assert work_queue.get_batch(10, timeout=1) == ['101']
+
+
+def test_full_queue_rejects_new_orders_but_accepts_repeats():
+    work_queue = OrderWorkQueue(max_size=2, debounce_seconds=10)
+    assert work_queue.put(1) and work_queue.put(2)
+    assert not work_queue.put(3)
+    assert work_queue.put(2)
+
+
+def test_extract_order_id_from_query_form_and_json():
+    assert extract_order_id({'id': ['101']}, b'', '') == '101'
+    assert extract_order_id({}, b'order_id=102', 'application/x-www-form-urlencoded') == '102'
+    assert extract_order_id({}, b'{"order": {"id": 103}}', 'application/json') == '103'
+    assert extract_order_id({}, b'{"id": "abc"}', 'application/json') is None
+
+
+def test_throttled_order_is_returned_to_queue(crm, monkeypatch):
+    crm.orders[101] = {'id': 101, 'status': 'new', 'managerComment': 'позвонить'}
+    monkeypatch.setattr(webhook_server, 'process_order', lambda order: 'llm_unavailable')
+    work_queue = OrderWorkQueue(debounce_seconds=0)
+
+    webhook_server.process_batch(work_queue, ['101'])
+
+    assert len(work_queue) == 1
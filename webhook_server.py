@@ -0,0 +1,275 @@
+# webhook_server.py
+
+import sys
+import time
+import threading
+import requests
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from typing import Dict, List, Optional, Set
+
+import checkpoint
+import json_codec
+import log
+from retailcrm_api import get_orders_by_ids
+from main import process_order, run_lock
+from models import Order
+from settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_HOST = SETTINGS.webhook_host
+WEBHOOK_PORT = SETTINGS.webhook_port
+WEBHOOK_PATH = '/retailcrm/trigger'
+# Секрет, который триггер RetailCRM передаёт в параметре token (пустой — проверка отключена)
+WEBHOOK_TOKEN = SETTINGS.webhook_token
+
+# Сколько секунд ждать после последнего события по заказу, прежде чем его обработать:
+# менеджер часто сохраняет комментарий несколько раз подряд
+DEBOUNCE_SECONDS = SETTINGS.webhook_debounce_seconds
+# Максимальное число заказов в очереди; при переполнении отвечаем 503 (backpressure)
+QUEUE_MAX_SIZE = SETTINGS.webhook_queue_max_size
+# Сколько готовых заказов worker забирает за раз (одним пакетным запросом в CRM)
+DRAIN_BATCH_SIZE = SETTINGS.webhook_drain_batch_size
+
+
+class OrderWorkQueue:
+    """
+    Ограниченная очередь ID заказов с дедупликацией и debounce.
+    Повторное событие по заказу, который ещё ждёт обработки, не создаёт новый элемент,
+    а откладывает его обработку на DEBOUNCE_SECONDS от последнего события.
+    Заказ, который сейчас обрабатывается, не выдаётся повторно до вызова done().
+    """
+
+    def __init__(self, max_size: int = QUEUE_MAX_SIZE, debounce_seconds: float = DEBOUNCE_SECONDS):
+        self.max_size = max_size
+        self.debounce_seconds = debounce_seconds
+        self._ready_at: Dict[str, float] = {}
+        self._in_progress: Set[str] = set()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._ready_at)
+
+    def put(self, order_id) -> bool:
+        """Добавляет заказ в очередь. Возвращает False, если очередь переполнена."""
+        order_id = str(order_id)
+        with self._cond:
+            if order_id not in self._ready_at and len(self._ready_at) >= self.max_size:
+                return False
+            self._ready_at[order_id] = time.monotonic() + self.debounce_seconds
+            self._cond.notify()
+            return True
+
+    def get_batch(self, max_items: int, timeout: Optional[float] = None) -> List[str]:
+        """
+        Ждёт, пока появятся заказы с истёкшим debounce, и забирает до max_items из них.
+        Возвращает пустой список по таймауту или после close().
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not self._closed:
+                now = time.monotonic()
+                ready = [
+                    order_id for order_id, ready_at in sorted(self._ready_at.items(), key=lambda item: item[1])
+                    if ready_at <= now and order_id not in self._in_progress
+                ][:max_items]
+                if ready:
+                    for order_id in ready:
+                        del self._ready_at[order_id]
+                        self._in_progress.add(order_id)
+                    return ready
+
+                waits = [ready_at - now for ready_at in self._ready_at.values() if ready_at > now]
+                if deadline is not None:
+                    waits.append(deadline - now)
+                    if deadline <= now:
+                        return []
+                self._cond.wait(timeout=min(waits) if waits else None)
+            return []
+
+    def done(self, order_id) -> None:
+        """Отмечает завершение обработки заказа."""
+        with self._cond:
+            self._in_progress.discard(str(order_id))
+            self._cond.notify()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+def drain_queue(work_queue: OrderWorkQueue, stop_event: threading.Event):
+    """
+    Worker: забирает готовые заказы, пакетно получает их из CRM и передаёт в process_order.
+    Пакет обрабатывается под той же блокировкой и с тем же журналом прогресса, что и периодический
+    запуск: пока идёт cron, заказы возвращаются в очередь, а не анализируются параллельно с ним.
+    """
+    while not stop_event.is_set():
+        order_ids = work_queue.get_batch(DRAIN_BATCH_SIZE, timeout=1.0)
+        if not order_ids:
+            continue
+
+        try:
+            with run_lock() as acquired:
+                if not acquired:
+                    logger.info("Идёт периодический запуск (блокировка занята). %s заказов возвращены в очередь.",
+                                len(order_ids))
+                    requeue(work_queue, order_ids)
+                    continue
+                process_batch(work_queue, order_ids)
+        finally:
+            for order_id in order_ids:
+                work_queue.done(order_id)
+
+
+def process_batch(work_queue: OrderWorkQueue, order_ids: List[str]):
+    """Обрабатывает пакет заказов как отдельный запуск журнала; отложенный анализ возвращается в очередь."""
+    logger.info("Обработка %s заказов из очереди триггеров: %s", len(order_ids), ', '.join(order_ids))
+    checkpoint.journal().start()
+    try:
+        orders = get_orders_by_ids(order_ids)
+        for order_id in order_ids:
+            order_data = orders.get(order_id)
+            if order_data is None:
+                logger.info("Заказ %s не получен из CRM. Пропускаю.", order_id)
+                continue
+            try:
+                outcome = process_order(Order.from_api(order_data))
+            except Exception as e:
+                logger.error("❌ Ошибка при обработке заказа %s: %s", order_id, e)
+                continue
+            if outcome == 'llm_unavailable':
+                requeue(work_queue, [order_id])
+    finally:
+        checkpoint.journal().finish()
+
+
+def requeue(work_queue: OrderWorkQueue, order_ids: List[str]):
+    """Возвращает заказы в очередь (через DEBOUNCE_SECONDS); при переполнении их подберёт периодический запуск."""
+    for order_id in order_ids:
+        if not work_queue.put(order_id):
+            logger.warning("Очередь триггеров переполнена: заказ %s обработает периодический запуск.", order_id)
+
+
+def extract_order_id(query: Dict[str, List[str]], body: bytes, content_type: str) -> Optional[str]:
+    """
+    Достаёт ID заказа из запроса триггера: из query-параметров, form-data или JSON-тела.
+    Поддерживаются имена параметров 'id' и 'order_id'.
+    """
+    values = dict(query)
+    if body:
+        if 'application/json' in content_type:
+            try:
+                payload = json_codec.loads(body)
+            except json_codec.JSONDecodeError:
+                payload = {}
+            if isinstance(payload, dict):
+                order = payload.get('order')
+                if isinstance(order, dict) and order.get('id') is not None:
+                    values.setdefault('id', [str(order['id'])])
+                for key in ('id', 'order_id'):
+                    if payload.get(key) is not None:
+                        values.setdefault(key, [str(payload[key])])
+        else:
+            for key, value in parse_qs(body.decode('utf-8', errors='replace')).items():
+                values.setdefault(key, value)
+
+    for key in ('id', 'order_id'):
+        raw_value = (values.get(key) or [''])[0].strip()
+        if raw_value.isdigit():
+            return raw_value
+    return None
+
+
+def make_handler(work_queue: OrderWorkQueue, token: str = WEBHOOK_TOKEN):
+    """Создаёт класс обработчика HTTP-запросов, привязанный к очереди."""
+
+    class TriggerHandler(BaseHTTPRequestHandler):
+
+        def _reply(self, status: int, payload: dict, headers: Optional[Dict[str, str]] = None):
+            body = json_codec.dumps_bytes(payload)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self):
+            parsed = urlparse(self.path)
+            if parsed.path != WEBHOOK_PATH:
+                self._reply(404, {'success': False, 'error': 'not found'})
+                return
+
+            query = parse_qs(parsed.query)
+            if token and (query.get('token') or [''])[0] != token:
+                self._reply(403, {'success': False, 'error': 'invalid token'})
+                return
+
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            order_id = extract_order_id(query, body, self.headers.get('Content-Type', ''))
+            if order_id is None:
+                self._reply(400, {'success': False, 'error': 'order id is required'})
+                return
+
+            if not work_queue.put(order_id):
+                self._reply(503, {'success': False, 'error': 'queue is full'},
+                            headers={'Retry-After': str(int(max(work_queue.debounce_seconds, 1)))})
+                return
+
+            self._reply(202, {'success': True, 'id': order_id, 'queued': len(work_queue)})
+
+        do_GET = _handle
+        do_POST = _handle
+
+        def log_message(self, format, *args):
+            # Стандартный лог http.server пишет в stderr каждую строку запроса; оставляем только ошибки
+            pass
+
+    return TriggerHandler
+
+
+def run_server(host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+    """Запускает HTTP-приёмник триггеров и worker, обрабатывающий очередь."""
+    log.configure()
+    work_queue = OrderWorkQueue()
+    stop_event = threading.Event()
+    worker = threading.Thread(target=drain_queue, args=(work_queue, stop_event), daemon=True)
+    worker.start()
+
+    server = ThreadingHTTPServer((host, port), make_handler(work_queue))
+    logger.info("Приёмник триггеров RetailCRM слушает http://%s:%s%s", host, port, WEBHOOK_PATH)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stop_event.set()
+        work_queue.close()
+        worker.join()
+
+
+def send_fake_trigger(url: str, order_id: int, token: str = WEBHOOK_TOKEN) -> requests.Response:
+    """Имитирует вызов триггера RetailCRM (для локальной проверки приёмника)."""
+    params = {'token': token} if token else {}
+    return requests.post(url, params=params, data={'id': order_id}, timeout=10)
+
+
+if __name__ == "__main__":
+    # python webhook_server.py                 — запустить приёмник
+    # python webhook_server.py send 123 456    — отправить фейковые триггеры на локальный приёмник
+    if len(sys.argv) > 2 and sys.argv[1] == 'send':
+        target_url = f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+        for arg in sys.argv[2:]:
+            response = send_fake_trigger(target_url, int(arg))
+            print(f"{arg}: {response.status_code} {response.text}")
+    else:
+        run_server()